@@ -1,5 +1,5 @@
+import os
 from flask import *
-from sqlalchemy import text
 
 
 
@@ -7,33 +7,10 @@ def create_app():
     app = Flask(__name__)
     from flask_cors import CORS
     from app.routes import api_bp
-    from app.db import db_path
-    import duckdb
-    CORS(app)
-    from app.db.setup import engine, Base, get_db
-    from app.models.sql import AppDetail, AppId
-    Base.metadata.create_all(bind=engine)
-
-    with engine.connect() as conn:
-        # duckdb doesnt have materialized views
-        conn.execute(text(
-            """
-            CREATE VIEW IF NOT EXISTS app_genres AS
-            SELECT DISTINCT element AS genre
-            FROM detail,
-                 UNNEST(genres) AS element
-            """
-        )
-        )
-
-        conn.execute(text(
-            """
-            CREATE VIEW IF NOT EXISTS app_categories AS
-            SELECT DISTINCT element AS category
-            FROM detail,
-                 UNNEST(categories) AS element
-            """)
-        )
-    engine.dispose()
+    CORS(app, expose_headers=['X-Next-Cursor', 'Server-Timing', 'ETag'])
+    # the schema is created by python -m app.db.migrations, so starting a worker doesnt touch the database
+    if os.getenv('MIGRATE_ON_STARTUP', 'false').lower() == 'true':
+        from app.db.migrations import run_migrations
+        run_migrations()
     app.register_blueprint(api_bp)
-    return app
\ No newline at end of file
+    return app
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import time
+from app.utils.logger import logger
+
+
+def create_asgi_app(flask_app=None):
+    """
+    Async serving mode. /api/search runs on the event loop: the query is embedded with aembed_query,
+    DuckDB work runs in worker threads and identical in-flight searches are coalesced.
+    Every other route is served by the flask app through a WSGI adapter.
+    """
+    from asgiref.wsgi import WsgiToAsgi
+    from app import create_app
+    from app.db.connection import connection_manager
+    from app.routes.api import validate_search, search_key, search_cache_key, encode_cursor
+    from app.db.connection import get_cursor
+    from app.db.version import get_dataset_version
+    from app.services.response_cache import response_cache, CachedResponse, make_etag, etag_matches, cache_control
+    from app.services.embedder import aembed_query_cached
+    from app.services.searcher import rank_query_search, fetch_details, needs_embedding
+    from app.services.singleflight import AsyncSingleFlight
+    from app.utils.streaming import stream_ndjson, stream_arrow, ndjson_mimetype, arrow_mimetype
+    from app.utils.metrics import span, start_timings, server_timing, request_seconds, errors
+
+    flask_app = flask_app or create_app()
+    wsgi_app = WsgiToAsgi(flask_app)
+    search_flight = AsyncSingleFlight()
+
+    def render(ids: list[int], fields: list[str] | None, response_format: str) -> tuple[bytes, str]:
+        result = fetch_details(ids, fields)
+        with span('serialize'):
+            if response_format == 'ndjson':
+                return b''.join(stream_ndjson(result.fetch_record_batch())), ndjson_mimetype
+            if response_format == 'arrow':
+                return b''.join(stream_arrow(result.fetch_record_batch())), arrow_mimetype
+            return result.df().to_json(orient="records").encode('utf-8'), 'application/json'
+
+    async def run_search(search_request: dict) -> tuple[bytes, str, int]:
+        search_args = search_request['search']
+        if await asyncio.to_thread(
+                needs_embedding, search_args['query'], search_args['category'], search_args['genre'],
+                search_args['price_start'], search_args['price_end'], search_args['mode']
+        ):
+            # fills the query cache, so the ranking below doesnt block on the embedding api
+            with span('embed'):
+                await aembed_query_cached(search_args['query'])
+        ids = await asyncio.to_thread(
+            rank_query_search, **search_args, k=search_request['k'], offset=search_request['offset']
+        )
+        body, mimetype = await asyncio.to_thread(render, ids, search_request['fields'], search_request['format'])
+        return body, mimetype, len(ids)
+
+    async def send_response(send, status: int, body: bytes, mimetype: str, headers: list[tuple[bytes, bytes]] = ()):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', mimetype.encode()),
+                (b'content-length', str(len(body)).encode()),
+                (b'access-control-allow-origin', b'*'),
+                (b'access-control-expose-headers', b'X-Next-Cursor, Server-Timing, ETag'),
+                *headers,
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def search(scope, receive, send):
+        timings = start_timings()
+        start = time.perf_counter()
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        try:
+            data = json.loads(body or b'null')
+        except ValueError:
+            data = None
+        search_request, error = validate_search(data)
+        if error:
+            await send_response(send, 400, json.dumps({'error': error}).encode(), 'application/json')
+            return
+        cache_key = search_cache_key(search_request) if response_cache.enabled else None
+        entry = None
+        if cache_key is not None:
+            with span('cache'):
+                version = await asyncio.to_thread(lambda: get_dataset_version(get_cursor()))
+                entry = response_cache.get(version, cache_key)
+        if entry is None:
+            key = json.dumps([search_key(search_request), search_request['fields'], search_request['format']])
+            try:
+                body, mimetype, count = await search_flight.do(key, lambda: run_search(search_request))
+            except Exception as e:
+                logger.error(f"Search failed: {e}")
+                errors.inc('search')
+                request_seconds.observe(time.perf_counter() - start, 'search')
+                await send_response(send, 500, json.dumps({'error': 'Internal server error.'}).encode(), 'application/json')
+                return
+            next_cursor = {}
+            if count == search_request['k']:
+                next_cursor['X-Next-Cursor'] = encode_cursor(search_request['offset'] + search_request['k'])
+            entry = CachedResponse(body, mimetype, make_etag(body), next_cursor)
+            if cache_key is not None:
+                response_cache.put(version, cache_key, entry)
+        headers = [(name.lower().encode(), value.encode()) for name, value in entry.headers.items()]
+        headers += [(b'etag', entry.etag.encode()), (b'cache-control', cache_control().encode())]
+        request_seconds.observe(time.perf_counter() - start, 'search')
+        if timings:
+            headers.append((b'server-timing', server_timing(timings).encode()))
+        request_headers = dict(scope.get('headers', []))
+        if etag_matches(request_headers.get(b'if-none-match', b'').decode('latin-1'), entry.etag):
+            response_cache.mark_not_modified()
+            await send_response(send, 304, b'', entry.mimetype, headers)
+            return
+        await send_response(send, 200, entry.body, entry.mimetype, headers)
+
+    async def lifespan(scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                connection_manager.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await lifespan(scope, receive, send)
+        elif scope['type'] == 'http' and scope['path'] == '/api/search' and scope['method'] == 'POST':
+            await search(scope, receive, send)
+        else:
+            await wsgi_app(scope, receive, send)
+
+    return application
@@ -0,0 +1,220 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+import aiohttp
+from app.utils.logger import logger
+
+# steam answers 429 past its per-ip budget, the bucket keeps the crawl under it and the concurrency adapts to what is left
+crawler_rate = float(os.getenv('CRAWLER_RATE', 10))
+crawler_burst = int(os.getenv('CRAWLER_BURST', 10))
+crawler_min_concurrency = int(os.getenv('CRAWLER_MIN_CONCURRENCY', 1))
+crawler_max_concurrency = int(os.getenv('CRAWLER_MAX_CONCURRENCY', 64))
+crawler_initial_concurrency = int(os.getenv('CRAWLER_INITIAL_CONCURRENCY', 8))
+crawler_max_tries = int(os.getenv('CRAWLER_MAX_TRIES', 5))
+crawler_backoff_base = float(os.getenv('CRAWLER_BACKOFF_BASE', 1))
+crawler_backoff_max = float(os.getenv('CRAWLER_BACKOFF_MAX', 120))
+
+
+class TokenBucket:
+    """
+    Global request rate of the crawl, rate tokens per second up to burst, a rate of 0 disables it.
+    pause holds every request, it is used when steam says when to come back.
+    """
+
+    def __init__(self, rate: float = crawler_rate, burst: int = crawler_burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        # the lock makes the waiters take their tokens in order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self.rate <= 0:
+                    return
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit of the requests in flight: every success adds 1/limit (about one slot per round of requests),
+    a throttled request (429, 5xx, timeout) multiplies it by decrease. Only requests started after the last
+    decrease can decrease it again, so one burst of 429s counts once.
+    """
+
+    def __init__(self, initial: int = crawler_initial_concurrency, minimum: int = crawler_min_concurrency,
+                 maximum: int = crawler_max_concurrency, decrease: float = 0.5):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease = decrease
+        self.in_flight = 0
+        self._decreased_at = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, started: float, throttled: bool | None):
+        """
+        throttled is None for failures that say nothing about the load (bad responses, 404s).
+        """
+        async with self._condition:
+            self.in_flight -= 1
+            if throttled and started >= self._decreased_at:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._decreased_at = time.monotonic()
+                logger.warning(f"Steam is throttling, concurrency lowered to {int(self.limit)}.")
+            elif throttled is False:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    Seconds asked by a Retry-After header, in seconds or as an http date.
+    """
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttled(error: BaseException) -> bool | None:
+    if isinstance(error, aiohttp.ClientResponseError):
+        if error.status == 429 or error.status >= 500:
+            return True
+        return None
+    # timeouts and dropped connections are what an overloaded proxy or server looks like
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+        return True
+    return None
+
+
+def backoff_delay(attempt: int, error: BaseException, base: float = crawler_backoff_base,
+                  maximum: float = crawler_backoff_max) -> float:
+    # full jitter, so the retries of a burst dont come back together, never sooner than Retry-After
+    delay = random.uniform(0, min(maximum, base * 2 ** attempt))
+    asked = retry_after(error)
+    return max(delay, asked) if asked is not None else delay
+
+
+class CrawlScheduler:
+    """
+    Runs every fetch of a crawl on one event loop. Items are pulled from a shared queue by as many workers
+    as the concurrency can reach, each request waits for a concurrency slot and a rate token,
+    failures go back to the queue after their backoff.
+    """
+
+    def __init__(self, bucket: TokenBucket | None = None, concurrency: AdaptiveConcurrency | None = None,
+                 max_tries: int = crawler_max_tries):
+        self.bucket = bucket or TokenBucket()
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.max_tries = max_tries
+        self.stats = {'requests': 0, 'throttled': 0, 'retries': 0, 'failed': 0}
+
+    async def _requeue(self, queue: asyncio.Queue, item: Hashable, attempt: int, delay: float):
+        # the retried item stays unfinished in the queue until it is back in it, so join waits for it
+        try:
+            await asyncio.sleep(delay)
+            queue.put_nowait((item, attempt))
+        finally:
+            queue.task_done()
+
+    async def _worker(self, queue: asyncio.Queue, fetch: Callable[[Hashable], Awaitable[Any]],
+                      on_done: Callable[[Hashable, Any, BaseException | None], None], retries: set):
+        while True:
+            item, attempt = await queue.get()
+            # the slot comes first, so a token is only taken by a request that is sent right away
+            await self.concurrency.acquire()
+            await self.bucket.acquire()
+            started = time.monotonic()
+            self.stats['requests'] += 1
+            try:
+                result = await fetch(item)
+            except Exception as e:
+                throttled = is_throttled(e)
+                await self.concurrency.release(started, throttled)
+                if throttled:
+                    self.stats['throttled'] += 1
+                asked = retry_after(e)
+                if asked:
+                    # the budget is per ip, so every request waits, not only this one
+                    self.bucket.pause(asked)
+                if attempt + 1 < self.max_tries:
+                    delay = backoff_delay(attempt, e)
+                    logger.error(f"Error fetching {item} on attempt {attempt + 1}: {e!r}, retrying in {delay:.1f}s.")
+                    self.stats['retries'] += 1
+                    task = asyncio.create_task(self._requeue(queue, item, attempt + 1, delay))
+                    retries.add(task)
+                    task.add_done_callback(retries.discard)
+                    continue
+                logger.error(f"Max retries reached for {item}, skipping.")
+                self.stats['failed'] += 1
+                on_done(item, None, e)
+                queue.task_done()
+                continue
+            await self.concurrency.release(started, False)
+            on_done(item, result, None)
+            queue.task_done()
+
+    async def run(self, items: Iterable[Hashable], fetch: Callable[[Hashable], Awaitable[Any]],
+                  on_done: Callable[[Hashable, Any, BaseException | None], None]):
+        """
+        Calls fetch for every item and on_done(item, result, error) once per item, error is the last
+        exception when every try failed.
+        """
+        self.stats = dict.fromkeys(self.stats, 0)
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait((item, 0))
+        retries: set = set()
+        workers = [
+            asyncio.create_task(self._worker(queue, fetch, on_done, retries))
+            for _ in range(self.concurrency.maximum)
+        ]
+        join = asyncio.create_task(queue.join())
+        try:
+            # a worker only returns by raising, its error must not leave join waiting forever
+            await asyncio.wait([join, *workers], return_when=asyncio.FIRST_COMPLETED)
+            for task in workers:
+                if task.done():
+                    task.result()
+        finally:
+            join.cancel()
+            for task in workers + list(retries):
+                task.cancel()
+            await asyncio.gather(*workers, *retries, return_exceptions=True)
+        logger.info(
+            f"Crawl finished: {self.stats['requests']} requests, {self.stats['throttled']} throttled, "
+            f"{self.stats['retries']} retries, {self.stats['failed']} failed, concurrency {int(self.concurrency.limit)}."
+        )
@@ -6,8 +6,19 @@ from app.utils.logger import logger
 import asyncio
 load_dotenv()
 
+# connection pool of the crawler session, connections to the proxy are kept open and reused between requests
+crawler_connection_limit = int(os.getenv('CRAWLER_CONNECTION_LIMIT', 100))
+crawler_limit_per_host = int(os.getenv('CRAWLER_LIMIT_PER_HOST', 30))
+crawler_keepalive_timeout = float(os.getenv('CRAWLER_KEEPALIVE_TIMEOUT', 60))
+crawler_dns_cache_ttl = int(os.getenv('CRAWLER_DNS_CACHE_TTL', 300))
+crawler_request_timeout = float(os.getenv('CRAWLER_REQUEST_TIMEOUT', 30))
+
 
 class Crawler:
+    """
+    Owns one aiohttp session for the whole crawl, use it as `async with Crawler() as crawler:`
+    so the pooled connections are closed when the crawl ends.
+    """
 
     url = 'https://ipv4.icanhazip.com'
 
@@ -21,27 +32,68 @@ class Crawler:
         "app_detail":"https://store.steampowered.com/api/appdetails"
     }
 
+    def __init__(self, limit: int = crawler_connection_limit, limit_per_host: int = crawler_limit_per_host,
+                 keepalive_timeout: float = crawler_keepalive_timeout, dns_cache_ttl: int = crawler_dns_cache_ttl):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session: aiohttp.ClientSession | None = None
+
+    async def __aenter__(self) -> 'Crawler':
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            ssl=False,
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            proxy=self.proxies.get('https'),
+            # no total timeout, the app list is a single large download
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=crawler_request_timeout, sock_read=crawler_request_timeout),
+        )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("Crawler session is not open, use `async with Crawler() as crawler:`.")
+        return self._session
+
 
     async def detect_ip(self):
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-            async with session.get('https://api.ipify.org?format=json', proxy=self.proxies.get('https')) as response:
-                print(f"Response: {await response.json()}")
+        async with self.session.get('https://api.ipify.org?format=json') as response:
+            print(f"Response: {await response.json()}")
 
 
     async def get_app_detail(self, app_id):
         params = {
             "appids": app_id,
         }
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False), proxy=self.proxies.get('https')) as session:
-            async with session.get(self.urls["app_detail"], params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-                app_data = data.get(str(app_id))
-                if not app_data or not app_data.get('success'):
-                    logger.error(f"Failed to retrieve app details for app ID {app_id}.")
-                    return None
-                response = AppDetailResponse.from_dict(app_data)
-                return response
+        async with self.session.get(self.urls["app_detail"], params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+            app_data = data.get(str(app_id))
+            if not app_data or not app_data.get('success'):
+                logger.error(f"Failed to retrieve app details for app ID {app_id}.")
+                return None
+            response = AppDetailResponse.from_dict(app_data)
+            return response
 
 
 
@@ -49,14 +101,19 @@ class Crawler:
         params = {
             "format": "json"
         }
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False), proxy=self.proxies.get('https')) as session:
-            async with session.get(self.urls["app_list"], params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-                response = AppIdResponse.from_dict(data)
-                logger.info(f"Total apps found: {len(response.applist.apps)}")
-                return response
+        async with self.session.get(self.urls["app_list"], params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+            response = AppIdResponse.from_dict(data)
+            logger.info(f"Total apps found: {len(response.applist.apps)}")
+            return response
+
+
+async def _main():
+    async with Crawler() as crawler:
+        return await crawler.get_app_detail('428020')
+
+
 if __name__ == '__main__':
-    crawler = Crawler()
-    x = asyncio.run(crawler.get_app_detail('428020'))
-    print(x)
\ No newline at end of file
+    x = asyncio.run(_main())
+    print(x)
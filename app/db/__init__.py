@@ -6,8 +6,13 @@ base_path = os.path.join(
 )
 os.makedirs(base_path, exist_ok=True)
 db_name = "steam-searcher.duckdb"
-db_path = os.path.join(base_path, db_name)
+# the benchmark points the app to synthetic catalogs through these variables
+db_path = os.getenv('STEAM_SEARCHER_DB', os.path.join(base_path, db_name))
 bronze_path = os.path.join(base_path, 'bronze', 'details')
 os.makedirs(bronze_path, exist_ok=True)
 silver_path = os.path.join(base_path, 'silver', 'details')
-os.makedirs(silver_path, exist_ok=True)
\ No newline at end of file
+os.makedirs(silver_path, exist_ok=True)
+vectors_path = os.getenv('STEAM_SEARCHER_VECTORS', os.path.join(base_path, 'vectors'))
+# the persistent query embedding cache has its own file, so the api can write it while the catalog is read-only
+query_cache_path = os.getenv('STEAM_SEARCHER_QUERY_CACHE', os.path.splitext(db_path)[0] + '.query_cache.duckdb')
+os.makedirs(vectors_path, exist_ok=True)
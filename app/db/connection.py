@@ -0,0 +1,112 @@
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+import duckdb
+from app.db import db_path
+from app.utils.logger import logger
+from app.utils.metrics import span
+
+# the vss extension crashes the process (SIGSEGV) when two HNSW index scans run at the same time, on cursors or
+# connections, and also when they scan different indexes or tables, so the lock is per process and not per index.
+# Exact scans and every other query still run in parallel. It caps a worker at one index scan at a time,
+# more HNSW throughput takes more worker processes, the hnsw_wait stage shows how long searches queue for it.
+hnsw_scan_lock = threading.Lock()
+
+
+@contextmanager
+def hnsw_scan():
+    """
+    Holds hnsw_scan_lock around a query that can be rewritten into an index scan,
+    timing the wait (hnsw_wait) and the scan (hnsw_scan) as search stages.
+    """
+    with span('hnsw_wait'):
+        hnsw_scan_lock.acquire()
+    try:
+        with span('hnsw_scan'):
+            yield
+    finally:
+        hnsw_scan_lock.release()
+
+
+class ConnectionManager:
+    """
+    Keeps a single DuckDB database open for the whole process and hands out one cursor per thread.
+    Every cursor gets vss loaded and the HNSW settings applied, so the index can be used at query time.
+    """
+
+    def __init__(self, path: str, read_only: bool = True, ef_search: int | None = None):
+        self.path = path
+        self.read_only = read_only
+        self.ef_search = ef_search
+        self._conn: duckdb.DuckDBPyConnection | None = None
+        self._cursors: list[duckdb.DuckDBPyConnection] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _configure(self, conn: duckdb.DuckDBPyConnection):
+        conn.execute("LOAD vss;")
+        conn.execute("LOAD fts;")
+        conn.execute("SET hnsw_enable_experimental_persistence = true;")
+        if self.ef_search:
+            conn.execute(f"SET hnsw_ef_search = {int(self.ef_search)};")
+
+    def connection(self) -> duckdb.DuckDBPyConnection:
+        with self._lock:
+            if self._conn is None:
+                self._conn = duckdb.connect(self.path, read_only=self.read_only)
+                self._configure(self._conn)
+                logger.info(f"Opened DuckDB connection to {self.path} (read_only={self.read_only}).")
+            return self._conn
+
+    def use_read_write(self):
+        """
+        Write tools call it before their first query. The API keeps the database read-only, so it doesnt hold
+        the file lock that the migrations, the embedding job and the other workers need.
+        """
+        with self._lock:
+            if self._conn is not None and self.read_only:
+                raise RuntimeError(f"{self.path} is already open read-only in this process.")
+            self.read_only = False
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self.connection().cursor()
+            self._configure(cursor)
+            with self._lock:
+                self._cursors.append(cursor)
+            self._local.cursor = cursor
+        return cursor
+
+    def close(self):
+        with self._lock:
+            for cursor in self._cursors:
+                try:
+                    cursor.close()
+                except duckdb.Error:
+                    pass
+            self._cursors.clear()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                logger.info(f"Closed DuckDB connection to {self.path}.")
+            # other threads still hold a reference to their closed cursor
+            self._local = threading.local()
+
+
+connection_manager = ConnectionManager(
+    db_path,
+    read_only=os.getenv('DUCKDB_READ_ONLY', 'true').lower() == 'true',
+    ef_search=int(os.getenv('HNSW_EF_SEARCH')) if os.getenv('HNSW_EF_SEARCH') else None,
+)
+atexit.register(connection_manager.close)
+
+
+def get_cursor() -> duckdb.DuckDBPyConnection:
+    return connection_manager.cursor()
+
+
+def get_write_cursor() -> duckdb.DuckDBPyConnection:
+    connection_manager.use_read_write()
+    return connection_manager.cursor()
@@ -0,0 +1,77 @@
+import duckdb
+from app.utils.logger import logger
+
+extensions = ('vss', 'fts')
+
+
+def install_extensions(conn: duckdb.DuckDBPyConnection):
+    # INSTALL downloads the extension, so it only runs when it cant be loaded yet
+    for extension in extensions:
+        try:
+            conn.execute(f"LOAD {extension};")
+        except duckdb.Error:
+            logger.info(f"Installing the DuckDB {extension} extension.")
+            conn.execute(f"INSTALL {extension};")
+            conn.execute(f"LOAD {extension};")
+
+
+def create_orm_tables():
+    # duckdb_engine opens the file with its own configuration, so this runs before any other connection
+    from app.db.setup import engine, Base
+    from app.models.sql import AppDetail, AppId
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+
+def migrate(conn: duckdb.DuckDBPyConnection):
+    """
+    Creates the tables, indexes and extensions the app needs on top of the collected data.
+    Every step is idempotent, so it runs after each data load and on deploys.
+    """
+    from app.db.version import ensure_dataset_version_table
+    from app.services.embedder import embeddings_table_name, embeddings_index_name, model_size
+    from app.services.index_manager import ensure_index_status_table, hnsw_m, hnsw_ef_construction, hnsw_metric
+    from app.services.similar import ensure_neighbors_table
+    from app.services.embedding_job import ensure_job_runs_table, ensure_content_hash
+    from app.services.bitmasks import ensure_bitmasks
+    from app.services.facets import ensure_facets
+    from app.services.lexical import ensure_fts_index, ensure_title_index
+    from app.services.query_cache import move_catalog_cache
+
+    install_extensions(conn)
+    conn.execute("SET hnsw_enable_experimental_persistence = true;")
+    ensure_dataset_version_table(conn)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {embeddings_table_name} (
+            id VARCHAR,
+            name VARCHAR,
+            text TEXT,
+            embedding FLOAT[{model_size}],
+            content_hash VARCHAR
+        );
+    """)
+    ensure_content_hash(conn, embeddings_table_name)
+    move_catalog_cache(conn)
+    ensure_index_status_table(conn)
+    ensure_neighbors_table(conn)
+    ensure_job_runs_table(conn)
+    conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS {embeddings_index_name} ON {embeddings_table_name} USING HNSW (embedding)
+        WITH (metric = '{hnsw_metric}', M = {hnsw_m}, ef_construction = {hnsw_ef_construction})
+    """)
+    ensure_bitmasks(conn)
+    ensure_facets(conn)
+    ensure_fts_index(conn)
+    ensure_title_index(conn)
+    logger.info("Database migrated.")
+
+
+def run_migrations():
+    from app.db import db_path
+    create_orm_tables()
+    with duckdb.connect(db_path) as conn:
+        migrate(conn)
+
+
+if __name__ == "__main__":
+    run_migrations()
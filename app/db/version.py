@@ -0,0 +1,43 @@
+import duckdb
+
+dataset_version_table_name = 'dataset_version'
+# bumps made by this process, the caches that dont read the version on every lookup check it to see them at once
+_local_bumps = 0
+
+
+def ensure_dataset_version_table(conn: duckdb.DuckDBPyConnection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {dataset_version_table_name} (
+            version BIGINT,
+            updated_at TIMESTAMP
+        );
+    """)
+    conn.execute(f"""
+        INSERT INTO {dataset_version_table_name}
+        SELECT 1, now()
+        WHERE NOT EXISTS (SELECT 1 FROM {dataset_version_table_name})
+    """)
+
+
+def get_dataset_version(conn: duckdb.DuckDBPyConnection) -> int:
+    try:
+        row = conn.execute(f"SELECT max(version) FROM {dataset_version_table_name}").fetchone()
+    except duckdb.CatalogException:
+        return 0
+    return row[0] or 0
+
+
+def bump_dataset_version(conn: duckdb.DuckDBPyConnection) -> int:
+    """
+    Must be called every time the pipeline rewrites detail or details_embedding,
+    everything cached on top of the dataset is keyed by this number.
+    """
+    global _local_bumps
+    ensure_dataset_version_table(conn)
+    conn.execute(f"UPDATE {dataset_version_table_name} SET version = version + 1, updated_at = now()")
+    _local_bumps += 1
+    return get_dataset_version(conn)
+
+
+def local_bumps() -> int:
+    return _local_bumps
@@ -1,36 +1,405 @@
+import base64
+import functools
+import math
+import time
 from flask import *
-from app.db.setup import get_db
-from app.services.searcher import do_query_search, do_genre_search, do_category_search
+import json
+from app.services.searcher import rank_query_search, fetch_details, select_columns, search_modes, do_batch_query_search, do_genre_search, do_category_search, do_genre_facets, do_category_facets, rank_similar_search, do_index_status
 from flask import Response
+from app.utils.streaming import stream_ndjson, stream_arrow, ndjson_mimetype, arrow_mimetype
+from app.services.query_cache import normalize_query
+from app.services.singleflight import SingleFlight
+from app.services.embedder import query_cache, query_batcher
+from app.utils.metrics import registry, Gauge, per_scrape, span, start_timings, server_timing, request_seconds, errors, prometheus_mimetype
+from app.services.response_cache import response_cache, CachedResponse, make_etag, etag_matches, cache_control, cache_key, normalize_filters
+from app.db.connection import get_cursor
+from app.db.version import get_dataset_version
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
+
+def instrumented(endpoint: str):
+    """
+    Times the view, counts its failures and sends the collected spans in a Server-Timing header.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            timings = start_timings()
+            start = time.perf_counter()
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                errors.inc(endpoint)
+                raise
+            finally:
+                request_seconds.observe(time.perf_counter() - start, endpoint)
+            if response.status_code >= 500:
+                errors.inc(endpoint)
+            if timings:
+                response.headers['Server-Timing'] = server_timing(timings)
+            return response
+        return wrapper
+    return decorator
+
+
+def cached(key_function):
+    """
+    Serves the view from the response cache, keyed by key_function and the dataset version.
+    key_function returns None for requests that must not be cached. Responses get an ETag and
+    a Cache-Control header, a matching If-None-Match gets a 304 without the body.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = key_function(*args, **kwargs) if response_cache.enabled else None
+            if key is None:
+                return view(*args, **kwargs)
+            with span('cache'):
+                version = get_dataset_version(get_cursor())
+                entry = response_cache.get(version, key)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                # errors and streamed bodies are never stored
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                entry = CachedResponse(
+                    body, response.mimetype, make_etag(body),
+                    {header: response.headers[header] for header in ('X-Next-Cursor',) if header in response.headers}
+                )
+                response_cache.put(version, key, entry)
+            if etag_matches(request.headers.get('If-None-Match'), entry.etag):
+                response_cache.mark_not_modified()
+                response = Response(status=304)
+            else:
+                response = Response(entry.body, mimetype=entry.mimetype)
+            response.headers.update(entry.headers)
+            response.headers['ETag'] = entry.etag
+            response.headers['Cache-Control'] = cache_control()
+            return response
+        return wrapper
+    return decorator
+
+
+def query_string_key(*args, **kwargs) -> str:
+    return cache_key(request.path, sorted(request.args.items(multi=True)))
+
+
 @api_bp.route("/get_categories", methods=['GET'])
+@instrumented('get_categories')
+@cached(query_string_key)
 def get_categories():
+    if request.args.get('with_counts', 'false').lower() == 'true':
+        return jsonify(do_category_facets()), 200
     return jsonify(do_category_search()), 200
 
 @api_bp.route("/get_genres", methods=['GET'])
+@instrumented('get_genres')
+@cached(query_string_key)
 def get_genres():
+    if request.args.get('with_counts', 'false').lower() == 'true':
+        return jsonify(do_genre_facets()), 200
     return jsonify(do_genre_search()), 200
 
+search_batch_max = 1000
+search_max_k = 100
+search_formats = ('json', 'ndjson', 'arrow')
+search_flight = SingleFlight()
+registry.register(Gauge(
+    'query_embedding_cache_hit_ratio', 'Share of query embeddings served by the memory or the persistent cache.',
+    lambda: {(): query_cache.stats()['hit_ratio']}
+))
+registry.register(Gauge(
+    'query_embedding_cache_lookups', 'Query embedding cache lookups by result.',
+    lambda: {(result,): query_cache.stats()[key] for result, key in (('hit', 'hits'), ('persistent_hit', 'persistent_hits'), ('miss', 'misses'))},
+    ('result',)
+))
+registry.register(Gauge(
+    'search_coalesced', 'Searches that waited for an identical in-flight search instead of running.',
+    lambda: {(): search_flight.coalesced}
+))
+# the three index gauges read the same statuses, which cost a few queries
+index_statuses = per_scrape(do_index_status)
+registry.register(Gauge(
+    'hnsw_index_recall', 'Last measured recall@k of each HNSW index.',
+    lambda: {(status['index_name'],): status['recall'] for status in index_statuses() if status.get('recall') is not None},
+    ('index',)
+))
+registry.register(Gauge(
+    'hnsw_index_dead_ratio', 'Deleted rows still in each HNSW index, as a share of the table rows.',
+    lambda: {(status['index_name'],): status['dead_ratio'] for status in index_statuses() if 'dead_ratio' in status},
+    ('index',)
+))
+registry.register(Gauge(
+    'hnsw_index_degraded', '1 when an HNSW index is missing or degraded.',
+    lambda: {(status['index_name'],): int(status['state'] in ('missing', 'degraded')) for status in index_statuses()},
+    ('index',)
+))
+registry.register(Gauge(
+    'response_cache_hit_ratio', 'Share of cacheable responses served from the response cache.',
+    lambda: {(): response_cache.stats()['hit_ratio']}
+))
+registry.register(Gauge(
+    'response_cache_lookups', 'Response cache lookups by result, not_modified counts the 304s.',
+    lambda: {(result,): response_cache.stats()[result] for result in ('hits', 'misses', 'not_modified')},
+    ('result',)
+))
+registry.register(Gauge(
+    'response_cache_bytes', 'Size of the bodies held by the response cache.',
+    lambda: {(): response_cache.stats()['bytes']}
+))
+if query_batcher:
+    registry.register(Gauge(
+        'query_embedding_average_batch_size', 'Average number of queries per micro-batched embedding request.',
+        lambda: {(): query_batcher.stats()['average_batch_size']}
+    ))
+
+
+def encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode()
+
+
+def decode_cursor(cursor: str | None) -> int:
+    if not cursor:
+        return 0
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))['offset']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Invalid cursor.')
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError('Invalid cursor.')
+    return offset
+
+
+def parse_search(data: dict) -> dict:
+    return {
+        'query': data.get('query'),
+        'category': data.get('category', None) or None,
+        'genre': data.get('genre', None) or None,
+        'price_start': data.get('price_start', 0.0),
+        'price_end': data.get('price_end', 1000000.0),
+        'mode': data.get('mode', 'semantic'),
+        'lexical_weight': data.get('lexical_weight', None),
+    }
+
+def check_search_args(search_args: dict) -> str | None:
+    """
+    Checks the types of a parsed search and turns the prices into floats, returns an error message or None.
+    """
+    if not isinstance(search_args['query'], str):
+        return 'query must be a string.'
+    for name in ('price_start', 'price_end'):
+        price = search_args[name]
+        try:
+            # bools are ints in python, but true is not a price
+            if isinstance(price, bool):
+                raise TypeError
+            search_args[name] = float(price)
+        except (ValueError, TypeError):
+            return f'{name} must be a number.'
+        if not math.isfinite(search_args[name]):
+            return f'{name} must be a number.'
+    for name in ('genre', 'category'):
+        if not is_string_list(search_args[name]):
+            return f'{name} must be a list of strings.'
+    return None
+
+def is_string_list(value) -> bool:
+    return value is None or (isinstance(value, list) and all(isinstance(item, str) for item in value))
+
+def validate_search(data: dict) -> tuple[dict | None, str | None]:
+    """
+    Parses a /api/search body, returns the parsed request or an error message.
+    Shared by the flask view and the async server.
+    """
+    if not isinstance(data, dict):
+        return None, 'A JSON object body is required.'
+    search_args = parse_search(data)
+    if not search_args['query']:
+        return None, 'Query parameter is required.'
+    error = check_search_args(search_args)
+    if error:
+        return None, error
+    fields = data.get('fields') or None
+    if not is_string_list(fields):
+        return None, 'fields must be a list of strings.'
+    try:
+        k = int(data.get('k', 20))
+        offset = decode_cursor(data.get('cursor'))
+        select_columns(fields)
+    except (ValueError, TypeError) as e:
+        return None, str(e)
+    if not 1 <= k <= search_max_k:
+        return None, f'k must be between 1 and {search_max_k}.'
+    if search_args['mode'] not in search_modes:
+        return None, f'mode must be one of {", ".join(search_modes)}.'
+    lexical_weight = search_args['lexical_weight']
+    if lexical_weight is not None and (not isinstance(lexical_weight, (int, float)) or not 0 <= lexical_weight <= 1):
+        return None, 'lexical_weight must be a number between 0 and 1.'
+    response_format = data.get('format', 'json')
+    if response_format not in search_formats:
+        return None, f'format must be one of {", ".join(search_formats)}.'
+    return {
+        'search': search_args,
+        'k': k,
+        'offset': offset,
+        'fields': fields,
+        'format': response_format,
+    }, None
+
+# every query of a batch is a semantic search with the k of the batch, so these are rejected rather than ignored
+batch_item_options = ('k', 'cursor', 'fields', 'format', 'lexical_weight')
+
+def validate_batch(data: dict) -> tuple[dict | None, str | None]:
+    """
+    Parses a /api/search/batch body, returns the parsed searches and k or an error message naming the query.
+    """
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries:
+        return None, 'A non empty queries list is required.'
+    if len(queries) > search_batch_max:
+        return None, f'At most {search_batch_max} queries are allowed per batch.'
+    try:
+        k = int(data.get('k', 20))
+    except (ValueError, TypeError) as e:
+        return None, str(e)
+    if not 1 <= k <= search_max_k:
+        return None, f'k must be between 1 and {search_max_k}.'
+    searches = []
+    for index, item in enumerate(queries):
+        if not isinstance(item, dict):
+            return None, f'queries[{index}] must be a JSON object.'
+        search_args = parse_search(item)
+        if not search_args['query']:
+            return None, f'queries[{index}]: Query parameter is required.'
+        error = check_search_args(search_args)
+        if error:
+            return None, f'queries[{index}]: {error}'
+        if search_args['mode'] != 'semantic':
+            return None, f'queries[{index}]: only the semantic mode is supported in a batch.'
+        options = [option for option in batch_item_options if option in item]
+        if options:
+            return None, f'queries[{index}]: {", ".join(options)} cant be set per query, only k for the whole batch.'
+        searches.append(search_args)
+    return {'searches': searches, 'k': k}, None
+
+
+def search_key(search_request: dict) -> str:
+    search_args = dict(search_request['search'], query=normalize_query(search_request['search']['query']))
+    return json.dumps([search_args, search_request['k'], search_request['offset']], sort_keys=True, default=str)
+
+
+def search_cache_key(search_request: dict) -> str | None:
+    # ndjson and arrow responses are streamed, so only json pages are cached
+    if search_request['format'] != 'json':
+        return None
+    search_args = normalize_filters(dict(search_request['search'], query=normalize_query(search_request['search']['query'])))
+    return cache_key('search', search_args, search_request['k'], search_request['offset'], search_request['fields'])
+
+
+def search_request_key(*args, **kwargs) -> str | None:
+    search_request, error = validate_search(request.get_json(silent=True))
+    return None if error else search_cache_key(search_request)
+
+
+def rank_search(search_request: dict) -> list[int]:
+    # identical searches that arrive while one is running share its embedding call and sql execution
+    return search_flight.do(
+        search_key(search_request),
+        lambda: rank_query_search(**search_request['search'], k=search_request['k'], offset=search_request['offset'])
+    )
+
+
 @api_bp.route('/search', methods=['POST'])
+@instrumented('search')
+@cached(search_request_key)
 def search():
     data = request.get_json()
-    print(data)
-    query = data.get('query')
-    category = data.get('category', None)
-    if not category or category == []:
-        category = do_category_search()
-    genre = data.get('genre', None)
-    if not genre or genre == []:
-        genre = do_genre_search()
-    price_start = data.get('price_start', 0.0)
-    price_end = data.get('price_end', 1000000.0)
-    if not query:
+    search_request, error = validate_search(data)
+    if error:
+        return jsonify(
+            {
+                'error': error
+            }
+        ), 400
+
+    ids = rank_search(search_request)
+    result = fetch_details(ids, search_request['fields'])
+    if search_request['format'] == 'ndjson':
+        response = Response(stream_with_context(stream_ndjson(result.fetch_record_batch())), mimetype=ndjson_mimetype)
+    elif search_request['format'] == 'arrow':
+        response = Response(stream_with_context(stream_arrow(result.fetch_record_batch())), mimetype=arrow_mimetype)
+    else:
+        with span('serialize'):
+            body = result.df().to_json(orient="records")
+        response = Response(body, mimetype='application/json')
+    # a full page means there may be more results after it
+    if len(ids) == search_request['k']:
+        response.headers['X-Next-Cursor'] = encode_cursor(search_request['offset'] + search_request['k'])
+    return response
+
+@api_bp.route('/search/batch', methods=['POST'])
+@instrumented('search_batch')
+def search_batch():
+    batch, error = validate_batch(request.get_json(silent=True))
+    if error:
+        return jsonify(
+            {
+                'error': error
+            }
+        ), 400
+    dfs = do_batch_query_search(batch['searches'], batch['k'])
+    return Response(
+        '[' + ','.join(df.to_json(orient="records") for df in dfs) + ']',
+        mimetype='application/json'
+    )
+
+@api_bp.route('/similar/<int:app_id>', methods=['GET'])
+@instrumented('similar')
+@cached(query_string_key)
+def similar(app_id: int):
+    try:
+        k = int(request.args.get('k', 20))
+        price_start = float(request.args.get('price_start', 0.0))
+        price_end = float(request.args.get('price_end', 1000000.0))
+        fields = request.args.get('fields', '').split(',') if request.args.get('fields') else None
+        select_columns(fields)
+    except ValueError as e:
+        return jsonify(
+            {
+                'error': str(e)
+            }
+        ), 400
+    if not 1 <= k <= search_max_k:
         return jsonify(
             {
-                'error': 'Query parameter is required.'
+                'error': f'k must be between 1 and {search_max_k}.'
             }
         ), 400
-    df = do_query_search(query, category=category, genre=genre, price_start=price_start, price_end=price_end)
-    return Response(df.to_json(orient="records"), mimetype='application/json')
+    ids = rank_similar_search(
+        app_id,
+        request.args.getlist('category') or None,
+        request.args.getlist('genre') or None,
+        price_start,
+        price_end,
+        k
+    )
+    if ids is None:
+        return jsonify(
+            {
+                'error': 'Game not found.'
+            }
+        ), 404
+    return Response(fetch_details(ids, fields).df().to_json(orient="records"), mimetype='application/json')
+
+@api_bp.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype=prometheus_mimetype)
+
+@api_bp.route('/index_status', methods=['GET'])
+def index_status():
+    statuses = do_index_status()
+    degraded = any(status['state'] in ('missing', 'degraded') for status in statuses)
+    # 503 lets a health check or load balancer notice a degraded index
+    return jsonify(statuses), 503 if degraded else 200
@@ -0,0 +1,79 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+from app.utils.logger import logger
+
+
+class EmbeddingMicroBatcher:
+    """
+    Collects the queries that arrive within window_ms (or until max_batch of them) and embeds them
+    with a single embed_documents request, every caller gets a future resolved with its own vector.
+    """
+
+    def __init__(self, embed_many: Callable[[list[str]], list[list[float]]], window_ms: float = 5.0,
+                 max_batch: int = 64, max_in_flight: int = 4):
+        self.embed_many = embed_many
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: queue.Queue[tuple[str, Future]] = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='embedding-batch')
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.batched_queries = 0
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect, name='embedding-batcher', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._flush, batch)
+
+    def _flush(self, batch: list[tuple[str, Future]]):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.batched_queries += len(batch)
+        try:
+            vectors = dict(zip(texts, self.embed_many(texts)))
+        except Exception as e:
+            logger.error(f"Embedding batch of {len(texts)} queries failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for text, future in batch:
+            future.set_result(vectors[text])
+
+    def submit(self, text: str) -> Future:
+        self._start()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text: str) -> list[float]:
+        return self.submit(text).result()
+
+    async def aembed(self, text: str) -> list[float]:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'batched_queries': self.batched_queries,
+            'average_batch_size': self.batched_queries / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,124 @@
+import json
+import os
+import duckdb
+from app.db import base_path
+from app.db.version import bump_dataset_version
+from app.utils.logger import logger
+
+table_name = 'detail'
+facet_ids_table_name = 'facet_ids'
+max_bits = 64
+
+# facet -> (list column, bitmask column, file with the fixed vocabulary)
+_facets = {
+    'genre': ('genres', 'genre_mask', 'genres_fix.json'),
+    'category': ('categories', 'category_mask', 'categories_fix.json'),
+}
+mask_columns = {facet: mask_column for facet, (_, mask_column, _) in _facets.items()}
+
+
+def fixed_vocabulary(facet: str) -> list[str]:
+    _, _, file_name = _facets[facet]
+    try:
+        with open(os.path.join(base_path, 'gold', file_name), 'r', encoding='utf-8') as f:
+            fixes = json.load(f)
+    except OSError:
+        return []
+    return sorted({value for fix in fixes for value in fix.values()})
+
+
+def ensure_facet_ids_table(conn: duckdb.DuckDBPyConnection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {facet_ids_table_name} (
+            facet VARCHAR,
+            value VARCHAR,
+            bit INTEGER,
+            PRIMARY KEY (facet, value)
+        );
+    """)
+
+
+def update_facet_ids(conn: duckdb.DuckDBPyConnection):
+    """
+    Gives every genre/category a bit. Existing bits never change, so masks stored anywhere stay valid,
+    new values take the next free bit and the ones past the 64th get none (their filters use the lists).
+    """
+    ensure_facet_ids_table(conn)
+    for facet, (column, _, _) in _facets.items():
+        known = {
+            value: bit for value, bit in conn.execute(
+                f"SELECT value, bit FROM {facet_ids_table_name} WHERE facet = ?", [facet]
+            ).fetchall()
+        }
+        found = {
+            row[0] for row in conn.execute(
+                f"SELECT DISTINCT facet.value FROM {table_name}, UNNEST({column}) AS facet(value) WHERE facet.value IS NOT NULL"
+            ).fetchall()
+        }
+        # the fixed vocabulary comes first, so the bits are the same whatever order the games are loaded in
+        new_values = [value for value in fixed_vocabulary(facet) + sorted(found) if value not in known]
+        next_bit = max((bit for bit in known.values() if bit is not None), default=-1) + 1
+        rows = []
+        for value in dict.fromkeys(new_values):
+            rows.append([facet, value, next_bit if next_bit < max_bits else None])
+            next_bit += 1
+        if next_bit > max_bits:
+            logger.warning(f"{facet} has more than {max_bits} values, filters on the extra ones use the {column} lists.")
+        if rows:
+            conn.executemany(f"INSERT INTO {facet_ids_table_name} VALUES (?, ?, ?)", rows)
+
+
+def rebuild_bitmasks(conn: duckdb.DuckDBPyConnection):
+    # runs before rebuild_facets in generate_gold, which bumps the dataset version
+    update_facet_ids(conn)
+    for facet, (column, mask_column, _) in _facets.items():
+        conn.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {mask_column} UBIGINT")
+        conn.execute(f"""
+            UPDATE {table_name} AS det
+            SET {mask_column} = COALESCE(masks.mask, 0)
+            FROM (
+                SELECT game.id, bit_or(CAST(1 AS UBIGINT) << ids.bit) AS mask
+                FROM {table_name} AS game, UNNEST(game.{column}) AS facet(value)
+                INNER JOIN {facet_ids_table_name} AS ids
+                    ON ids.facet = '{facet}' AND ids.value = facet.value AND ids.bit IS NOT NULL
+                GROUP BY game.id
+            ) AS masks
+            WHERE det.id = masks.id
+        """)
+        conn.execute(f"UPDATE {table_name} SET {mask_column} = 0 WHERE {mask_column} IS NULL")
+
+
+def ensure_bitmasks(conn: duckdb.DuckDBPyConnection):
+    existing_tables = {row[0] for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+    if table_name not in existing_tables:
+        return
+    if not has_bitmasks(conn):
+        rebuild_bitmasks(conn)
+        bump_dataset_version(conn)
+
+
+def has_bitmasks(conn: duckdb.DuckDBPyConnection) -> bool:
+    columns = {
+        row[0] for row in conn.execute(
+            "SELECT column_name FROM duckdb_columns() WHERE table_name = ?", [table_name]
+        ).fetchall()
+    }
+    return all(mask_column in columns for mask_column in mask_columns.values())
+
+
+def facet_mask(facet_ids: dict[str, int | None], values: list[str]) -> tuple[int, list[str]]:
+    """
+    OR of the bits of the values, plus the values that dont have a bit.
+    Values missing from the dictionary are on no game, so they are dropped.
+    """
+    mask = 0
+    unmapped = []
+    for value in values:
+        if value not in facet_ids:
+            continue
+        bit = facet_ids[value]
+        if bit is None:
+            unmapped.append(value)
+        else:
+            mask |= 1 << bit
+    return mask, unmapped
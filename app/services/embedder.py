@@ -1,80 +1,64 @@
 import os
 import duckdb
-from langchain_openai import OpenAIEmbeddings
 from dotenv import load_dotenv
 from app.db import db_path
-from app.db.setup import engine
-print(db_path)
+from app.db.version import bump_dataset_version
+from app.services.query_cache import QueryEmbeddingCache
+from app.services.embedding_backends import get_embedding_backend, get_embeddings_table_name
+from app.services.batcher import EmbeddingMicroBatcher
+from app.services.index_manager import measure_recall, rebuild_indexes
 
-engine.dispose()
 load_dotenv()
-embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+embeddings = get_embedding_backend()
 table_name = 'detail'
-embeddings_table_name = 'details_embedding'
-model_size = 1536
-with duckdb.connect(db_path) as conn:
-    #conn.execute(f"DROP TABLE IF EXISTS {embeddings_table_name};")
-    conn.execute(f"""
-        CREATE TABLE IF NOT EXISTS {embeddings_table_name} (
-            id VARCHAR,
-            name VARCHAR,
-            text TEXT,
-            embedding FLOAT[{model_size}]
-        );
-    """)
-    conn.execute("INSTALL vss;")
-    conn.execute("LOAD vss;")
-    conn.execute("SET hnsw_enable_experimental_persistence = true;")
-    conn.execute(f"""
-    CREATE INDEX IF NOT EXISTS description_index ON {embeddings_table_name} USING HNSW (embedding)
-    """)
+embeddings_table_name = get_embeddings_table_name(embeddings)
+embeddings_index_name = 'description_index' if embeddings_table_name == 'details_embedding' else f'{embeddings_table_name}_index'
+model_size = embeddings.dimension
+query_cache = QueryEmbeddingCache(
+    model=embeddings.identity,
+    max_size=int(os.getenv('QUERY_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('QUERY_CACHE_TTL', 3600)),
+    persistent=os.getenv('QUERY_CACHE_PERSISTENT', 'true').lower() == 'true',
+    flush_size=int(os.getenv('QUERY_CACHE_FLUSH_SIZE', 32)),
+    flush_seconds=float(os.getenv('QUERY_CACHE_FLUSH_SECONDS', 5)),
+)
+# queries arriving within the window are embedded together, 0 disables the batching
+batch_window_ms = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', 0))
+query_batcher = EmbeddingMicroBatcher(
+    embeddings.embed_documents,
+    window_ms=batch_window_ms,
+    max_batch=int(os.getenv('EMBEDDING_BATCH_MAX_SIZE', 64)),
+) if batch_window_ms > 0 else None
 
-def process_and_embed_in_batches(batch_size: int):
-    batch_num = 1
-    while True:
-        with duckdb.connect(db_path) as conn:
-            conn.execute("LOAD vss;")
-            conn.execute("SET hnsw_enable_experimental_persistence = true;")
-            df = conn.execute(
-                f"""
-            SELECT
-                id,
-                name,
-                SUBSTR(
-                    CONCAT(
-                        short_description,
-                        '\\n\\n',
-                        detailed_description,
-                        '\\n\\n',
-                        about_the_game
-                    ),
-                    1,
-                    60000
-                ) AS text
-            FROM {table_name}
-            WHERE CAST(id AS VARCHAR) NOT IN (
-                SELECT id FROM {embeddings_table_name}
-            )
-            LIMIT {batch_size}
-                """
-            ).df()
 
-            if df.empty:
-                print("Não há mais registros novos para processar. O processo foi concluído.")
-                break
+def embed_query_cached(query: str) -> list[float]:
+    return query_cache.get_or_embed(query, query_batcher.embed if query_batcher else embeddings.embed_query)
 
-            print(f"Processando lote {batch_num} com {len(df)} registros.")
-        #make this way so it have less chance to disrupt the connection
-        df['embedding'] = embeddings.embed_documents(df['text'].tolist(), chunk_size=430)
-        df = df[['id', 'name', 'text', 'embedding']]
-        with duckdb.connect(db_path) as conn:
-            conn.execute("LOAD vss;")
-            conn.execute("SET hnsw_enable_experimental_persistence = true;")
-            conn.execute(f"INSERT INTO {embeddings_table_name} SELECT * FROM df;")
-            print(f"Lote {batch_num} inserido com sucesso.")
-            batch_num += 1
+async def aembed_query_cached(query: str) -> list[float]:
+    return await query_cache.aget_or_embed(query, query_batcher.aembed if query_batcher else embeddings.aembed_query)
+
+def embed_queries_cached(queries: list[str]) -> list[list[float]]:
+    return query_cache.get_or_embed_many(queries, embeddings.embed_documents)
+
+def process_and_embed_in_batches(batch_size: int) -> dict:
+    # the job loads pyarrow, which the search path doesnt need
+    from app.services.embedding_job import run_embedding_job
+    with duckdb.connect(db_path) as conn:
+        conn.execute("LOAD vss;")
+        conn.execute("SET hnsw_enable_experimental_persistence = true;")
+        return run_embedding_job(conn, embeddings, table_name, embeddings_table_name, batch_size=batch_size)
 
 if __name__ == "__main__":
-    print("Iniciando o processamento e a incorporação dos dados em lotes...")
-    process_and_embed_in_batches(batch_size=1000)
+    from app.db.migrations import run_migrations
+    run_migrations()
+    from app.services.embedding_job import job_batch_size
+    process_and_embed_in_batches(batch_size=job_batch_size)
+    from app.services.similar import refresh_neighbors
+    with duckdb.connect(db_path) as conn:
+        # the row by row inserts leave a worse graph than a bulk build, and the deletes and the short vector
+        # updates leave tombstones in every index of the table, not only the full vector one
+        for index_name in rebuild_indexes(conn, embeddings_table_name):
+            measure_recall(conn, index_name)
+        refresh_neighbors(conn, embeddings_table_name)
+        bump_dataset_version(conn)
 
@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+import re
+import numpy as np
+from app.utils.logger import logger
+
+# about 4 characters per token for english text, used by backends without a tokenizer
+chars_per_token = 4
+
+
+class EmbeddingBackend:
+    """
+    Interface shared by every embedding provider, it mirrors the langchain Embeddings methods used by the app.
+    """
+    name = 'base'
+    model = ''
+    dimension = 0
+    # provider limits, the bulk embedding job packs and splits its requests with them
+    max_input_tokens = 8191
+    max_request_tokens = 300000
+    max_batch_size = 2048
+
+    def embed_documents(self, texts: list[str], chunk_size: int | None = None) -> list[list[float]]:
+        raise NotImplementedError
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str], chunk_size: int | None = None) -> list[list[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts, chunk_size)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def count_tokens(self, text: str) -> int:
+        return len(text) // chars_per_token + 1
+
+    def split_tokens(self, text: str, max_tokens: int) -> list[tuple[str, int]]:
+        """
+        Splits a text in pieces of at most max_tokens tokens, returns every piece with its token count.
+        """
+        size = max(max_tokens - 1, 1) * chars_per_token
+        pieces = [text[start:start + size] for start in range(0, len(text), size)] or ['']
+        return [(piece, self.count_tokens(piece)) for piece in pieces]
+
+    @property
+    def identity(self) -> str:
+        # model must already tell apart vectors of different sizes, it keys caches and table names
+        return f"{self.name}/{self.model}"
+
+    @property
+    def table_suffix(self) -> str:
+        return re.sub(r'[^a-z0-9]+', '_', self.identity.lower()).strip('_')
+
+
+class OpenAIBackend(EmbeddingBackend):
+    name = 'openai'
+    dimensions = {
+        'text-embedding-3-small': 1536,
+        'text-embedding-3-large': 3072,
+        'text-embedding-ada-002': 1536,
+    }
+
+    def __init__(self, model: str = 'text-embedding-3-small', dimension: int | None = None):
+        self.model = f"{model}-{dimension}" if dimension else model
+        self.dimension = dimension or self.dimensions.get(model, 1536)
+        self._model_name = model
+        self._client = None
+        self._encoding = None
+
+    @property
+    def client(self):
+        # langchain_openai takes seconds to import, so it is only loaded by the first embedding
+        if self._client is None:
+            from langchain_openai import OpenAIEmbeddings
+            kwargs = {'dimensions': self.dimension} if self.model != self._model_name else {}
+            self._client = OpenAIEmbeddings(model=self._model_name, **kwargs)
+        return self._client
+
+    @property
+    def encoding(self):
+        # tiktoken downloads its vocabulary on first use, without it tokens are estimated from the length
+        if self._encoding is None:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.encoding_for_model(self._model_name)
+            except Exception as e:
+                logger.warning(f"Could not load the tiktoken encoding of {self._model_name}, estimating tokens instead: {e}")
+                self._encoding = False
+        return self._encoding
+
+    def count_tokens(self, text: str) -> int:
+        if not self.encoding:
+            return super().count_tokens(text)
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def split_tokens(self, text: str, max_tokens: int) -> list[tuple[str, int]]:
+        if not self.encoding:
+            return super().split_tokens(text, max_tokens)
+        tokens = self.encoding.encode(text, disallowed_special=())
+        pieces = [tokens[start:start + max_tokens] for start in range(0, len(tokens), max_tokens)] or [[]]
+        return [(self.encoding.decode(piece), len(piece)) for piece in pieces]
+
+    def embed_documents(self, texts: list[str], chunk_size: int | None = None) -> list[list[float]]:
+        return self.client.embed_documents(texts, chunk_size=chunk_size)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.client.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str], chunk_size: int | None = None) -> list[list[float]]:
+        return await self.client.aembed_documents(texts, chunk_size=chunk_size)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.client.aembed_query(text)
+
+
+class LocalBackend(EmbeddingBackend):
+    """
+    sentence-transformers model loaded from a local path, runs on CPU without any network access.
+    runtime can be torch or onnx.
+    """
+    name = 'local'
+
+    def __init__(self, path: str, runtime: str = 'torch', device: str = 'cpu', dimension: int | None = None):
+        # only checked here, importing it loads torch
+        if importlib.util.find_spec('sentence_transformers') is None:
+            raise ImportError("The local embedding backend requires sentence-transformers, install it with pip install sentence-transformers.")
+        self.model = os.path.basename(os.path.normpath(path))
+        self.path = path
+        self.runtime = runtime
+        self.device = device
+        self._dimension = dimension
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from sentence_transformers import SentenceTransformer
+            self._client = SentenceTransformer(self.path, device=self.device, backend=self.runtime, local_files_only=True)
+        return self._client
+
+    @property
+    def max_input_tokens(self) -> int:
+        # longer inputs are truncated by the model, the bulk job splits them instead
+        return self.client.max_seq_length
+
+    @property
+    def dimension(self) -> int:
+        # with EMBEDDING_DIMENSIONS set the model isnt loaded until the first embedding
+        if self._dimension is None:
+            self._dimension = self.client.get_sentence_embedding_dimension()
+        return self._dimension
+
+    def embed_documents(self, texts: list[str], chunk_size: int | None = None) -> list[list[float]]:
+        vectors = self.client.encode(texts, batch_size=chunk_size or 32, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.astype(np.float32).tolist()
+
+
+class HashingBackend(EmbeddingBackend):
+    """
+    Deterministic feature hashing of word unigrams and bigrams, used by tests and benchmarks.
+    """
+    name = 'hashing'
+
+    def __init__(self, dimension: int = 256):
+        self.model = str(dimension)
+        self.dimension = dimension
+
+    def _embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        words = re.findall(r'\w+', text.lower())
+        for token in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+            value = int.from_bytes(digest, 'little')
+            vector[value % self.dimension] += 1.0 if value >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[0] = 1.0
+            norm = 1.0
+        return (vector / norm).tolist()
+
+    def embed_documents(self, texts: list[str], chunk_size: int | None = None) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+
+def get_embedding_backend(name: str | None = None) -> EmbeddingBackend:
+    name = name or os.getenv('EMBEDDING_BACKEND', 'openai')
+    dimension = int(os.getenv('EMBEDDING_DIMENSIONS')) if os.getenv('EMBEDDING_DIMENSIONS') else None
+    if name == 'openai':
+        return OpenAIBackend(model=os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small'), dimension=dimension)
+    if name == 'local':
+        path = os.getenv('EMBEDDING_MODEL_PATH')
+        if not path:
+            raise ValueError("EMBEDDING_MODEL_PATH must point to a local model to use the local embedding backend.")
+        return LocalBackend(path, runtime=os.getenv('EMBEDDING_LOCAL_RUNTIME', 'torch'), dimension=dimension)
+    if name == 'hashing':
+        return HashingBackend(dimension=dimension or 256)
+    raise ValueError(f"Unknown embedding backend {name}.")
+
+
+def get_embeddings_table_name(backend: EmbeddingBackend, base_name: str = 'details_embedding') -> str:
+    # the original openai table keeps its name, so existing databases and the kaggle dataset still work
+    if backend.identity == 'openai/text-embedding-3-small':
+        return base_name
+    return f"{base_name}_{backend.table_suffix}"
@@ -0,0 +1,407 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import NamedTuple
+import duckdb
+import numpy as np
+import pyarrow as pa
+from app.db.version import bump_dataset_version
+from app.services.matryoshka import short_vector_dimensions, short_vector_sql, short_column
+from app.services.quantization import quantized_dimensions, fill_quantized
+from app.services.embedding_backends import chars_per_token
+from app.utils.logger import logger
+
+job_runs_table_name = 'embedding_job_runs'
+# most rows per batch, a batch also closes when its estimated tokens fill a request
+job_batch_size = int(os.getenv('EMBEDDING_JOB_BATCH_SIZE', 1000))
+job_concurrency = int(os.getenv('EMBEDDING_JOB_CONCURRENCY', 4))
+# provider budget, 0 disables the limit
+job_requests_per_minute = int(os.getenv('EMBEDDING_JOB_RPM', 3000))
+job_tokens_per_minute = int(os.getenv('EMBEDDING_JOB_TPM', 1000000))
+# 0 uses the limit of the provider
+job_max_request_tokens = int(os.getenv('EMBEDDING_JOB_MAX_REQUEST_TOKENS', 0))
+# longer texts are split in chunks of the provider input limit, the chunks past this one are dropped
+job_max_chunks = int(os.getenv('EMBEDDING_JOB_MAX_CHUNKS', 8))
+
+
+def normalize_sql(text: str) -> str:
+    # whitespace only changes dont change the embedding, so they dont count as a new text
+    return f"trim(regexp_replace(coalesce({text}, ''), '\\s+', ' ', 'g'))"
+
+
+# the fields are normalized one by one, whitespace at the end of a field would otherwise survive next to the separator
+document_sql = f"""
+    CONCAT(
+        {normalize_sql('short_description')},
+        '\\n\\n',
+        {normalize_sql('detailed_description')},
+        '\\n\\n',
+        {normalize_sql('about_the_game')}
+    )
+"""
+
+
+def ensure_job_runs_table(conn: duckdb.DuckDBPyConnection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {job_runs_table_name} (
+            run_id VARCHAR PRIMARY KEY,
+            table_name VARCHAR,
+            model VARCHAR,
+            started_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            pending BIGINT,
+            embedded BIGINT,
+            requests BIGINT,
+            estimated_tokens BIGINT,
+            deduplicated BIGINT DEFAULT 0,
+            saved_tokens BIGINT DEFAULT 0
+        );
+    """)
+    for column in ('deduplicated', 'saved_tokens'):
+        conn.execute(f"ALTER TABLE {job_runs_table_name} ADD COLUMN IF NOT EXISTS {column} BIGINT DEFAULT 0")
+
+
+def ensure_content_hash(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str):
+    """
+    Adds the content_hash column, rows embedded before it existed get the hash of the text they stored,
+    so they are only embedded again if the game text changed since.
+    """
+    conn.execute(f"ALTER TABLE {embeddings_table_name} ADD COLUMN IF NOT EXISTS content_hash VARCHAR")
+    if not stores_text(conn, embeddings_table_name):
+        return
+    conn.execute(f"""
+        UPDATE {embeddings_table_name}
+        SET content_hash = md5({normalize_sql('text')})
+        WHERE content_hash IS NULL
+    """)
+
+
+def stores_text(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str) -> bool:
+    # the text column can be dropped once the hashes exist, see quantization.drop_text
+    return conn.execute(
+        "SELECT COUNT(*) FROM duckdb_columns() WHERE table_name = ? AND column_name = 'text'", [embeddings_table_name]
+    ).fetchone()[0] > 0
+
+
+class RateBudget:
+    """
+    Token buckets of requests and tokens per minute, acquire blocks until both have room.
+    """
+
+    def __init__(self, requests_per_minute: int = job_requests_per_minute, tokens_per_minute: int = job_tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int):
+        while True:
+            with self._lock:
+                self._refill()
+                # a request bigger than the whole budget waits for a full bucket instead of forever
+                tokens_needed = min(tokens, self.tokens_per_minute)
+                has_request = not self.requests_per_minute or self._requests >= 1
+                has_tokens = not self.tokens_per_minute or self._tokens >= tokens_needed
+                if has_request and has_tokens:
+                    if self.requests_per_minute:
+                        self._requests -= 1
+                    if self.tokens_per_minute:
+                        self._tokens -= tokens_needed
+                    return
+                waits = []
+                if not has_request:
+                    waits.append((1 - self._requests) * 60 / self.requests_per_minute)
+                if not has_tokens:
+                    waits.append((tokens_needed - self._tokens) * 60 / self.tokens_per_minute)
+            time.sleep(max(waits))
+
+
+def pending_ids(conn: duckdb.DuckDBPyConnection, table_name: str, embeddings_table_name: str) -> list[tuple[int, int]]:
+    """
+    One snapshot for the whole run of the games without an embedding or whose text hash changed, with their text length.
+    Ordered by hash, so copies of the same text land in the same batch and are embedded once.
+    """
+    return conn.execute(f"""
+        SELECT det.id, det.length
+        FROM (SELECT id, md5({document_sql}) AS content_hash, length({document_sql}) AS length FROM {table_name}) AS det
+        LEFT JOIN {embeddings_table_name} AS emb
+            ON emb.id = CAST(det.id AS VARCHAR)
+        WHERE emb.id IS NULL OR emb.content_hash IS DISTINCT FROM det.content_hash
+        ORDER BY det.content_hash, det.id
+    """).fetchall()
+
+
+def plan_batches(pending: list[tuple[int, int]], batch_size: int, max_tokens: int, max_document_tokens: int) -> list[list[int]]:
+    # token counts are estimated from the length here, the exact split happens when the batch is read
+    batches, batch, batch_tokens = [], [], 0
+    for app_id, length in pending:
+        tokens = min(length // chars_per_token + 1, max_document_tokens)
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(app_id)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def fetch_texts(conn: duckdb.DuckDBPyConnection, table_name: str, ids: list[int]) -> pa.Table:
+    return conn.execute(f"""
+        SELECT id, name, text, md5(text) AS content_hash
+        FROM (
+            SELECT id, name, {document_sql} AS text
+            FROM {table_name}
+            WHERE id IN (SELECT UNNEST(?::BIGINT[]))
+        )
+        ORDER BY content_hash, id
+    """, [ids]).fetch_record_batch().read_all()
+
+
+def stored_vectors(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str, hashes: list[str]) -> dict[str, list[float]]:
+    # texts already embedded for another game reuse its vector
+    return dict(conn.execute(f"""
+        SELECT content_hash, any_value(embedding)
+        FROM {embeddings_table_name}
+        WHERE content_hash IN (SELECT UNNEST(?::VARCHAR[]))
+        GROUP BY content_hash
+    """, [hashes]).fetchall())
+
+
+def _start_run(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str, model: str, pending: int) -> tuple[str, int]:
+    """
+    Resumes the unfinished run of the table if there is one, the rows it already committed
+    are not pending anymore so only its counters carry over.
+    """
+    ensure_job_runs_table(conn)
+    row = conn.execute(f"""
+        SELECT run_id, embedded FROM {job_runs_table_name}
+        WHERE table_name = ? AND model = ? AND finished_at IS NULL
+        ORDER BY started_at DESC
+        LIMIT 1
+    """, [embeddings_table_name, model]).fetchone()
+    if row:
+        logger.info(f"Resuming embedding run {row[0]}, {row[1]} rows were already embedded.")
+        conn.execute(f"UPDATE {job_runs_table_name} SET pending = ?, updated_at = now() WHERE run_id = ?", [pending, row[0]])
+        return row[0], row[1]
+    run_id = uuid.uuid4().hex
+    conn.execute(f"""
+        INSERT INTO {job_runs_table_name}
+            (run_id, table_name, model, started_at, updated_at, pending, embedded, requests, estimated_tokens, deduplicated, saved_tokens)
+        VALUES (?, ?, ?, now(), now(), ?, 0, 0, 0, 0, 0)
+    """, [run_id, embeddings_table_name, model, pending])
+    return run_id, 0
+
+
+class PendingBatch(NamedTuple):
+    rows: pa.Table
+    # hashes sent to the api, every one is split in one or more inputs
+    hashes: list[str]
+    reused: dict[str, list[float]]
+    inputs: list[str]
+    # position in hashes of the text of every input, and its token count
+    owners: list[int]
+    input_tokens: list[int]
+    # slices of inputs sent in one request each
+    requests: list[tuple[int, int]]
+    saved_tokens: int
+    # texts with more than max_chunks chunks, only their first chunks are embedded
+    truncated: int
+
+    @property
+    def tokens(self) -> int:
+        return sum(self.input_tokens)
+
+
+def pack_requests(input_tokens: list[int], max_tokens: int, max_inputs: int) -> list[tuple[int, int]]:
+    requests, start, tokens = [], 0, 0
+    for position, count in enumerate(input_tokens):
+        if position > start and (tokens + count > max_tokens or position - start >= max_inputs):
+            requests.append((start, position))
+            start, tokens = position, 0
+        tokens += count
+    if start < len(input_tokens):
+        requests.append((start, len(input_tokens)))
+    return requests
+
+
+def prepare_batch(conn: duckdb.DuckDBPyConnection, embeddings, table_name: str, embeddings_table_name: str,
+                  ids: list[int], max_request_tokens: int, max_chunks: int = job_max_chunks) -> PendingBatch:
+    rows = fetch_texts(conn, table_name, ids)
+    texts = dict(zip(rows.column('content_hash').to_pylist(), rows.column('text').to_pylist()))
+    reused = stored_vectors(conn, embeddings_table_name, list(texts))
+    hashes = [content_hash for content_hash in texts if content_hash not in reused]
+    inputs, owners, input_tokens = [], [], []
+    text_tokens = {}
+    truncated = 0
+    for position, content_hash in enumerate(hashes):
+        pieces = embeddings.split_tokens(texts[content_hash], embeddings.max_input_tokens)
+        truncated += len(pieces) > max_chunks
+        for piece, tokens in pieces[:max_chunks]:
+            inputs.append(piece)
+            owners.append(position)
+            input_tokens.append(tokens)
+        text_tokens[content_hash] = sum(tokens for _, tokens in pieces[:max_chunks])
+    for content_hash in reused:
+        text_tokens[content_hash] = min(embeddings.count_tokens(texts[content_hash]), max_chunks * embeddings.max_input_tokens)
+    all_tokens = sum(text_tokens[content_hash] for content_hash in rows.column('content_hash').to_pylist())
+    requests = pack_requests(input_tokens, max_request_tokens, embeddings.max_batch_size)
+    return PendingBatch(rows, hashes, reused, inputs, owners, input_tokens, requests, all_tokens - sum(input_tokens), truncated)
+
+
+def aggregate_chunks(vectors: list[list[float]], owners: list[int], weights: list[int], count: int) -> np.ndarray:
+    """
+    One vector per text from the vectors of its chunks: their mean weighted by token count, normalized again.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(owners), -1)
+    totals = np.zeros((count, vectors.shape[1]), dtype=np.float32)
+    np.add.at(totals, np.asarray(owners), vectors * np.asarray(weights, dtype=np.float32)[:, None])
+    norms = np.linalg.norm(totals, axis=1, keepdims=True)
+    return totals / np.maximum(norms, 1e-12)
+
+
+def _insert_batch(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str, batch: PendingBatch,
+                  vectors: list[list[float]], dimension: int, short_dimensions: int | None, int8_dimensions: int | None,
+                  store_text: bool, run_id: str):
+    """
+    Replaces the rows of the batch and records it in the run in the same transaction, so a committed batch is never redone.
+    """
+    by_hash = dict(batch.reused, **dict(zip(batch.hashes, vectors)))
+    row_vectors = [by_hash[content_hash] for content_hash in batch.rows.column('content_hash').to_pylist()]
+    flat = pa.array([value for vector in row_vectors for value in vector], type=pa.float32())
+    embedding_batch = batch.rows.append_column('embedding', pa.FixedSizeListArray.from_arrays(flat, dimension))
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.register('embedding_batch', embedding_batch)
+        # games whose text changed get their new vector, the old one leaves a tombstone in the hnsw index
+        conn.execute(f"DELETE FROM {embeddings_table_name} WHERE id IN (SELECT CAST(id AS VARCHAR) FROM embedding_batch)")
+        text_column = 'text, ' if store_text else ''
+        conn.execute(f"""
+            INSERT INTO {embeddings_table_name} (id, name, {text_column}embedding, content_hash)
+            SELECT CAST(id AS VARCHAR), name, {text_column}embedding, content_hash FROM embedding_batch
+        """)
+        if short_dimensions:
+            # keeps the coarse vectors of the two stage search in sync with the new rows
+            conn.execute(
+                f"UPDATE {embeddings_table_name} SET {short_column} = {short_vector_sql('embedding', short_dimensions)} "
+                f"WHERE {short_column} IS NULL"
+            )
+        if int8_dimensions:
+            # same for the int8 copy scanned by EMBEDDING_QUANTIZATION=int8
+            fill_quantized(conn, embeddings_table_name, int8_dimensions)
+        conn.execute(f"""
+            UPDATE {job_runs_table_name}
+            SET
+                embedded = embedded + ?,
+                requests = requests + ?,
+                estimated_tokens = estimated_tokens + ?,
+                deduplicated = deduplicated + ?,
+                saved_tokens = saved_tokens + ?,
+                updated_at = now()
+            WHERE run_id = ?
+        """, [batch.rows.num_rows, len(batch.requests), batch.tokens, batch.rows.num_rows - len(batch.hashes),
+              batch.saved_tokens, run_id])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.unregister('embedding_batch')
+
+
+def run_embedding_job(conn: duckdb.DuckDBPyConnection, embeddings, table_name: str, embeddings_table_name: str,
+                      batch_size: int = job_batch_size, concurrency: int = job_concurrency,
+                      budget: RateBudget | None = None, max_request_tokens: int = job_max_request_tokens) -> dict:
+    """
+    Embeds every row of table_name missing from embeddings_table_name or whose text changed,
+    every distinct text is sent to the api once.
+    Texts are read and inserted on this thread while up to concurrency batches are embedded in a pool.
+    Batches are packed by tokens up to the request limit, texts over the input limit are split in chunks
+    whose vectors are averaged, and every request is admitted by the rate budget. Returns the counters of the run.
+    """
+    budget = budget or RateBudget()
+    ensure_job_runs_table(conn)
+    ensure_content_hash(conn, embeddings_table_name)
+    max_request_tokens = min(max_request_tokens or embeddings.max_request_tokens, embeddings.max_request_tokens)
+    ids = pending_ids(conn, table_name, embeddings_table_name)
+    run_id, embedded = _start_run(conn, embeddings_table_name, embeddings.identity, len(ids))
+    logger.info(f"{len(ids)} rows to embed into {embeddings_table_name}.")
+    short_dimensions = short_vector_dimensions(conn, embeddings_table_name)
+    int8_dimensions = quantized_dimensions(conn, embeddings_table_name)
+    store_text = stores_text(conn, embeddings_table_name)
+    start = time.perf_counter()
+    embedded_now = 0
+    truncated = 0
+    in_flight: dict[Future, PendingBatch] = {}
+    chunks = deque(plan_batches(ids, batch_size, max_request_tokens, job_max_chunks * embeddings.max_input_tokens))
+
+    def embed(batch: PendingBatch) -> list[list[float]]:
+        if not batch.inputs:
+            return []
+        vectors = []
+        for start, end in batch.requests:
+            budget.acquire(sum(batch.input_tokens[start:end]))
+            vectors.extend(embeddings.embed_documents(batch.inputs[start:end], chunk_size=end - start))
+        if len(batch.inputs) == len(batch.hashes):
+            return vectors
+        return aggregate_chunks(vectors, batch.owners, batch.input_tokens, len(batch.hashes)).tolist()
+
+    error = None
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='embedding-job') as executor:
+        try:
+            while in_flight or (chunks and error is None):
+                # keeps one batch queued behind every running request, so the pool never waits for the database
+                while error is None and chunks and len(in_flight) < concurrency * 2:
+                    batch = prepare_batch(conn, embeddings, table_name, embeddings_table_name, chunks.popleft(), max_request_tokens)
+                    in_flight[executor.submit(embed, batch)] = batch
+                    truncated += batch.truncated
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = in_flight.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    _insert_batch(conn, embeddings_table_name, batch, future.result(), embeddings.dimension,
+                                  short_dimensions, int8_dimensions, store_text, run_id)
+                    embedded += batch.rows.num_rows
+                    embedded_now += batch.rows.num_rows
+                    logger.info(f"Embedded {embedded} rows ({embedded_now / (time.perf_counter() - start):.0f} rows/s).")
+                if error is not None:
+                    # the requests already running are still saved, the queued ones are left for the next run
+                    for future in [future for future in in_flight if future.cancel()]:
+                        del in_flight[future]
+        except BaseException:
+            for future in in_flight:
+                future.cancel()
+            raise
+    if error is not None:
+        logger.error(f"Embedding run {run_id} stopped after {embedded} rows, run it again to resume.")
+        raise error
+    if truncated:
+        logger.warning(f"{truncated} texts had more than {job_max_chunks} chunks, only their first {job_max_chunks} were embedded.")
+    conn.execute(f"UPDATE {job_runs_table_name} SET finished_at = now(), updated_at = now() WHERE run_id = ?", [run_id])
+    if ids:
+        # served responses and caches built on the embeddings are keyed by the dataset version
+        bump_dataset_version(conn)
+    columns = ('run_id', 'pending', 'embedded', 'requests', 'estimated_tokens', 'deduplicated', 'saved_tokens')
+    report = dict(zip(columns, conn.execute(
+        f"SELECT {', '.join(columns)} FROM {job_runs_table_name} WHERE run_id = ?", [run_id]
+    ).fetchone()))
+    logger.info(
+        f"Embedding run {run_id} finished: {report['embedded']} rows, {report['deduplicated']} reused an identical text, "
+        f"about {report['saved_tokens']} tokens saved."
+    )
+    return report
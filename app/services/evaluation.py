@@ -0,0 +1,74 @@
+import argparse
+import json
+import time
+import duckdb
+import numpy as np
+from app.db.connection import get_cursor
+from app.services.embedder import embeddings_table_name
+from app.services.matryoshka import coarse_candidates
+from app.services.quantization import quantized_dimensions, rerank_candidates
+from app.services.searcher import _exact_rank, _hnsw_rank, build_filters, coarse_search_dimensions
+
+
+def recall_at_k(expected: list, found: list, k: int) -> float:
+    expected = expected[:k]
+    if not expected:
+        return 1.0
+    return len(set(expected) & set(found[:k])) / len(expected)
+
+
+def sample_query_vectors(conn: duckdb.DuckDBPyConnection, sample_size: int, seed: int = 42) -> list[list[float]]:
+    """
+    Stored game vectors are used as queries, they follow the same distribution as the catalog.
+    """
+    rows = conn.execute(
+        f"SELECT embedding FROM {embeddings_table_name} USING SAMPLE reservoir({int(sample_size)} ROWS) REPEATABLE ({int(seed)})"
+    ).fetchall()
+    return [list(row[0]) for row in rows]
+
+
+def evaluate_two_stage(conn: duckdb.DuckDBPyConnection, sample_size: int = 200, k: int = 20) -> dict:
+    """
+    Recall@k and latency of the full dimension and the two stage HNSW searches and of the int8 scan
+    against the exact scan of the full vectors.
+    """
+    coarse = coarse_search_dimensions(conn)
+    predicates, params = build_filters(None, None, 0, float('inf'))
+    strategies = {'exact': lambda q: _exact_rank(conn, q, predicates, params, k, 0, quantized=False),
+                  'hnsw': lambda q: _hnsw_rank(conn, q, predicates, params, k, k)}
+    if coarse:
+        strategies['two_stage'] = lambda q: _hnsw_rank(conn, q, predicates, params, k, k, coarse)
+    if quantized_dimensions(conn, embeddings_table_name):
+        strategies['int8_rerank'] = lambda q: _exact_rank(conn, q, predicates, params, k, 0, quantized=True)
+    results = {name: {'recall': [], 'latency_ms': []} for name in strategies}
+    for query_embedding in sample_query_vectors(conn, sample_size):
+        expected = None
+        for name, rank in strategies.items():
+            start = time.perf_counter()
+            ids = rank(query_embedding) or []
+            results[name]['latency_ms'].append((time.perf_counter() - start) * 1000)
+            expected = ids if expected is None else expected
+            results[name]['recall'].append(recall_at_k(expected, ids, k))
+    return {
+        'k': k,
+        'queries': sample_size,
+        'coarse_dimensions': coarse,
+        'coarse_candidates': coarse_candidates,
+        'rerank_candidates': rerank_candidates,
+        **{
+            name: {
+                f'recall@{k}': float(np.mean(result['recall'])) if result['recall'] else None,
+                'p50_ms': float(np.percentile(result['latency_ms'], 50)) if result['latency_ms'] else None,
+                'p95_ms': float(np.percentile(result['latency_ms'], 95)) if result['latency_ms'] else None,
+            }
+            for name, result in results.items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the approximate searches with the exact one.")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(evaluate_two_stage(get_cursor(), args.queries, args.k), indent=2))
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+import duckdb
+from app.db.version import get_dataset_version, bump_dataset_version, local_bumps
+from app.services.bitmasks import facet_ids_table_name, has_bitmasks
+
+table_name = 'detail'
+genre_facets_table_name = 'app_genre_facets'
+category_facets_table_name = 'app_category_facets'
+price_quantiles = 200
+# a search makes several facet lookups, the dataset version is read at most once per this many seconds
+facet_version_ttl = float(os.getenv('FACET_CACHE_VERSION_TTL', 1.0))
+
+_facets = {
+    'genre': (genre_facets_table_name, 'genres'),
+    'category': (category_facets_table_name, 'categories'),
+}
+
+
+def rebuild_facets(conn: duckdb.DuckDBPyConnection, bump_version: bool = True):
+    # duckdb doesnt have materialized views, so the facets are real tables rebuilt after generate_gold
+    for facet, (facet_table_name, column) in _facets.items():
+        conn.execute(f"""
+            CREATE OR REPLACE TABLE {facet_table_name} AS
+            SELECT
+                facet.value AS {facet},
+                COUNT(DISTINCT det.id) AS game_count
+            FROM {table_name} AS det,
+                 UNNEST(det.{column}) AS facet(value)
+            WHERE facet.value IS NOT NULL
+            GROUP BY facet.value
+            ORDER BY game_count DESC, {facet}
+        """)
+    if bump_version:
+        bump_dataset_version(conn)
+
+
+def ensure_facets(conn: duckdb.DuckDBPyConnection):
+    existing = {
+        row[0] for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()
+    }
+    if table_name not in existing:
+        return
+    if not all(facet_table_name in existing for facet_table_name, _ in _facets.values()):
+        rebuild_facets(conn)
+
+
+class FacetCache:
+    """
+    In-process copy of the facet tables, reloaded only when the dataset version changes.
+    The version is checked every version_ttl seconds, so a new version written by another process
+    is seen within that time, and one written by this process at once.
+    """
+
+    def __init__(self, version_ttl: float = facet_version_ttl):
+        self.version_ttl = version_ttl
+        self._version = None
+        self._checked_at = 0.0
+        self._checked_bumps = None
+        self._facets: dict = {}
+        self._lock = threading.Lock()
+
+    def _current_version(self, conn: duckdb.DuckDBPyConnection) -> int:
+        now = time.monotonic()
+        bumps = local_bumps()
+        if self._version is not None and bumps == self._checked_bumps and now - self._checked_at < self.version_ttl:
+            return self._version
+        self._checked_at, self._checked_bumps = now, bumps
+        return get_dataset_version(conn)
+
+    def _cached(self, conn: duckdb.DuckDBPyConnection, key: str, loader):
+        with self._lock:
+            version = self._current_version(conn)
+            if version != self._version:
+                self._facets = {}
+                self._version = version
+            if key not in self._facets:
+                self._facets[key] = loader(conn)
+            return self._facets[key]
+
+    def get(self, conn: duckdb.DuckDBPyConnection, facet: str) -> list[dict]:
+        facet_table_name, _ = _facets[facet]
+
+        def load(conn):
+            rows = conn.execute(
+                f"SELECT {facet}, game_count FROM {facet_table_name} ORDER BY game_count DESC, {facet}"
+            ).fetchall()
+            return [{facet: value, 'game_count': count} for value, count in rows]
+
+        return self._cached(conn, facet, load)
+
+    def ids(self, conn: duckdb.DuckDBPyConnection, facet: str) -> dict[str, int | None] | None:
+        """
+        Bit of every genre/category, None when the bitmask columns werent built yet.
+        """
+        def load(conn):
+            if not has_bitmasks(conn):
+                return None
+            rows = conn.execute(
+                f"SELECT value, bit FROM {facet_ids_table_name} WHERE facet = ?", [facet]
+            ).fetchall()
+            return dict(rows)
+
+        return self._cached(conn, f'ids:{facet}', load)
+
+    def stats(self, conn: duckdb.DuckDBPyConnection) -> dict:
+        def load(conn):
+            total, priced = conn.execute(f"SELECT COUNT(*), COUNT(price) FROM {table_name}").fetchone()
+            quantiles = conn.execute(
+                f"SELECT quantile_disc(price, [{', '.join(str(i / price_quantiles) for i in range(price_quantiles + 1))}]) FROM {table_name}"
+            ).fetchone()[0]
+            return {'total': total, 'priced': priced, 'price_quantiles': quantiles or []}
+
+        return self._cached(conn, 'stats', load)
+
+    def row_count(self, conn: duckdb.DuckDBPyConnection, table: str) -> int:
+        # the tables only change with the dataset version, so they are counted once per version
+        return self._cached(conn, f'rows:{table}', lambda conn: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0])
+
+    def has_table(self, conn: duckdb.DuckDBPyConnection, table: str) -> bool:
+        # tables are only added by a migration or a generate_gold, which both bump the dataset version
+        return self._cached(
+            conn, f'table:{table}',
+            lambda conn: conn.execute("SELECT 1 FROM duckdb_tables() WHERE table_name = ?", [table]).fetchone() is not None
+        )
+
+
+facet_cache = FacetCache()
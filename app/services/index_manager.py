@@ -0,0 +1,269 @@
+import os
+import time
+from contextlib import contextmanager
+import duckdb
+import numpy as np
+from app.db.connection import hnsw_scan
+from app.utils.logger import logger
+
+index_status_table_name = 'hnsw_index_status'
+hnsw_m = int(os.getenv('HNSW_M', 16))
+hnsw_ef_construction = int(os.getenv('HNSW_EF_CONSTRUCTION', 128))
+hnsw_metric = os.getenv('HNSW_METRIC', 'l2sq')
+# below this recall, or with more deleted entries than this share of the rows, the index is reported as degraded
+hnsw_min_recall = float(os.getenv('HNSW_MIN_RECALL', 0.9))
+hnsw_max_dead_ratio = float(os.getenv('HNSW_MAX_DEAD_RATIO', 0.2))
+
+# the index is only used when the query orders by the distance function of its metric
+distance_functions = {
+    'l2sq': 'array_distance',
+    'cosine': 'array_cosine_distance',
+    'ip': 'array_negative_inner_product',
+}
+if hnsw_metric not in distance_functions:
+    raise ValueError(f"Unknown HNSW metric {hnsw_metric}, use one of {', '.join(distance_functions)}.")
+distance_function = distance_functions[hnsw_metric]
+
+
+def ensure_index_status_table(conn: duckdb.DuckDBPyConnection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {index_status_table_name} (
+            index_name VARCHAR PRIMARY KEY,
+            table_name VARCHAR,
+            column_name VARCHAR,
+            metric VARCHAR,
+            m INTEGER,
+            ef_construction INTEGER,
+            built_at TIMESTAMP,
+            build_seconds DOUBLE,
+            ef_search INTEGER,
+            recall DOUBLE,
+            recall_k INTEGER,
+            checked_at TIMESTAMP
+        );
+    """)
+
+
+def build_index(conn: duckdb.DuckDBPyConnection, table_name: str, index_name: str, column: str = 'embedding',
+                m: int = hnsw_m, ef_construction: int = hnsw_ef_construction, metric: str = hnsw_metric):
+    """
+    Drops and rebuilds the index in one pass, which gives a better graph than the row by row
+    inserts it gets while the embeddings are loaded.
+    """
+    if metric != hnsw_metric:
+        logger.warning(f"Building {index_name} with metric {metric}, searches use {hnsw_metric} and will not use it.")
+    ensure_index_status_table(conn)
+    conn.execute("LOAD vss;")
+    conn.execute("SET hnsw_enable_experimental_persistence = true;")
+    start = time.perf_counter()
+    conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+    conn.execute(f"""
+        CREATE INDEX {index_name} ON {table_name} USING HNSW ({column})
+        WITH (metric = '{metric}', M = {int(m)}, ef_construction = {int(ef_construction)})
+    """)
+    build_seconds = time.perf_counter() - start
+    conn.execute(f"""
+        INSERT OR REPLACE INTO {index_status_table_name}
+            (index_name, table_name, column_name, metric, m, ef_construction, built_at, build_seconds)
+        VALUES (?, ?, ?, ?, ?, ?, now(), ?)
+    """, [index_name, table_name, column, metric, m, ef_construction, build_seconds])
+    logger.info(f"Built {index_name} (M={m}, ef_construction={ef_construction}, metric={metric}) in {build_seconds:.1f}s.")
+
+
+def compact_index(conn: duckdb.DuckDBPyConnection, index_name: str):
+    # updated and deleted rows stay in the graph as tombstones until the index is compacted
+    conn.execute("LOAD vss;")
+    conn.execute(f"PRAGMA hnsw_compact_index('{index_name}')")
+    logger.info(f"Compacted {index_name}.")
+
+
+def index_parameters(conn: duckdb.DuckDBPyConnection, index_name: str) -> dict:
+    """
+    M, ef_construction and metric an existing index was built with, so rebuilding it keeps a tuning done with
+    `build --m/--ef-construction/--metric`. The metric is read from the index, M and ef_construction from the
+    status table, the env defaults stand in for indexes build_index never recorded (the migration builds them with those).
+    """
+    parameters = {'m': hnsw_m, 'ef_construction': hnsw_ef_construction, 'metric': hnsw_metric}
+    conn.execute("LOAD vss;")
+    row = conn.execute("SELECT metric FROM pragma_hnsw_index_info() WHERE index_name = ?", [index_name]).fetchone()
+    if row:
+        parameters['metric'] = row[0]
+    if conn.execute("SELECT 1 FROM duckdb_tables() WHERE table_name = ?", [index_status_table_name]).fetchone():
+        stored = conn.execute(
+            f"SELECT m, ef_construction FROM {index_status_table_name} WHERE index_name = ?", [index_name]
+        ).fetchone()
+        if stored and stored[0] is not None and stored[1] is not None:
+            parameters['m'], parameters['ef_construction'] = stored
+    return parameters
+
+
+def hnsw_indexes(conn: duckdb.DuckDBPyConnection, table_name: str) -> list[tuple[str, str, dict]]:
+    """
+    Name, column and build parameters of every hnsw index of the table.
+    """
+    conn.execute("LOAD vss;")
+    indexes = conn.execute(
+        "SELECT index_name, trim(expressions, '[]') FROM duckdb_indexes() WHERE table_name = ? AND sql ILIKE '%USING HNSW%'",
+        [table_name]
+    ).fetchall()
+    return [(index_name, column, index_parameters(conn, index_name)) for index_name, column in indexes]
+
+
+def rebuild_indexes(conn: duckdb.DuckDBPyConnection, table_name: str) -> list[str]:
+    """
+    Builds every hnsw index of the table again with its own parameters, which drops the tombstones the
+    deletes and updates of an embedding run leave in all of them. Returns the index names.
+    """
+    indexes = hnsw_indexes(conn, table_name)
+    for index_name, column, parameters in indexes:
+        build_index(conn, table_name, index_name, column, **parameters)
+    return [index_name for index_name, _, _ in indexes]
+
+
+@contextmanager
+def hnsw_indexes_dropped(conn: duckdb.DuckDBPyConnection, table_name: str):
+    """
+    Drops the hnsw indexes of the table while the block runs and builds them again after, with the parameters
+    they had. An UPDATE adds a new graph entry for every row it touches and leaves the old one as a tombstone,
+    so a bulk update of any column would double the index.
+    """
+    indexes = hnsw_indexes(conn, table_name)
+    for index_name, _, _ in indexes:
+        conn.execute(f"DROP INDEX {index_name}")
+    try:
+        yield
+    finally:
+        for index_name, column, parameters in indexes:
+            build_index(conn, table_name, index_name, column, **parameters)
+
+
+def measure_recall(conn: duckdb.DuckDBPyConnection, index_name: str, sample_size: int = 100, k: int = 20,
+                   ef_search: int | None = None, seed: int = 42) -> float:
+    """
+    Recall@k of the index against a brute force scan, the queries are stored vectors with some noise
+    added, so they are not in the index themselves.
+    """
+    ensure_index_status_table(conn)
+    table_name, column = conn.execute(
+        "SELECT table_name, trim(expressions, '[]') FROM duckdb_indexes() WHERE index_name = ?", [index_name]
+    ).fetchone()
+    dimension = conn.execute(f"SELECT max(len({column})) FROM {table_name}").fetchone()[0]
+    conn.execute("LOAD vss;")
+    if ef_search:
+        conn.execute(f"SET hnsw_ef_search = {int(ef_search)};")
+    # None means the extension default
+    ef_search = conn.execute("SELECT value FROM duckdb_settings() WHERE name = 'hnsw_ef_search'").fetchone()[0]
+    rng = np.random.default_rng(seed)
+    rows = conn.execute(
+        f"SELECT {column} FROM {table_name} WHERE {column} IS NOT NULL "
+        f"USING SAMPLE reservoir({int(sample_size)} ROWS) REPEATABLE ({int(seed)})"
+    ).fetchall()
+    recalls = []
+    for (vector,) in rows:
+        query = np.asarray(vector, dtype=np.float32)
+        query = query + rng.normal(0, 0.1 * np.abs(query).mean(), len(query)).astype(np.float32)
+        norm = np.linalg.norm(query)
+        # a zero vector (a truncated one can be) has no direction, normalizing it gives NaNs that break the index scan
+        if not norm:
+            continue
+        query = (query / norm).tolist()
+        distance = f"{distance_function}({column}, ?::FLOAT[{dimension}])"
+        with hnsw_scan():
+            approximate = conn.execute(
+                f"SELECT id FROM {table_name} ORDER BY {distance} LIMIT {int(k)}", [query]
+            ).fetchall()
+        # adding 0 keeps the optimizer from rewriting the scan into an index scan
+        exact = conn.execute(
+            f"SELECT id FROM {table_name} ORDER BY {distance} + 0 LIMIT {int(k)}", [query]
+        ).fetchall()
+        recalls.append(len(set(approximate) & set(exact)) / len(exact) if exact else 1.0)
+    recall = float(np.mean(recalls)) if recalls else 1.0
+    conn.execute(f"""
+        INSERT INTO {index_status_table_name} (index_name, table_name, column_name, ef_search, recall, recall_k, checked_at)
+        VALUES (?, ?, ?, ?, ?, ?, now())
+        ON CONFLICT (index_name) DO UPDATE SET
+            ef_search = excluded.ef_search, recall = excluded.recall, recall_k = excluded.recall_k, checked_at = excluded.checked_at
+    """, [index_name, table_name, column, ef_search, recall, k])
+    logger.info(f"Recall@{k} of {index_name}: {recall:.3f} over {len(recalls)} queries.")
+    return recall
+
+
+def index_status(conn: duckdb.DuckDBPyConnection, index_name: str) -> dict:
+    """
+    State of an index: healthy, unchecked (never measured), degraded or missing, with the reasons.
+    It is unknown when the status table wasnt created yet, this runs on the read only api so it never creates it.
+    """
+    status = {'index_name': index_name, 'state': 'missing', 'reasons': []}
+    if conn.execute("SELECT 1 FROM duckdb_tables() WHERE table_name = ?", [index_status_table_name]).fetchone() is None:
+        status['state'] = 'unknown'
+        status['reasons'].append(f'{index_status_table_name} does not exist, run the migrations')
+        return status
+    conn.execute("LOAD vss;")
+    info = conn.execute(
+        "SELECT table_name, metric, dimensions, count, approx_memory_usage FROM pragma_hnsw_index_info() WHERE index_name = ?",
+        [index_name]
+    ).fetchone()
+    stored = conn.execute(
+        f"SELECT m, ef_construction, built_at, build_seconds, ef_search, recall, recall_k, checked_at "
+        f"FROM {index_status_table_name} WHERE index_name = ?", [index_name]
+    ).fetchone()
+    if stored:
+        status.update(zip(
+            ('m', 'ef_construction', 'built_at', 'build_seconds', 'ef_search', 'recall', 'recall_k', 'checked_at'),
+            (value.isoformat() if hasattr(value, 'isoformat') else value for value in stored)
+        ))
+    if info is None:
+        status['reasons'].append('index does not exist')
+        return status
+    table_name, metric, dimensions, entries, memory = info
+    rows = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    dead_ratio = max(entries - rows, 0) / rows if rows else 0.0
+    status.update({
+        'table_name': table_name,
+        'metric': metric,
+        'dimensions': dimensions,
+        'rows': rows,
+        'entries': entries,
+        'dead_ratio': dead_ratio,
+        'memory_bytes': memory,
+    })
+    if metric != hnsw_metric:
+        status['reasons'].append(f'metric {metric} does not match the search metric {hnsw_metric}')
+    if dead_ratio > hnsw_max_dead_ratio:
+        status['reasons'].append(f'{dead_ratio:.0%} of the entries are deleted rows, compact or rebuild it')
+    if status.get('recall') is not None and status['recall'] < hnsw_min_recall:
+        status['reasons'].append(f"recall@{status['recall_k']} {status['recall']:.3f} is below {hnsw_min_recall}")
+    if status['reasons']:
+        status['state'] = 'degraded'
+    elif status.get('recall') is None:
+        status['state'] = 'unchecked'
+    else:
+        status['state'] = 'healthy'
+    return status
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from app.db.connection import get_cursor, get_write_cursor
+    from app.services.embedder import embeddings_table_name, embeddings_index_name
+
+    parser = argparse.ArgumentParser(description="Manages the HNSW index of the embeddings.")
+    parser.add_argument('command', choices=['build', 'compact', 'check', 'status'])
+    parser.add_argument('--index', default=embeddings_index_name)
+    parser.add_argument('--column', default='embedding')
+    parser.add_argument('--m', type=int, default=hnsw_m)
+    parser.add_argument('--ef-construction', type=int, default=hnsw_ef_construction)
+    parser.add_argument('--ef-search', type=int, default=None)
+    parser.add_argument('--metric', default=hnsw_metric, choices=list(distance_functions))
+    parser.add_argument('--sample', type=int, default=100)
+    parser.add_argument('--k', type=int, default=20)
+    args = parser.parse_args()
+    conn = get_cursor() if args.command == 'status' else get_write_cursor()
+    if args.command == 'build':
+        build_index(conn, embeddings_table_name, args.index, args.column, args.m, args.ef_construction, args.metric)
+    if args.command == 'compact':
+        compact_index(conn, args.index)
+    if args.command in ('build', 'compact', 'check'):
+        measure_recall(conn, args.index, args.sample, args.k, args.ef_search)
+    print(json.dumps(index_status(conn, args.index), indent=2, default=str))
@@ -0,0 +1,129 @@
+import duckdb
+from app.db.version import bump_dataset_version
+from app.services.facets import facet_cache
+
+table_name = 'detail'
+fts_schema_name = f'fts_main_{table_name}'
+title_table_name = 'detail_titles'
+rrf_k = 60
+
+
+def normalize_title(title: str) -> str:
+    return ' '.join(title.strip().lower().split())
+
+
+def rebuild_fts_index(conn: duckdb.DuckDBPyConnection):
+    # duckdb full text indexes are not updated with the table, so this runs after every generate_gold
+    conn.execute("INSTALL fts;")
+    conn.execute("LOAD fts;")
+    # the default tokenizer drops digits, which are part of many titles ("hades 2", "fifa 23")
+    conn.execute(
+        f"PRAGMA create_fts_index('{table_name}', 'id', 'name', 'short_description', "
+        f"ignore='(\\.|[^a-z0-9])+', overwrite=1)"
+    )
+
+
+def ensure_fts_index(conn: duckdb.DuckDBPyConnection):
+    existing_tables = {row[0] for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+    if table_name not in existing_tables:
+        return
+    existing_schemas = {row[0] for row in conn.execute("SELECT schema_name FROM duckdb_schemas()").fetchall()}
+    if fts_schema_name not in existing_schemas:
+        rebuild_fts_index(conn)
+
+
+def normalized_name_sql(column: str) -> str:
+    return f"lower(trim(regexp_replace({column}, '[™®©]', '', 'g')))"
+
+
+def rebuild_title_index(conn: duckdb.DuckDBPyConnection):
+    """
+    Every normalized title plus each of its prefixes that ends before a space or a colon ("hades" for "Hades II"),
+    so title_rank is an index lookup instead of normalizing every title of the catalog on each query.
+    Runs before rebuild_facets in generate_gold, which bumps the dataset version.
+    """
+    conn.execute(f"""
+        CREATE OR REPLACE TABLE {title_table_name} AS
+        WITH names AS (
+            SELECT det.id, {normalized_name_sql('det.name')} AS name
+            FROM {table_name} AS det
+            WHERE det.name IS NOT NULL
+        )
+        SELECT name AS title, id, true AS exact
+        FROM names
+        UNION ALL
+        SELECT left(name, position - 1) AS title, id, false AS exact
+        FROM names, range(2, length(name) + 1) AS positions(position)
+        WHERE substring(name, position, 1) IN (' ', ':')
+        ORDER BY title
+    """)
+    conn.execute(f"CREATE INDEX {title_table_name}_title_index ON {title_table_name} (title)")
+
+
+def ensure_title_index(conn: duckdb.DuckDBPyConnection):
+    existing_tables = {row[0] for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+    if table_name in existing_tables and title_table_name not in existing_tables:
+        rebuild_title_index(conn)
+        bump_dataset_version(conn)
+
+
+def title_rank(conn: duckdb.DuckDBPyConnection, query: str, predicates: list[str], params: list, limit: int) -> tuple[list[int], bool]:
+    """
+    Games whose title is the query, followed by the ones whose title starts with it ("hades" -> "Hades II").
+    The flag tells if there was an exact title match.
+    """
+    title = normalize_title(query)
+    if facet_cache.has_table(conn, title_table_name):
+        sql_query = f"""
+            SELECT det.id, titles.exact
+            FROM {title_table_name} AS titles
+            INNER JOIN {table_name} AS det ON det.id = titles.id
+            WHERE
+                {' AND '.join(predicates)} AND
+                titles.title = ?
+            ORDER BY titles.exact DESC, det.recommendations DESC NULLS LAST, det.id
+            LIMIT {int(limit)}
+        """
+        rows = conn.execute(sql_query, params + [title]).fetchall()
+        return [row[0] for row in rows], any(row[1] for row in rows)
+    # databases that werent migrated yet normalize every title on the fly
+    normalized_name = normalized_name_sql('det.name')
+    sql_query = f"""
+        SELECT det.id, {normalized_name} = ? AS exact
+        FROM {table_name} AS det
+        WHERE
+            {' AND '.join(predicates)} AND
+            (
+                {normalized_name} = ? OR
+                starts_with({normalized_name}, ? || ' ') OR
+                starts_with({normalized_name}, ? || ':')
+            )
+        ORDER BY exact DESC, det.recommendations DESC NULLS LAST, det.id
+        LIMIT {int(limit)}
+    """
+    rows = conn.execute(sql_query, [title] + params + [title, title, title]).fetchall()
+    return [row[0] for row in rows], any(row[1] for row in rows)
+
+
+def bm25_rank(conn: duckdb.DuckDBPyConnection, query: str, predicates: list[str], params: list, limit: int) -> list[int]:
+    sql_query = f"""
+        SELECT id
+        FROM (
+            SELECT det.id, {fts_schema_name}.match_bm25(det.id, ?) AS score
+            FROM {table_name} AS det
+            WHERE
+                {' AND '.join(predicates)}
+        )
+        WHERE score IS NOT NULL
+        ORDER BY score DESC, id
+        LIMIT {int(limit)}
+    """
+    return [row[0] for row in conn.execute(sql_query, [query] + params).fetchall()]
+
+
+def reciprocal_rank_fusion(lexical_ids: list[int], vector_ids: list[int], lexical_weight: float) -> list[int]:
+    scores = {}
+    for weight, ids in ((lexical_weight, lexical_ids), (1 - lexical_weight, vector_ids)):
+        for rank, app_id in enumerate(ids):
+            scores[app_id] = scores.get(app_id, 0.0) + weight / (rrf_k + rank + 1)
+    return sorted(scores, key=lambda app_id: -scores[app_id])
@@ -0,0 +1,60 @@
+import os
+import duckdb
+import numpy as np
+from app.utils.logger import logger
+from app.services.index_manager import build_index, hnsw_indexes_dropped
+
+# text-embedding-3 vectors can be truncated and renormalized, 0 disables the coarse search stage
+coarse_dimensions = int(os.getenv('SEARCH_COARSE_DIMENSIONS', 0))
+coarse_candidates = int(os.getenv('SEARCH_COARSE_CANDIDATES', 400))
+short_column = 'embedding_short'
+
+
+def truncate_vector(vector: list[float], dimensions: int) -> list[float]:
+    short = np.asarray(vector[:dimensions], dtype=np.float32)
+    norm = np.linalg.norm(short)
+    return (short / norm if norm > 0 else short).tolist()
+
+
+def short_vector_sql(column: str, dimensions: int) -> str:
+    sliced = f"list_slice({column}::FLOAT[], 1, {int(dimensions)})"
+    return f"""CAST(list_transform(
+        {sliced},
+        x -> x / greatest(sqrt(list_sum(list_transform({sliced}, y -> y * y))), 1e-12)
+    ) AS FLOAT[{int(dimensions)}])"""
+
+
+def short_vector_dimensions(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str) -> int | None:
+    """
+    Size of the truncated vectors stored with the table, None when they were never built.
+    """
+    row = conn.execute(
+        "SELECT data_type FROM duckdb_columns() WHERE table_name = ? AND column_name = ?",
+        [embeddings_table_name, short_column]
+    ).fetchone()
+    return int(row[0].split('[')[-1].rstrip(']')) if row else None
+
+
+def build_short_vectors(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str, dimensions: int):
+    """
+    (Re)creates the truncated vector column and its own HNSW index from the full vectors.
+    """
+    index_name = f'{embeddings_table_name}_short_index'
+    logger.info(f"Building {dimensions} dimension vectors for {embeddings_table_name}.")
+    conn.execute("LOAD vss;")
+    conn.execute("SET hnsw_enable_experimental_persistence = true;")
+    conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+    # the update touches every row, so the full vector index is built again rather than left with a tombstone per row
+    with hnsw_indexes_dropped(conn, embeddings_table_name):
+        if short_vector_dimensions(conn, embeddings_table_name):
+            conn.execute(f"ALTER TABLE {embeddings_table_name} DROP COLUMN {short_column}")
+        conn.execute(f"ALTER TABLE {embeddings_table_name} ADD COLUMN {short_column} FLOAT[{int(dimensions)}]")
+        conn.execute(f"UPDATE {embeddings_table_name} SET {short_column} = {short_vector_sql('embedding', dimensions)}")
+    build_index(conn, embeddings_table_name, index_name, short_column)
+    logger.info(f"Built {short_column} and {index_name}.")
+
+
+if __name__ == "__main__":
+    from app.db.connection import get_write_cursor
+    from app.services.embedder import embeddings_table_name
+    build_short_vectors(get_write_cursor(), embeddings_table_name, coarse_dimensions or 256)
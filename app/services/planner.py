@@ -0,0 +1,46 @@
+import math
+import os
+import duckdb
+from app.services.facets import facet_cache
+
+exact_max_rows = int(os.getenv('SEARCH_EXACT_MAX_ROWS', 5000))
+exact_max_selectivity = float(os.getenv('SEARCH_EXACT_MAX_SELECTIVITY', 0.02))
+hnsw_overfetch = float(os.getenv('SEARCH_HNSW_OVERFETCH', 2.0))
+hnsw_max_fetch = int(os.getenv('SEARCH_HNSW_MAX_FETCH', 20000))
+
+
+def estimate_selectivity(conn: duckdb.DuckDBPyConnection, category: list[str] | None, genre: list[str] | None,
+                         price_start: float, price_end: float) -> float:
+    """
+    Fraction of the catalog expected to survive the filters, assuming the filters are independent.
+    Genre and category counts are summed, so games with several of the picked values make it an upper bound.
+    """
+    stats = facet_cache.stats(conn)
+    total = stats['total']
+    if not total:
+        return 0.0
+    quantiles = stats['price_quantiles']
+    if not quantiles:
+        return 0.0
+    in_range = sum(1 for price in quantiles if price_start <= price <= price_end) / len(quantiles)
+    selectivity = stats['priced'] / total * in_range
+    for facet, values in (('category', category), ('genre', genre)):
+        if values:
+            counts = {row[facet]: row['game_count'] for row in facet_cache.get(conn, facet)}
+            selectivity *= min(1.0, sum(counts.get(value, 0) for value in values) / total)
+    return selectivity
+
+
+def plan_search(conn: duckdb.DuckDBPyConnection, category: list[str] | None, genre: list[str] | None,
+                price_start: float, price_end: float, k: int) -> dict:
+    """
+    Selective filters leave few rows, scanning them exactly is cheap and always returns k results.
+    Otherwise the HNSW index is used, fetching enough candidates for k of them to survive the filters
+    (index scans run one at a time per process, the time spent queueing for it is the hnsw_wait stage, see hnsw_scan).
+    """
+    selectivity = estimate_selectivity(conn, category, genre, price_start, price_end)
+    expected_rows = selectivity * facet_cache.stats(conn)['total']
+    if expected_rows <= exact_max_rows or selectivity <= exact_max_selectivity:
+        return {'strategy': 'exact', 'selectivity': selectivity, 'fetch': None}
+    fetch = math.ceil(k / selectivity * hnsw_overfetch)
+    return {'strategy': 'hnsw', 'selectivity': selectivity, 'fetch': max(k, min(fetch, hnsw_max_fetch))}
@@ -0,0 +1,138 @@
+import os
+import duckdb
+import numpy as np
+from app.services.index_manager import hnsw_indexes_dropped, hnsw_metric
+from app.utils.logger import logger
+
+# int8 scans a one byte per dimension copy of the vectors and reranks a shortlist with the full ones
+quantization = os.getenv('EMBEDDING_QUANTIZATION', 'none')
+rerank_candidates = int(os.getenv('QUANTIZED_RERANK_CANDIDATES', 200))
+int8_column = 'embedding_int8'
+scale_column = 'embedding_scale'
+# norm of the dequantized vector, it stands in for the |x|^2 term of the l2 distance and for the cosine
+norm_column = 'embedding_norm'
+if quantization not in ('none', 'int8'):
+    raise ValueError(f"Unknown embedding quantization {quantization}, use none or int8.")
+
+
+def quantize_int8(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per vector quantization, every row is stored as int8 codes times its own scale.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.maximum(np.abs(matrix).max(axis=1, initial=0) / 127, 1e-12).astype(np.float32)
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+def quantized_dimensions(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str) -> int | None:
+    row = conn.execute(
+        "SELECT data_type FROM duckdb_columns() WHERE table_name = ? AND column_name = ?",
+        [embeddings_table_name, int8_column]
+    ).fetchone()
+    return int(row[0].split('[')[-1].rstrip(']')) if row else None
+
+
+def fill_quantized(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str, dimensions: int):
+    # only the rows without codes, so it also keeps the column in sync after an embedding run
+    missing = f"{int8_column} IS NULL AND embedding IS NOT NULL"
+    conn.execute(f"""
+        UPDATE {embeddings_table_name}
+        SET {scale_column} = greatest(list_max(list_transform(embedding::FLOAT[], x -> abs(x))) / 127, 1e-12)
+        WHERE {missing}
+    """)
+    conn.execute(f"""
+        UPDATE {embeddings_table_name}
+        SET {int8_column} = CAST(
+            list_transform(embedding::FLOAT[], x -> CAST(round(x / {scale_column}) AS TINYINT)) AS TINYINT[{int(dimensions)}]
+        )
+        WHERE {missing}
+    """)
+    conn.execute(f"""
+        UPDATE {embeddings_table_name}
+        SET {norm_column} = {scale_column} * sqrt(list_inner_product({int8_column}::FLOAT[], {int8_column}::FLOAT[]))
+        WHERE {norm_column} IS NULL AND {int8_column} IS NOT NULL
+    """)
+
+
+def build_quantized(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str):
+    dimensions = conn.execute(f"SELECT max(len(embedding)) FROM {embeddings_table_name}").fetchone()[0]
+    if not dimensions:
+        raise ValueError(f"{embeddings_table_name} has no embeddings to quantize.")
+    logger.info(f"Quantizing {embeddings_table_name} to int8.")
+    # every row is updated, which would leave a tombstone per row in the hnsw indexes, so they are built again after
+    with hnsw_indexes_dropped(conn, embeddings_table_name):
+        conn.execute(f"ALTER TABLE {embeddings_table_name} ADD COLUMN IF NOT EXISTS {int8_column} TINYINT[{int(dimensions)}]")
+        conn.execute(f"ALTER TABLE {embeddings_table_name} ADD COLUMN IF NOT EXISTS {scale_column} FLOAT")
+        conn.execute(f"ALTER TABLE {embeddings_table_name} ADD COLUMN IF NOT EXISTS {norm_column} FLOAT")
+        conn.execute(f"UPDATE {embeddings_table_name} SET {int8_column} = NULL, {scale_column} = NULL, {norm_column} = NULL")
+        fill_quantized(conn, embeddings_table_name, dimensions)
+
+
+def drop_text(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str):
+    """
+    The content hash tells when a game must be embedded again, so the copy of its text isnt needed anymore.
+    duckdb cant drop a column before an indexed one, so the hnsw indexes are dropped and built again.
+    """
+    with hnsw_indexes_dropped(conn, embeddings_table_name):
+        conn.execute(f"ALTER TABLE {embeddings_table_name} DROP COLUMN IF EXISTS text")
+
+
+def quantized_distance_sql(dimensions: int) -> str:
+    """
+    Distance between the int8 codes and the query parameter, it ranks like the hnsw metric
+    (the terms that only depend on the query are left out).
+    """
+    inner_product = f"array_inner_product(CAST({int8_column} AS FLOAT[{int(dimensions)}]), ?::FLOAT[{int(dimensions)}])"
+    if hnsw_metric == 'cosine':
+        return f"-{scale_column} * {inner_product} / greatest({norm_column}, 1e-12)"
+    if hnsw_metric == 'ip':
+        return f"-{scale_column} * {inner_product}"
+    return f"{norm_column} * {norm_column} - 2 * {scale_column} * {inner_product}"
+
+
+def storage_report(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str) -> dict:
+    """
+    Bytes of the vectors in every representation and of the stored texts, before compression.
+    """
+    columns = {
+        row[0] for row in conn.execute(
+            "SELECT column_name FROM duckdb_columns() WHERE table_name = ?", [embeddings_table_name]
+        ).fetchall()
+    }
+    rows, dimensions = conn.execute(f"SELECT COUNT(*), max(len(embedding)) FROM {embeddings_table_name}").fetchone()
+    dimensions = dimensions or 0
+    text_bytes = conn.execute(f"SELECT sum(strlen(text)) FROM {embeddings_table_name}").fetchone()[0] if 'text' in columns else 0
+    return {
+        'rows': rows,
+        'dimensions': dimensions,
+        'float32_bytes': rows * dimensions * 4,
+        'float16_bytes': rows * dimensions * 2,
+        # codes plus the scale and norm floats
+        'int8_bytes': rows * (dimensions + 8),
+        'text_bytes': int(text_bytes or 0),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from app.db.connection import get_write_cursor
+    from app.services.embedder import embeddings_table_name
+    from app.services.embedding_job import ensure_content_hash
+    from app.services.evaluation import evaluate_two_stage
+
+    parser = argparse.ArgumentParser(description="Adds the int8 copy of the embeddings used by EMBEDDING_QUANTIZATION=int8.")
+    parser.add_argument('--drop-text', action='store_true', help="drop the copy of the embedded text")
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=20)
+    args = parser.parse_args()
+    conn = get_write_cursor()
+    build_quantized(conn, embeddings_table_name)
+    if args.drop_text:
+        ensure_content_hash(conn, embeddings_table_name)
+        drop_text(conn, embeddings_table_name)
+    conn.execute("CHECKPOINT")
+    report = storage_report(conn, embeddings_table_name)
+    report['evaluation'] = evaluate_two_stage(conn, args.queries, args.k)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,234 @@
+import asyncio
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator, Optional
+import duckdb
+from app.db import query_cache_path
+from app.services.singleflight import SingleFlight, AsyncSingleFlight
+from app.utils.logger import logger
+
+query_cache_table_name = 'query_embedding_cache'
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(query.strip().lower().split())
+
+
+def ensure_query_cache_table(conn: duckdb.DuckDBPyConnection, table_name: str = query_cache_table_name):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            query VARCHAR,
+            model VARCHAR,
+            embedding FLOAT[],
+            created_at TIMESTAMP,
+            PRIMARY KEY (query, model)
+        );
+    """)
+
+
+def move_catalog_cache(conn: duckdb.DuckDBPyConnection, path: str = query_cache_path):
+    """
+    The cache used to be a table of the catalog, the migration moves its entries to the cache file once.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM duckdb_tables() WHERE database_name = current_database() AND table_name = ?", [query_cache_table_name]
+    ).fetchone()
+    if not exists:
+        return
+    conn.execute(f"ATTACH '{path.replace(chr(39), chr(39) * 2)}' AS query_cache_store")
+    try:
+        ensure_query_cache_table(conn, f'query_cache_store.main.{query_cache_table_name}')
+        conn.execute(f"INSERT OR REPLACE INTO query_cache_store.main.{query_cache_table_name} SELECT * FROM {query_cache_table_name}")
+    finally:
+        conn.execute("DETACH query_cache_store")
+    conn.execute(f"DROP TABLE {query_cache_table_name}")
+    logger.info(f"Moved the query embedding cache to {path}.")
+
+
+class QueryEmbeddingCache:
+    """
+    Two tier cache for query embeddings.
+    The first tier is an in-process LRU bounded by size and TTL, the second one is a
+    DuckDB table keyed by normalized query text and model name, so it survives restarts.
+    The table lives in its own file (path), which is only opened for a lookup or a flush: the catalog is read-only
+    in the api and several workers share the cache, a worker that finds it locked counts a miss or flushes later.
+    New entries are written in batches of flush_size, or after flush_seconds.
+    """
+
+    def __init__(self, model: str, max_size: int = 10000, ttl: float = 3600.0, persistent: bool = True,
+                 path: str = query_cache_path, flush_size: int = 32, flush_seconds: float = 5.0):
+        self.model = model
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent = persistent
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self._entries: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+        # duckdb doesnt open a file twice in a process with different settings, so lookups and flushes take turns
+        self._store_lock = threading.Lock()
+        self._pending: dict[str, list[float]] = {}
+        self._flushed_at = time.monotonic()
+        if persistent:
+            atexit.register(self.flush)
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self._in_flight = SingleFlight()
+        self._async_in_flight = AsyncSingleFlight()
+
+    def _get_memory(self, key: str) -> Optional[list[float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, embedding = entry
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return embedding
+
+    def _put_memory(self, key: str, embedding: list[float]):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    @contextmanager
+    def _store(self, read_only: bool) -> Iterator[duckdb.DuckDBPyConnection]:
+        with self._store_lock:
+            conn = duckdb.connect(self.path, read_only=read_only)
+            try:
+                yield conn
+            finally:
+                conn.close()
+
+    def _get_persistent(self, key: str) -> Optional[list[float]]:
+        if not self.persistent or not os.path.exists(self.path):
+            return None
+        try:
+            with self._store(read_only=True) as conn:
+                row = conn.execute(
+                    f"SELECT embedding FROM {query_cache_table_name} WHERE query = ? AND model = ?",
+                    [key, self.model]
+                ).fetchone()
+        except duckdb.Error as e:
+            # another worker is flushing, or nothing was flushed yet
+            logger.debug(f"Query embedding cache not readable: {e}")
+            return None
+        return list(row[0]) if row else None
+
+    def _put_persistent(self, key: str, embedding: list[float]):
+        if not self.persistent:
+            return
+        with self._lock:
+            self._pending[key] = embedding
+            due = len(self._pending) >= self.flush_size or time.monotonic() - self._flushed_at >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Writes the pending entries, returns how many. They are kept for the next flush when the file is locked.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return 0
+        try:
+            with self._store(read_only=False) as conn:
+                ensure_query_cache_table(conn)
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO {query_cache_table_name} (query, model, embedding, created_at) VALUES (?, ?, ?, now())",
+                    [[key, self.model, embedding] for key, embedding in pending.items()]
+                )
+        except duckdb.Error as e:
+            logger.warning(f"Failed to write {len(pending)} query embeddings to the cache, retrying on the next flush: {e}")
+            with self._lock:
+                # newer entries win, and the backlog stays within the size of the memory tier
+                pending.update(self._pending)
+                self._pending = dict(list(pending.items())[-self.max_size:])
+            return 0
+        return len(pending)
+
+    def get(self, query: str) -> Optional[list[float]]:
+        key = normalize_query(query)
+        embedding = self._get_memory(key)
+        if embedding is not None:
+            self.hits += 1
+            return embedding
+        embedding = self._get_persistent(key)
+        if embedding is not None:
+            self.persistent_hits += 1
+            self._put_memory(key, embedding)
+            return embedding
+        self.misses += 1
+        return None
+
+    def put(self, query: str, embedding: list[float]):
+        key = normalize_query(query)
+        self._put_memory(key, embedding)
+        self._put_persistent(key, embedding)
+
+    def get_or_embed(self, query: str, embed: Callable[[str], list[float]]) -> list[float]:
+        embedding = self.get(query)
+        if embedding is not None:
+            return embedding
+        key = normalize_query(query)
+
+        # concurrent misses for the same query share one embedding call
+        def embed_and_put():
+            embedding = embed(key)
+            self.put(key, embedding)
+            return embedding
+
+        return self._in_flight.do(key, embed_and_put)
+
+    async def aget_or_embed(self, query: str, aembed: Callable[[str], Awaitable[list[float]]]) -> list[float]:
+        key = normalize_query(query)
+        embedding = self._get_memory(key)
+        if embedding is not None:
+            self.hits += 1
+            return embedding
+
+        async def embed_and_put():
+            embedding = await asyncio.to_thread(self.get, key)
+            if embedding is None:
+                embedding = await aembed(key)
+                await asyncio.to_thread(self.put, key, embedding)
+            return embedding
+
+        return await self._async_in_flight.do(key, embed_and_put)
+
+    def get_or_embed_many(self, queries: list[str], embed_many: Callable[[list[str]], list[list[float]]]) -> list[list[float]]:
+        found = {}
+        for query in queries:
+            key = normalize_query(query)
+            if key not in found:
+                found[key] = self.get(query)
+        missing = [key for key, embedding in found.items() if embedding is None]
+        if missing:
+            for key, embedding in zip(missing, embed_many(missing)):
+                found[key] = embedding
+                self.put(key, embedding)
+        return [found[normalize_query(query)] for query in queries]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            'model': self.model,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+response_cache_size = int(os.getenv('RESPONSE_CACHE_SIZE', 1000))
+response_cache_max_bytes = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# how long clients and proxies may reuse a response before revalidating it with its ETag
+response_cache_max_age = int(os.getenv('RESPONSE_CACHE_MAX_AGE', 60))
+price_precision = 2
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    mimetype: str
+    etag: str
+    headers: dict
+
+
+def make_etag(body: bytes) -> str:
+    # derived from the bytes only, so every worker gives the same tag to the same response
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def cache_control() -> str:
+    return f'public, max-age={response_cache_max_age}'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+def normalize_filters(search_args: dict) -> dict:
+    """
+    Filters that select the same games give the same key: the lists are sorted and deduplicated,
+    the price bounds are rounded to cents.
+    """
+    normalized = dict(search_args)
+    for key in ('category', 'genre'):
+        if normalized.get(key):
+            normalized[key] = sorted(set(normalized[key]))
+    for key in ('price_start', 'price_end'):
+        if isinstance(normalized.get(key), (int, float)):
+            normalized[key] = round(float(normalized[key]), price_precision)
+    return normalized
+
+
+def cache_key(*parts) -> str:
+    return json.dumps(parts, sort_keys=True, default=str)
+
+
+class ResponseCache:
+    """
+    In-process LRU of rendered responses, bounded by entry count and total body size.
+    Entries of older dataset versions are dropped as soon as a newer version is seen.
+    """
+
+    def __init__(self, max_size: int = response_cache_size, max_bytes: int = response_cache_max_bytes):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.max_bytes > 0
+
+    def _check_version(self, version: int) -> bool:
+        # a request that read an older version must not evict the entries of the newer one
+        if self._version is not None and version < self._version:
+            return False
+        if version != self._version:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+        return True
+
+    def get(self, version: int, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key) if self._check_version(version) else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, version: int, key: str, entry: CachedResponse):
+        if not self.enabled or len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            if not self._check_version(version):
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous.body)
+            self._entries[key] = entry
+            self._bytes += len(entry.body)
+            while len(self._entries) > self.max_size or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+
+    def mark_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+response_cache = ResponseCache()
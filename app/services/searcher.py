@@ -1,64 +1,377 @@
-from app.db import db_path, bronze_path, silver_path
+import os
+from app.db.connection import get_cursor, hnsw_scan
 import duckdb
-from sqlalchemy import text
-from app.services.embedder import  embeddings, table_name, embeddings_table_name, model_size
-import pandas as pd
-def do_query_search(query: str, category: list[str], genre: list[str], price_start: int, price_end: int) -> pd.DataFrame:
-    with duckdb.connect(db_path) as conn:
+from app.services.embedder import  embed_query_cached, embed_queries_cached, table_name, embeddings_table_name, embeddings_index_name, model_size
+from app.services.facets import facet_cache
+from app.services.bitmasks import facet_mask, mask_columns
+from app.services.planner import plan_search, hnsw_max_fetch
+from app.services.vector_engine import VectorEngine
+from app.services.lexical import title_rank, bm25_rank, reciprocal_rank_fusion
+from app.services.similar import similar_ids
+from app.utils.metrics import span, rows_scanned
+from app.services.index_manager import distance_function, index_status
+from app.services.matryoshka import coarse_dimensions, coarse_candidates, short_column, short_vector_dimensions, truncate_vector
+from app.services.quantization import quantization, quantized_dimensions, quantized_distance_sql, rerank_candidates
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    # duckdb imports pandas by itself on the first .df(), importing it here would slow down every worker boot
+    import pandas as pd
+
+search_backend = os.getenv('SEARCH_BACKEND', 'duckdb')
+vector_engine = VectorEngine(embeddings_table_name, dtype=os.getenv('VECTOR_ENGINE_DTYPE', 'float32'))
+search_modes = ('semantic', 'lexical', 'hybrid')
+title_fast_path = os.getenv('SEARCH_TITLE_FAST_PATH', 'true').lower() == 'true'
+default_lexical_weight = float(os.getenv('SEARCH_LEXICAL_WEIGHT', 0.5))
+hybrid_candidates = int(os.getenv('SEARCH_HYBRID_CANDIDATES', 100))
+# false filters with list_has_any on the genre/category lists even when the bitmask columns exist
+facet_bitmasks = os.getenv('SEARCH_FACET_BITMASKS', 'true').lower() == 'true'
+search_fields = {
+    'id': 'det.id',
+    'name': 'det.name',
+    'description': 'det.short_description',
+    'price': """
+        CASE
+            WHEN det.price IS NULL THEN 0
+            ELSE det.price/100
+        END""",
+    'image': 'det.image',
+    'link': """
+        CONCAT(
+            'https://store.steampowered.com/app/',
+            det.id
+        )""",
+    'pc_requirements': 'det.windows_req_min',
+    'mac_requirements': 'det.mac_req_min',
+    'linux_requirements': 'det.lin_req_min',
+    'genres': 'det.genres',
+    'categories': 'det.categories',
+}
+
+
+def select_columns(fields: list[str] | None = None) -> str:
+    fields = fields or list(search_fields)
+    unknown = [field for field in fields if field not in search_fields]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}.")
+    return ',\n'.join(f"{search_fields[field]} AS {field}" for field in fields)
+
+
+def _facet_ids(conn, facet: str) -> dict | None:
+    # None when the bitmasks are turned off or not built yet, the filters then check the lists
+    return facet_cache.ids(conn, facet) if facet_bitmasks else None
+
+
+def _facet_filter(conn, facet: str, column: str, values: list[str]) -> tuple[str, list]:
+    # a bitwise AND on the mask column replaces the list scan, values without a bit still check the list
+    facet_ids = _facet_ids(conn, facet)
+    if facet_ids is None:
+        return f'list_has_any(det.{column}, ?)', [values]
+    mask, unmapped = facet_mask(facet_ids, values)
+    if unmapped:
+        return f'((det.{mask_columns[facet]} & ?::UBIGINT) != 0 OR list_has_any(det.{column}, ?))', [mask, unmapped]
+    return f'(det.{mask_columns[facet]} & ?::UBIGINT) != 0', [mask]
+
+
+def build_filters(category: list[str] | None, genre: list[str] | None, price_start: float, price_end: float) -> tuple[list[str], list]:
+    predicates = ['det.price >= ?', 'det.price <= ?']
+    params = [price_start, price_end]
+    # an empty filter means no filter, so it doesnt need to be checked against every facet value
+    for facet, column, values in (('category', 'categories', category), ('genre', 'genres', genre)):
+        if values:
+            predicate, values_params = _facet_filter(get_cursor(), facet, column, values)
+            predicates.append(predicate)
+            params.extend(values_params)
+    return predicates, params
+
+
+def _exact_rank(conn, query_embedding: list[float], predicates: list[str], params: list, k: int, offset: int,
+                quantized: bool | None = None) -> list[int]:
+    """
+    With int8 quantization (EMBEDDING_QUANTIZATION unless quantized is given), the filtered rows are scanned
+    through their int8 codes and the shortlist is reranked with the full vectors.
+    """
+    quantized = quantization == 'int8' if quantized is None else quantized
+    int8_dimensions = quantized and quantized_dimensions(conn, embeddings_table_name)
+    if int8_dimensions:
         sql_query = f"""
-            SELECT
-                det.id,
-                det.name,
-                det.short_description AS description,
-                CASE
-                    WHEN det.price IS NULL THEN 0
-                    ELSE det.price/100
-                END AS price,
-                image,
-                CONCAT(
-                    'https://store.steampowered.com/app/',
-                    det.id
-                ) AS link,
-                det.windows_req_min AS pc_requirements,
-                det.mac_req_min AS mac_requirements,
-                det.lin_req_min AS linux_requirements,
-                det.genres,
-                det.categories
-            FROM {embeddings_table_name} AS emb
+            WITH candidates AS (
+                SELECT det.id, emb.embedding
+                FROM {embeddings_table_name} AS emb
+                INNER JOIN {table_name} AS det
+                    ON emb.id = det.id
+                WHERE
+                    {' AND '.join(predicates)}
+                ORDER BY {quantized_distance_sql(int8_dimensions)}
+                LIMIT {int(max(rerank_candidates, offset + k))}
+            )
+            SELECT id
+            FROM candidates
+            ORDER BY {distance_function}(embedding, ?::FLOAT[{model_size}])
+            LIMIT {int(k)}
+            OFFSET {int(offset)}
+        """
+        return [row[0] for row in conn.execute(sql_query, params + [query_embedding, query_embedding]).fetchall()]
+    sql_query = f"""
+        SELECT det.id
+        FROM {embeddings_table_name} AS emb
+        INNER JOIN {table_name} AS det
+            ON emb.id = det.id
+        WHERE
+            {' AND '.join(predicates)}
+        ORDER BY {distance_function}(embedding, ?::FLOAT[{model_size}])
+        LIMIT {int(k)}
+        OFFSET {int(offset)}
+    """
+    return [row[0] for row in conn.execute(sql_query, params + [query_embedding]).fetchall()]
+
+
+def _hnsw_rank(conn, query_embedding: list[float], predicates: list[str], params: list, k: int, fetch: int,
+               coarse: int | None = None) -> list[int] | None:
+    """
+    With coarse set, the candidates come from the index of the truncated vectors
+    and are reranked with the full ones (two stage matryoshka search).
+    """
+    # the inner query is the only shape the vss extension rewrites into an index scan
+    total = facet_cache.row_count(conn, embeddings_table_name)
+    if coarse:
+        candidate_column, candidate_embedding = short_column, truncate_vector(query_embedding, coarse)
+        fetch = max(fetch, coarse_candidates)
+    else:
+        candidate_column, candidate_embedding = 'embedding', query_embedding
+    while True:
+        sql_query = f"""
+            WITH candidates AS (
+                SELECT id, embedding
+                FROM {embeddings_table_name}
+                ORDER BY {distance_function}({candidate_column}, ?::FLOAT[{coarse or model_size}])
+                LIMIT {int(fetch)}
+            )
+            SELECT det.id
+            FROM candidates AS emb
             INNER JOIN {table_name} AS det
                 ON emb.id = det.id
             WHERE
-                det.price >= ? AND 
-                det.price <= ? AND
-                list_has_any(det.categories, ?) AND
-                list_has_any(det.genres, ?)
-            ORDER BY array_distance(embedding, array{embeddings.embed_query(query)}::FLOAT[{model_size}])
-            LIMIT 20
+                {' AND '.join(predicates)}
+            ORDER BY {distance_function}(emb.embedding, ?::FLOAT[{model_size}])
+            LIMIT {int(k)}
         """
-        params = [
-            price_start,
-            price_end,
-            category,
-            genre
-        ]
-        df = conn.execute(sql_query, params).df()
-
-    return df
-
-def do_category_search():
-    with duckdb.connect(db_path) as conn:
-        df = conn.execute(
-            """
-            SELECT category FROM app_categories
-            """
-        ).df()
-    return [x['unnest'] for x in df['category'].tolist()]
-
-def do_genre_search():
-    with duckdb.connect(db_path) as conn:
-        df = conn.execute(
-            """
-            SELECT genre FROM app_genres
-            """
-        ).df()
-    return [x['unnest'] for x in df['genre'].tolist()]
\ No newline at end of file
+        with hnsw_scan():
+            ids = [row[0] for row in conn.execute(sql_query, [candidate_embedding] + params + [query_embedding]).fetchall()]
+        rows_scanned.inc('two_stage' if coarse else 'hnsw', amount=min(fetch, total))
+        if len(ids) >= k or fetch >= total:
+            return ids
+        if fetch >= hnsw_max_fetch:
+            return None
+        fetch = min(fetch * 4, hnsw_max_fetch)
+
+
+def coarse_search_dimensions(conn) -> int | None:
+    if not coarse_dimensions:
+        return None
+    return short_vector_dimensions(conn, embeddings_table_name)
+
+
+def fetch_details(ids: list[int], fields: list[str] | None = None) -> duckdb.DuckDBPyConnection:
+    """
+    Returns the executed cursor, so callers pick how to materialize it (df, arrow batches, ...).
+    """
+    sql_query = f"""
+        SELECT
+            {select_columns(fields)}
+        FROM {table_name} AS det
+        WHERE det.id IN (SELECT UNNEST(?::BIGINT[]))
+        ORDER BY list_position(?::BIGINT[], det.id)
+    """
+    with span('details'):
+        return get_cursor().execute(sql_query, [ids, ids])
+
+
+def _vector_rank(conn, query: str, category: list[str] | None, genre: list[str] | None, price_start: int, price_end: int,
+                 predicates: list[str], params: list, k: int, offset: int) -> list[int]:
+    with span('embed'):
+        query_embedding = embed_query_cached(query)
+    if search_backend == 'numpy':
+        with span('vector_numpy'):
+            vector_engine.load(conn)
+            ids, _ = vector_engine.search(query_embedding, category, genre, price_start, price_end, offset + k)
+        rows_scanned.inc('numpy', amount=len(vector_engine.ids))
+        return ids[offset:].tolist()
+    with span('plan'):
+        plan = plan_search(conn, category, genre, price_start, price_end, offset + k)
+    if plan['strategy'] == 'hnsw':
+        with span('vector_hnsw'):
+            ids = _hnsw_rank(conn, query_embedding, predicates, params, offset + k, plan['fetch'], coarse_search_dimensions(conn))
+        if ids is not None:
+            return ids[offset:]
+    with span('vector_exact'):
+        ids = _exact_rank(conn, query_embedding, predicates, params, k, offset)
+    # the filters are applied before the distances, so an exact scan compares about the rows that survive them
+    rows_scanned.inc('exact', amount=round(plan['selectivity'] * facet_cache.stats(conn)['total']))
+    return ids
+
+
+def _merge_ranks(*rankings: list[int]) -> list[int]:
+    return list(dict.fromkeys(app_id for ranking in rankings for app_id in ranking))
+
+
+def needs_embedding(query: str, category: list[str] | None, genre: list[str] | None, price_start: int, price_end: int,
+                    mode: str = 'semantic') -> bool:
+    """
+    Tells if rank_query_search will embed the query, so async callers can embed it beforehand without blocking.
+    """
+    if mode == 'lexical':
+        return False
+    if not title_fast_path:
+        return True
+    predicates, params = build_filters(category, genre, price_start, price_end)
+    _, exact = title_rank(get_cursor(), query, predicates, params, 1)
+    return not exact
+
+
+def rank_query_search(query: str, category: list[str] | None, genre: list[str] | None, price_start: int, price_end: int,
+                      k: int = 20, offset: int = 0, mode: str = 'semantic', lexical_weight: float | None = None) -> list[int]:
+    if mode not in search_modes:
+        raise ValueError(f"Unknown search mode {mode}.")
+    conn = get_cursor()
+    predicates, params = build_filters(category, genre, price_start, price_end)
+    limit = offset + k
+    if title_fast_path or mode == 'lexical':
+        # a literal title doesnt need an embedding, the title matches come first and bm25 fills the page
+        with span('title'):
+            title_ids, exact = title_rank(conn, query, predicates, params, limit)
+        if exact or mode == 'lexical':
+            with span('bm25'):
+                lexical_ids = bm25_rank(conn, query, predicates, params, limit)
+            return _merge_ranks(title_ids, lexical_ids)[offset:limit]
+    if mode == 'hybrid':
+        candidates = max(hybrid_candidates, 2 * limit)
+        with span('bm25'):
+            lexical_ids = bm25_rank(conn, query, predicates, params, candidates)
+        vector_ids = _vector_rank(conn, query, category, genre, price_start, price_end, predicates, params, candidates, 0)
+        weight = default_lexical_weight if lexical_weight is None else lexical_weight
+        return reciprocal_rank_fusion(lexical_ids, vector_ids, weight)[offset:limit]
+    return _vector_rank(conn, query, category, genre, price_start, price_end, predicates, params, k, offset)
+
+
+def do_query_search(query: str, category: list[str] | None, genre: list[str] | None, price_start: int, price_end: int,
+                    k: int = 20, offset: int = 0, fields: list[str] | None = None, mode: str = 'semantic',
+                    lexical_weight: float | None = None) -> 'pd.DataFrame':
+    ids = rank_query_search(query, category, genre, price_start, price_end, k=k, offset=offset, mode=mode, lexical_weight=lexical_weight)
+    result = fetch_details(ids, fields)
+    # fetch_details times the query itself, the conversion is timed like the routes do
+    with span('serialize'):
+        return result.df()
+
+def rank_similar_search(app_id: int, category: list[str] | None, genre: list[str] | None, price_start: float, price_end: float,
+                        k: int = 20) -> list[int] | None:
+    predicates, params = build_filters(category, genre, price_start, price_end)
+    return similar_ids(get_cursor(), app_id, predicates, params, k)
+
+
+def _batch_facet_filter(conn, facet: str, column: str, searches: list[dict]) -> tuple[str, str, list]:
+    """
+    Columns of the batch CTE, predicate and params of one facet of the batch.
+    """
+    facet_ids = _facet_ids(conn, facet)
+    if facet_ids is None:
+        return (
+            f"UNNEST(?::VARCHAR[][]) AS {facet}",
+            f"(batch.{facet} IS NULL OR list_has_any(det.{column}, batch.{facet}))",
+            [[search[facet] or None for search in searches]],
+        )
+    masks = [facet_mask(facet_ids, search[facet]) if search[facet] else None for search in searches]
+    # the list holds only the values without a bit, an empty list matches nothing
+    return (
+        f"UNNEST(?::UBIGINT[]) AS {facet}, UNNEST(?::VARCHAR[][]) AS {facet}_unmapped",
+        f"(batch.{facet} IS NULL OR (det.{mask_columns[facet]} & batch.{facet}) != 0 "
+        f"OR list_has_any(det.{column}, batch.{facet}_unmapped))",
+        [[mask[0] if mask else None for mask in masks], [mask[1] if mask else [] for mask in masks]],
+    )
+
+
+def _exact_batch_search(conn, query_embeddings: list[list[float]], searches: list[dict], k: int) -> 'pd.DataFrame':
+    # every query of the batch is scored in the same scan, then the top k of each one is kept
+    category_columns, category_predicate, category_params = _batch_facet_filter(conn, 'category', 'categories', searches)
+    genre_columns, genre_predicate, genre_params = _batch_facet_filter(conn, 'genre', 'genres', searches)
+    sql_query = f"""
+        WITH batch AS (
+            SELECT
+                UNNEST(?::BIGINT[]) AS qid,
+                UNNEST(?::FLOAT[{model_size}][]) AS embedding,
+                UNNEST(?::DOUBLE[]) AS price_start,
+                UNNEST(?::DOUBLE[]) AS price_end,
+                {category_columns},
+                {genre_columns}
+        )
+        SELECT
+            batch.qid,
+            {select_columns()}
+        FROM batch
+        CROSS JOIN {embeddings_table_name} AS emb
+        INNER JOIN {table_name} AS det
+            ON emb.id = det.id
+        WHERE
+            det.price >= batch.price_start AND
+            det.price <= batch.price_end AND
+            {category_predicate} AND
+            {genre_predicate}
+        QUALIFY row_number() OVER (
+            PARTITION BY batch.qid
+            ORDER BY {distance_function}(emb.embedding, batch.embedding)
+        ) <= {int(k)}
+        ORDER BY batch.qid, {distance_function}(emb.embedding, batch.embedding)
+    """
+    params = [
+        list(range(len(searches))),
+        query_embeddings,
+        [search['price_start'] for search in searches],
+        [search['price_end'] for search in searches],
+        *category_params,
+        *genre_params,
+    ]
+    return conn.execute(sql_query, params).df()
+
+
+def do_batch_query_search(searches: list[dict], k: int = 20) -> list['pd.DataFrame']:
+    """
+    searches are dicts with the do_query_search arguments, results are returned in the same order.
+    All the texts are embedded in one request and all the queries are scored in one pass.
+    """
+    if not searches:
+        return []
+    query_embeddings = embed_queries_cached([search['query'] for search in searches])
+    conn = get_cursor()
+    if search_backend == 'numpy':
+        vector_engine.load(conn)
+        filters = [{key: search[key] for key in ('category', 'genre', 'price_start', 'price_end')} for search in searches]
+        results = vector_engine.search_many(query_embeddings, filters, k)
+        all_ids = sorted({app_id for ids, _ in results for app_id in ids.tolist()})
+        details = fetch_details(all_ids).df().set_index('id', drop=False)
+        return [details.loc[ids.tolist()].reset_index(drop=True) for ids, _ in results]
+    df = _exact_batch_search(conn, query_embeddings, searches, k)
+    groups = {qid: group.drop(columns='qid').reset_index(drop=True) for qid, group in df.groupby('qid')}
+    empty = df.drop(columns='qid').iloc[0:0]
+    return [groups.get(qid, empty) for qid in range(len(searches))]
+
+
+def do_index_status() -> list[dict]:
+    conn = get_cursor()
+    index_names = [embeddings_index_name]
+    if short_vector_dimensions(conn, embeddings_table_name):
+        index_names.append(f'{embeddings_table_name}_short_index')
+    return [index_status(conn, index_name) for index_name in index_names]
+
+
+def do_category_facets() -> list[dict]:
+    return facet_cache.get(get_cursor(), 'category')
+
+def do_genre_facets() -> list[dict]:
+    return facet_cache.get(get_cursor(), 'genre')
+
+def do_category_search() -> list[str]:
+    with span('facets'):
+        return [x['category'] for x in do_category_facets()]
+
+def do_genre_search() -> list[str]:
+    with span('facets'):
+        return [x['genre'] for x in do_genre_facets()]
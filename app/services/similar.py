@@ -0,0 +1,177 @@
+import os
+import duckdb
+import numpy as np
+from app.services.facets import facet_cache
+from app.services.index_manager import hnsw_metric
+from app.utils.logger import logger
+
+table_name = 'detail'
+neighbors_table_name = 'game_neighbors'
+neighbor_count = int(os.getenv('SIMILAR_NEIGHBORS', 50))
+block_size = int(os.getenv('SIMILAR_BLOCK_SIZE', 1024))
+
+
+def ensure_neighbors_table(conn: duckdb.DuckDBPyConnection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {neighbors_table_name} (
+            id BIGINT PRIMARY KEY,
+            neighbor_ids BIGINT[],
+            distances FLOAT[],
+            embedding_hash UBIGINT
+        );
+    """)
+
+
+def _load_vectors(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    total, dim = conn.execute(
+        f"SELECT COUNT(*), max(len(embedding)) FROM {embeddings_table_name}"
+    ).fetchone()
+    ids = np.empty(total, dtype=np.int64)
+    hashes = np.empty(total, dtype=np.uint64)
+    matrix = np.empty((total, dim or 0), dtype=np.float32)
+    reader = conn.execute(
+        f"SELECT CAST(id AS BIGINT) AS id, hash(embedding) AS embedding_hash, embedding FROM {embeddings_table_name} ORDER BY id"
+    ).fetch_record_batch(rows_per_batch=block_size)
+    offset = 0
+    for batch in reader:
+        size = batch.num_rows
+        ids[offset:offset + size] = batch.column('id').to_numpy()
+        hashes[offset:offset + size] = batch.column('embedding_hash').to_numpy()
+        matrix[offset:offset + size] = batch.column('embedding').flatten().to_numpy().reshape(size, dim)
+        offset += size
+    return ids, hashes, matrix
+
+
+def _distances(block: np.ndarray, matrix: np.ndarray, norms: np.ndarray, metric: str = hnsw_metric) -> np.ndarray:
+    """
+    Distances between the block rows and every game, by the same metric as the searches (HNSW_METRIC),
+    from the x.y scores and the |x|^2 norms.
+    """
+    scores = block @ matrix.T
+    block_norms = np.einsum('ij,ij->i', block, block)
+    if metric == 'cosine':
+        # array_cosine_distance
+        return 1 - scores / np.maximum(np.sqrt(norms)[None, :] * np.sqrt(block_norms)[:, None], 1e-12)
+    if metric == 'ip':
+        # array_negative_inner_product
+        return -scores
+    # array_distance
+    return np.sqrt(np.maximum(norms[None, :] - 2 * scores + block_norms[:, None], 0))
+
+
+def _nearest(rows: np.ndarray, ids: np.ndarray, matrix: np.ndarray, norms: np.ndarray, count: int) -> 'pd.DataFrame':
+    import pandas as pd
+    neighbor_ids, neighbor_distances = [], []
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        distances = _distances(matrix[block_rows], matrix, norms)
+        # a game is not its own neighbor
+        distances[np.arange(len(block_rows)), block_rows] = np.inf
+        top = min(count, len(ids) - 1)
+        if top <= 0:
+            neighbor_ids.extend([] for _ in block_rows)
+            neighbor_distances.extend([] for _ in block_rows)
+            continue
+        nearest = np.argpartition(distances, top - 1, axis=1)[:, :top]
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1, kind='stable')
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        nearest_distances = np.take_along_axis(nearest_distances, order, axis=1)
+        neighbor_ids.extend(ids[nearest].tolist())
+        neighbor_distances.extend(nearest_distances.tolist())
+    return pd.DataFrame({'id': ids[rows], 'neighbor_ids': neighbor_ids, 'distances': neighbor_distances})
+
+
+def refresh_neighbors(conn: duckdb.DuckDBPyConnection, embeddings_table_name: str, count: int = neighbor_count,
+                      full: bool = False) -> int:
+    """
+    Recomputes the neighbor lists of the games whose embedding changed, and of the games whose list
+    could change because of them (a changed or removed game was in it, or a changed game is now closer
+    than its last neighbor). Returns the number of refreshed games.
+    """
+    ensure_neighbors_table(conn)
+    ids, hashes, matrix = _load_vectors(conn, embeddings_table_name)
+    norms = np.einsum('ij,ij->i', matrix, matrix)
+    stored = conn.execute(
+        f"SELECT id, embedding_hash, neighbor_ids, distances FROM {neighbors_table_name}"
+    ).fetchall()
+    stored_hashes = {row[0]: row[1] for row in stored}
+    if full or len(stored) == 0:
+        rows = np.arange(len(ids))
+        removed = list(stored_hashes)
+    else:
+        positions = {app_id: position for position, app_id in enumerate(ids.tolist())}
+        changed_rows = np.array(
+            [position for position, (app_id, embedding_hash) in enumerate(zip(ids.tolist(), hashes.tolist()))
+             if stored_hashes.get(app_id) != embedding_hash],
+            dtype=np.int64
+        )
+        removed = [app_id for app_id in stored_hashes if app_id not in positions]
+        stale = set(ids[changed_rows].tolist()) | set(removed)
+        affected = np.zeros(len(ids), dtype=bool)
+        affected[changed_rows] = True
+        worst = np.full(len(ids), np.inf, dtype=np.float32)
+        for app_id, _, neighbor_ids, distances in stored:
+            position = positions.get(app_id)
+            if position is None:
+                continue
+            if stale.intersection(neighbor_ids or []):
+                affected[position] = True
+            elif distances and len(distances) >= min(count, len(ids) - 1):
+                worst[position] = distances[-1]
+        for start in range(0, len(changed_rows), block_size):
+            block = matrix[changed_rows[start:start + block_size]]
+            closest = _distances(block, matrix, norms).min(axis=0)
+            affected |= closest < worst
+        rows = np.flatnonzero(affected)
+    logger.info(f"Refreshing the neighbors of {len(rows)} games and removing {len(removed)}.")
+    df = _nearest(rows, ids, matrix, norms, count)
+    df['embedding_hash'] = hashes[rows]
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute(
+            f"DELETE FROM {neighbors_table_name} WHERE id IN (SELECT UNNEST(?::BIGINT[]))",
+            [ids[rows].tolist() + removed]
+        )
+        conn.execute(f"INSERT INTO {neighbors_table_name} SELECT id, neighbor_ids, distances, embedding_hash FROM df")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(rows)
+
+
+def similar_ids(conn: duckdb.DuckDBPyConnection, app_id: int, predicates: list[str], params: list, k: int) -> list[int] | None:
+    """
+    Precomputed neighbors of a game that pass the filters, None when the game doesnt exist.
+    A game without a neighbor list yet (no embedding, or the table wasnt refreshed) has no neighbors.
+    """
+    row = None
+    if facet_cache.has_table(conn, neighbors_table_name):
+        row = conn.execute(
+            f"SELECT neighbor_ids FROM {neighbors_table_name} WHERE id = ?", [app_id]
+        ).fetchone()
+    if row is None:
+        exists = conn.execute(f"SELECT 1 FROM {table_name} WHERE id = ?", [app_id]).fetchone()
+        return [] if exists else None
+    sql_query = f"""
+        SELECT det.id
+        FROM {table_name} AS det
+        WHERE
+            det.id IN (SELECT UNNEST(?::BIGINT[])) AND
+            {' AND '.join(predicates)}
+        ORDER BY list_position(?::BIGINT[], det.id)
+        LIMIT {int(k)}
+    """
+    return [r[0] for r in conn.execute(sql_query, [row[0]] + params + [row[0]]).fetchall()]
+
+
+if __name__ == "__main__":
+    import argparse
+    from app.db.connection import get_write_cursor
+    from app.services.embedder import embeddings_table_name
+    parser = argparse.ArgumentParser(description="Refreshes the precomputed similar games.")
+    parser.add_argument('--full', action='store_true', help="recompute every game instead of the changed ones")
+    parser.add_argument('--neighbors', type=int, default=neighbor_count)
+    args = parser.parse_args()
+    refresh_neighbors(get_write_cursor(), embeddings_table_name, args.neighbors, args.full)
@@ -10,6 +10,9 @@ import swifter
 import time
 from app.db import db_path, bronze_path, silver_path, base_path
 from app.db.setup import engine
+from app.services.bitmasks import rebuild_bitmasks
+from app.services.facets import rebuild_facets
+from app.services.lexical import rebuild_fts_index, rebuild_title_index
 import json
 from uuid import uuid4
 engine.dispose()
@@ -221,6 +224,10 @@ WHERE TYPE = 'game'
             SELECT * FROM df
             """
         )
+        rebuild_bitmasks(conn)
+        rebuild_fts_index(conn)
+        rebuild_title_index(conn)
+        rebuild_facets(conn)
         conn.commit()
     pass
 
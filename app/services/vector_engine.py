@@ -0,0 +1,243 @@
+import json
+import os
+import threading
+import duckdb
+import numpy as np
+from app.db import vectors_path
+from app.db.version import get_dataset_version
+from app.services.index_manager import hnsw_metric
+from app.services.quantization import quantize_int8, rerank_candidates
+from app.utils.logger import logger
+
+table_name = 'detail'
+block_size = 65536
+
+
+class VectorEngine:
+    """
+    Exact in-process vector search over a memory-mapped copy of the embedding table.
+    The matrix is exported once per dataset version, every worker maps the same pages.
+    Genre/category filters are precomputed boolean columns aligned with the matrix rows.
+    float16 and int8 matrices are scanned first and their shortlist is reranked with the float32 copy,
+    whose pages are only read for the shortlisted rows.
+    Games are ranked and their distances reported like the duckdb distance function of the HNSW metric.
+    """
+
+    def __init__(self, embeddings_table_name: str, dtype: str = 'float32', path: str = vectors_path,
+                 metric: str = hnsw_metric):
+        if dtype not in ('float32', 'float16', 'int8'):
+            raise ValueError(f"Unsupported vector dtype {dtype}.")
+        if metric not in ('l2sq', 'cosine', 'ip'):
+            raise ValueError(f"Unsupported metric {metric}.")
+        self.embeddings_table_name = embeddings_table_name
+        self.dtype = dtype
+        self.metric = metric
+        self.path = path
+        self.version = None
+        self._lock = threading.Lock()
+        self.ids = None
+        self.matrix = None
+        self.full_matrix = None
+        self.scales = None
+        self.norms = None
+        self.prices = None
+        self.genre_masks = None
+        self.category_masks = None
+        self.genre_vocab = {}
+        self.category_vocab = {}
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, f"{self.embeddings_table_name}.{name}")
+
+    def _read_meta(self) -> dict | None:
+        try:
+            with open(self._file('meta.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def export(self, conn: duckdb.DuckDBPyConnection):
+        version = get_dataset_version(conn)
+        total, dim = conn.execute(
+            f"SELECT COUNT(*), max(len(embedding)) FROM {self.embeddings_table_name}"
+        ).fetchone()
+        logger.info(f"Exporting {total} vectors from {self.embeddings_table_name} to {self.path}.")
+        dim = dim or 0
+        suffix = f".{os.getpid()}.tmp"
+        matrix = np.lib.format.open_memmap(self._file('float32.npy') + suffix, mode='w+', dtype=np.float32, shape=(total, dim))
+        ids = np.empty(total, dtype=np.int64)
+        reader = conn.execute(
+            f"SELECT CAST(id AS BIGINT) AS id, embedding FROM {self.embeddings_table_name} ORDER BY id"
+        ).fetch_record_batch(rows_per_batch=block_size // 8)
+        offset = 0
+        for batch in reader:
+            size = batch.num_rows
+            ids[offset:offset + size] = batch.column('id').to_numpy()
+            matrix[offset:offset + size] = batch.column('embedding').flatten().to_numpy().reshape(size, dim)
+            offset += size
+        matrix.flush()
+        if self.dtype != 'float32':
+            compact = np.lib.format.open_memmap(self._file(f'{self.dtype}.npy') + suffix, mode='w+', dtype=self.dtype, shape=(total, dim))
+            scales = np.ones(total, dtype=np.float32)
+            for start in range(0, total, block_size):
+                block = matrix[start:start + block_size]
+                if self.dtype == 'int8':
+                    compact[start:start + block_size], scales[start:start + block_size] = quantize_int8(block)
+                else:
+                    compact[start:start + block_size] = block
+            compact.flush()
+            del compact
+            np.save(self._file('scales.npy') + suffix, scales)
+            os.replace(self._file('scales.npy') + suffix + '.npy', self._file('scales.npy'))
+        del matrix
+
+        rows = {
+            row[0]: row[1:] for row in conn.execute(
+                f"SELECT CAST(id AS BIGINT), price, genres, categories FROM {table_name}"
+            ).fetchall()
+        }
+        details = [rows.get(app_id, (None, None, None)) for app_id in ids.tolist()]
+        prices = np.array([np.nan if price is None else price for price, _, _ in details], dtype=np.float64)
+        genre_vocab = sorted({genre for _, genres, _ in details for genre in genres or []})
+        category_vocab = sorted({category for _, _, categories in details for category in categories or []})
+        genre_masks = np.zeros((len(genre_vocab), total), dtype=bool)
+        category_masks = np.zeros((len(category_vocab), total), dtype=bool)
+        genre_index = {genre: i for i, genre in enumerate(genre_vocab)}
+        category_index = {category: i for i, category in enumerate(category_vocab)}
+        for row, (_, genres, categories) in enumerate(details):
+            for genre in genres or []:
+                genre_masks[genre_index[genre], row] = True
+            for category in categories or []:
+                category_masks[category_index[category], row] = True
+
+        for name, array in (('ids.npy', ids), ('prices.npy', prices), ('genres.npy', genre_masks), ('categories.npy', category_masks)):
+            np.save(self._file(name) + suffix, array)
+            os.replace(self._file(name) + suffix + '.npy', self._file(name))
+        os.replace(self._file('float32.npy') + suffix, self._file('float32.npy'))
+        if self.dtype != 'float32':
+            os.replace(self._file(f'{self.dtype}.npy') + suffix, self._file(f'{self.dtype}.npy'))
+        meta = {'version': version, 'dtype': self.dtype, 'dim': dim, 'total': total,
+                'genres': genre_vocab, 'categories': category_vocab}
+        with open(self._file('meta.json') + suffix, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(self._file('meta.json') + suffix, self._file('meta.json'))
+
+    def load(self, conn: duckdb.DuckDBPyConnection):
+        version = get_dataset_version(conn)
+        with self._lock:
+            if self.version == version:
+                return
+            meta = self._read_meta()
+            if (not meta or meta['version'] != version or meta['dtype'] != self.dtype
+                    or not os.path.exists(self._file('float32.npy'))):
+                self.export(conn)
+                meta = self._read_meta()
+            self.full_matrix = np.load(self._file('float32.npy'), mmap_mode='r')
+            self.matrix = np.load(self._file(f'{self.dtype}.npy'), mmap_mode='r')
+            self.scales = np.load(self._file('scales.npy')) if self.dtype != 'float32' else None
+            self.ids = np.load(self._file('ids.npy'))
+            self.prices = np.load(self._file('prices.npy'))
+            self.genre_masks = np.load(self._file('genres.npy'), mmap_mode='r')
+            self.category_masks = np.load(self._file('categories.npy'), mmap_mode='r')
+            self.genre_vocab = {genre: i for i, genre in enumerate(meta['genres'])}
+            self.category_vocab = {category: i for i, category in enumerate(meta['categories'])}
+            self.norms = self._squared_norms()
+            self.version = version
+            logger.info(f"Loaded {len(self.ids)} vectors ({self.dtype}) for dataset version {version}.")
+
+    def _squared_norms(self) -> np.ndarray:
+        norms = np.empty(len(self.matrix), dtype=np.float32)
+        for start in range(0, len(self.matrix), block_size):
+            block = np.asarray(self.matrix[start:start + block_size], dtype=np.float32)
+            norms[start:start + block_size] = np.einsum('ij,ij->i', block, block)
+        # int8 rows are codes times their scale
+        return norms * self.scales ** 2 if self.dtype == 'int8' else norms
+
+    def _any_mask(self, masks: np.ndarray, vocab: dict, values: list[str]) -> np.ndarray:
+        rows = [vocab[value] for value in values if value in vocab]
+        if not rows:
+            return np.zeros(masks.shape[1], dtype=bool)
+        return np.any(masks[rows], axis=0)
+
+    def filter_mask(self, category: list[str] | None, genre: list[str] | None, price_start: float, price_end: float) -> np.ndarray:
+        with np.errstate(invalid='ignore'):
+            mask = (self.prices >= price_start) & (self.prices <= price_end)
+        if category:
+            mask &= self._any_mask(self.category_masks, self.category_vocab, category)
+        if genre:
+            mask &= self._any_mask(self.genre_masks, self.genre_vocab, genre)
+        return mask
+
+    def scores(self, query_embeddings: np.ndarray) -> np.ndarray:
+        if self.matrix.dtype == np.float32:
+            return self.matrix @ query_embeddings.T
+        scores = np.empty((len(self.matrix), len(query_embeddings)), dtype=np.float32)
+        for start in range(0, len(self.matrix), block_size):
+            block = np.asarray(self.matrix[start:start + block_size], dtype=np.float32)
+            scores[start:start + block_size] = block @ query_embeddings.T
+        return scores * self.scales[:, None] if self.dtype == 'int8' else scores
+
+    def _rank_distances(self, scores: np.ndarray, norms: np.ndarray, query_norm: float) -> np.ndarray:
+        """
+        Distances that rank like the distance function, from the x.q scores and the |x|^2 norms.
+        l2 leaves out the constant |q|^2 term and the square root, _distances adds them back.
+        """
+        if self.metric == 'cosine':
+            # array_cosine_distance
+            return 1 - scores / np.maximum(np.sqrt(norms) * np.sqrt(query_norm), 1e-12)
+        if self.metric == 'ip':
+            # array_negative_inner_product
+            return -scores
+        return norms - 2 * scores
+
+    def _distances(self, distances: np.ndarray, query_norm: float) -> np.ndarray:
+        if self.metric == 'l2sq':
+            # array_distance
+            return np.sqrt(np.maximum(distances + query_norm, 0))
+        return distances
+
+    def search_many(self, query_embeddings: list[list[float]], filters: list[dict], k: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Scores every query with a single matrix product, filters are dicts with the do_query_search filter arguments.
+        """
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32).reshape(len(filters), -1)
+        scores = self.scores(query_embeddings)
+        results = []
+        for column, query_filter in enumerate(filters):
+            query_norm = float(query_embeddings[column] @ query_embeddings[column])
+            distances = self._rank_distances(scores[:, column], self.norms, query_norm)
+            distances[~self.filter_mask(**query_filter)] = np.inf
+            if self.dtype != 'float32':
+                distances = self._rerank(distances, query_embeddings[column], query_norm, k)
+            top_k = min(k, len(distances))
+            if top_k == 0:
+                results.append((self.ids[:0], distances[:0]))
+                continue
+            top = np.argpartition(distances, top_k - 1)[:top_k]
+            top = top[np.argsort(distances[top], kind='stable')]
+            top = top[np.isfinite(distances[top])]
+            results.append((self.ids[top], self._distances(distances[top], query_norm)))
+        return results
+
+    def _rerank(self, distances: np.ndarray, query_embedding: np.ndarray, query_norm: float, k: int) -> np.ndarray:
+        # the approximate distances only pick the shortlist, its rows get their distance from the float32 copy
+        shortlist = min(max(rerank_candidates, k), len(distances))
+        if shortlist == 0:
+            return distances
+        rows = np.sort(np.argpartition(distances, shortlist - 1)[:shortlist])
+        rows = rows[np.isfinite(distances[rows])]
+        block = np.asarray(self.full_matrix[rows], dtype=np.float32)
+        exact = np.full(len(distances), np.inf, dtype=np.float32)
+        exact[rows] = self._rank_distances(block @ query_embedding, np.einsum('ij,ij->i', block, block), query_norm)
+        return exact
+
+    def search(self, query_embedding: list[float], category: list[str] | None, genre: list[str] | None,
+               price_start: float, price_end: float, k: int) -> tuple[np.ndarray, np.ndarray]:
+        query_filter = {'category': category, 'genre': genre, 'price_start': price_start, 'price_end': price_end}
+        return self.search_many([query_embedding], [query_filter], k)[0]
+
+
+if __name__ == "__main__":
+    from app.db.connection import get_cursor
+    from app.services.embedder import embeddings_table_name
+    VectorEngine(embeddings_table_name, dtype=os.getenv('VECTOR_ENGINE_DTYPE', 'float32')).export(get_cursor())
@@ -0,0 +1,161 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+prometheus_mimetype = 'text/plain; version=0.0.4; charset=utf-8'
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            lines += [f'{self.name}{_labels(self.labelnames, labels)} {value}' for labels, value in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = latency_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            entry = self._values.setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_labels(names, labels + (bound,))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{_labels(names, labels + ("+Inf",))} {count}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Gauge:
+    """
+    Read when the metrics are rendered, collect returns {labels: value}.
+    """
+
+    def __init__(self, name: str, help: str, collect: Callable[[], dict[tuple, float]], labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        lines += [f'{self.name}{_labels(self.labelnames, labels)} {value}' for labels, value in sorted(self.collect().items())]
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        token = _scrape.set({})
+        try:
+            return '\n'.join(line for metric in self._metrics for line in metric.render()) + '\n'
+        finally:
+            _scrape.reset(token)
+
+
+_scrape: contextvars.ContextVar[dict | None] = contextvars.ContextVar('metrics_scrape', default=None)
+
+
+def per_scrape(collect: Callable[[], Any]) -> Callable[[], Any]:
+    """
+    Wraps a function read by several gauges, so it runs once per render instead of once per gauge.
+    """
+    def cached():
+        results = _scrape.get()
+        if results is None:
+            return collect()
+        if collect not in results:
+            results[collect] = collect()
+        return results[collect]
+    return cached
+
+
+registry = Registry()
+stage_seconds = registry.register(Histogram(
+    'search_stage_duration_seconds', 'Time spent in each stage of a search.', ('stage',)
+))
+request_seconds = registry.register(Histogram(
+    'search_request_duration_seconds', 'End to end time of the search endpoints.', ('endpoint',)
+))
+rows_scanned = registry.register(Counter(
+    'search_rows_scanned_total', 'Vector rows compared against the query, by strategy.', ('strategy',)
+))
+errors = registry.register(Counter(
+    'search_errors_total', 'Failed requests, by endpoint.', ('endpoint',)
+))
+
+_timings: contextvars.ContextVar[list | None] = contextvars.ContextVar('search_timings', default=None)
+
+
+def start_timings() -> list:
+    """
+    Starts collecting the spans of the current request, threads started with a copy of the
+    context (asyncio.to_thread) append to the same list.
+    """
+    timings = []
+    _timings.set(timings)
+    return timings
+
+
+@contextmanager
+def span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stage_seconds.observe(duration, stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((stage, duration))
+
+
+def server_timing(timings: list) -> str:
+    totals = {}
+    for stage, duration in timings:
+        totals[stage] = totals.get(stage, 0.0) + duration
+    return ', '.join(f'{stage};dur={duration * 1000:.2f}' for stage, duration in totals.items())
@@ -0,0 +1,38 @@
+import json
+from typing import Iterator
+import pyarrow as pa
+
+ndjson_mimetype = 'application/x-ndjson'
+arrow_mimetype = 'application/vnd.apache.arrow.stream'
+
+
+def _to_json_value(value, data_type: pa.DataType):
+    # arrow hands maps back as lists of (key, value) tuples, the json responses use objects
+    if value is None:
+        return None
+    if pa.types.is_map(data_type):
+        return {key: _to_json_value(item, data_type.item_type) for key, item in value}
+    if pa.types.is_list(data_type) or pa.types.is_large_list(data_type) or pa.types.is_fixed_size_list(data_type):
+        return [_to_json_value(item, data_type.value_type) for item in value]
+    if pa.types.is_struct(data_type):
+        return {field.name: _to_json_value(value[field.name], field.type) for field in data_type}
+    return value
+
+
+def stream_ndjson(reader: pa.RecordBatchReader) -> Iterator[bytes]:
+    schema = reader.schema
+    for batch in reader:
+        lines = []
+        for row in batch.to_pylist():
+            record = {field.name: _to_json_value(row[field.name], field.type) for field in schema}
+            lines.append(json.dumps(record, default=str, ensure_ascii=False))
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def stream_arrow(reader: pa.RecordBatchReader) -> Iterator[bytes]:
+    # encapsulated ipc messages, so every batch is sent as soon as it is read
+    yield reader.schema.serialize().to_pybytes()
+    for batch in reader:
+        yield batch.serialize().to_pybytes()
+    yield b'\xff\xff\xff\xff\x00\x00\x00\x00'
@@ -0,0 +1,347 @@
+"""
+Search benchmark over synthetic catalogs.
+
+    python benchmark.py --rows 10000 100000 --output bench.json
+
+Every catalog size is generated once (detail + embedding table, HNSW, FTS and facets) and every
+backend/index configuration runs in its own process, because the search settings are read at import time,
+on a fresh copy of the catalog, because some of them add columns to it.
+Queries are embedded with the deterministic hashing backend, so no API key is needed and runs are comparable.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+
+default_workdir = os.path.join(os.path.dirname(__file__), 'app', 'db', 'db_files', 'benchmark')
+block_rows = 50000
+
+# share of steam games with each genre/category, games get each one independently
+genre_weights = {
+    'Indie': 0.65, 'Action': 0.40, 'Casual': 0.38, 'Adventure': 0.37, 'Simulation': 0.19, 'Strategy': 0.18,
+    'RPG': 0.17, 'Early Access': 0.12, 'Free to Play': 0.08, 'Sports': 0.05, 'Racing': 0.04,
+    'Massively Multiplayer': 0.03,
+}
+category_weights = {
+    'Single-player': 0.90, 'Steam Achievements': 0.45, 'Steam Cloud': 0.30, 'Full controller support': 0.20,
+    'Multi-player': 0.18, 'Partial Controller Support': 0.15, 'PvP': 0.10, 'Co-op': 0.09,
+    'Steam Trading Cards': 0.08, 'Online Co-op': 0.07, 'Shared/Split Screen': 0.05, 'VR Supported': 0.02,
+}
+free_share = 0.12
+
+configs = {
+    'duckdb-planner': {},
+    'duckdb-exact': {'SEARCH_EXACT_MAX_ROWS': str(10 ** 12)},
+    # the same exact scans filtered with list_has_any, to compare with the bitmask filters of duckdb-exact
+    'duckdb-exact-lists': {'SEARCH_EXACT_MAX_ROWS': str(10 ** 12), 'SEARCH_FACET_BITMASKS': 'false'},
+    'duckdb-exact-int8': {'SEARCH_EXACT_MAX_ROWS': str(10 ** 12), 'EMBEDDING_QUANTIZATION': 'int8'},
+    'duckdb-hnsw': {'SEARCH_EXACT_MAX_ROWS': '0', 'SEARCH_EXACT_MAX_SELECTIVITY': '0'},
+    # many threads scanning the index at once, it crashed the process before the scans were serialized
+    'duckdb-hnsw-concurrent': {'SEARCH_EXACT_MAX_ROWS': '0', 'SEARCH_EXACT_MAX_SELECTIVITY': '0', 'BENCHMARK_CONCURRENCY': '32'},
+    'duckdb-two-stage': {'SEARCH_EXACT_MAX_ROWS': '0', 'SEARCH_EXACT_MAX_SELECTIVITY': '0', 'SEARCH_COARSE_DIMENSIONS': None},
+    'numpy-float32': {'SEARCH_BACKEND': 'numpy', 'VECTOR_ENGINE_DTYPE': 'float32'},
+    'numpy-float16': {'SEARCH_BACKEND': 'numpy', 'VECTOR_ENGINE_DTYPE': 'float16'},
+    'numpy-int8': {'SEARCH_BACKEND': 'numpy', 'VECTOR_ENGINE_DTYPE': 'int8'},
+}
+
+filter_mixes = {
+    'none': {'category': None, 'genre': None, 'price_start': 0, 'price_end': 1000000},
+    'genre': {'category': None, 'genre': ['RPG'], 'price_start': 0, 'price_end': 1000000},
+    'genre_price': {'category': None, 'genre': ['Strategy', 'Simulation'], 'price_start': 0, 'price_end': 1999},
+    'narrow': {'category': ['VR Supported'], 'genre': ['Racing'], 'price_start': 0, 'price_end': 1000000},
+    # what the frontend sends when nothing is picked, every row passes but every value is checked
+    'all_facets': {'category': list(category_weights), 'genre': list(genre_weights), 'price_start': 0, 'price_end': 1000000},
+}
+
+query_words = (
+    'cozy farming space shooter roguelike deckbuilder open world survival crafting horror puzzle platformer '
+    'racing city builder tactical turn based story rich pixel art multiplayer co-op fantasy medieval sci-fi '
+    'zombies anime stealth sandbox strategy sports football retro arcade relaxing hard dark souls like'
+).split()
+
+
+def catalog_path(workdir: str, rows: int, dimension: int, seed: int) -> str:
+    return os.path.join(workdir, f'catalog_{rows}_{dimension}_{seed}.duckdb')
+
+
+def _multi_hot(rng: np.random.Generator, weights: dict, size: int) -> list[list[str]]:
+    names = list(weights)
+    picked = rng.random((size, len(names))) < np.array(list(weights.values()))
+    # every game has at least its most likely value
+    picked[~picked.any(axis=1), 0] = True
+    return [[names[i] for i in np.flatnonzero(row)] for row in picked]
+
+
+def generate_catalog(path: str, rows: int, dimension: int, seed: int):
+    from app.services.bitmasks import rebuild_bitmasks
+    from app.services.embedding_backends import HashingBackend, get_embeddings_table_name
+    from app.services.facets import rebuild_facets
+    from app.services.lexical import rebuild_fts_index, rebuild_title_index
+
+    embeddings_table_name = get_embeddings_table_name(HashingBackend(dimension))
+    rng = np.random.default_rng(seed)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    print(f"Generating {rows} games with {dimension} dimension vectors in {path}.", file=sys.stderr)
+    with duckdb.connect(tmp_path) as conn:
+        conn.execute("""
+            CREATE TABLE detail (
+                id BIGINT, name VARCHAR, is_free BOOLEAN, detailed_description VARCHAR, about_the_game VARCHAR,
+                short_description VARCHAR, supported_languages VARCHAR, image VARCHAR,
+                windows_req_rec MAP(VARCHAR, VARCHAR), windows_req_min MAP(VARCHAR, VARCHAR),
+                mac_req_rec MAP(VARCHAR, VARCHAR), mac_req_min MAP(VARCHAR, VARCHAR),
+                lin_req_rec MAP(VARCHAR, VARCHAR), lin_req_min MAP(VARCHAR, VARCHAR),
+                currency_cents VARCHAR, price BIGINT, categories VARCHAR[], genres VARCHAR[],
+                recommendations BIGINT, release_date VARCHAR[], extras VARCHAR[]
+            )
+        """)
+        conn.execute(f"""
+            CREATE TABLE {embeddings_table_name} (
+                id VARCHAR, name VARCHAR, text TEXT, embedding FLOAT[{dimension}]
+            )
+        """)
+        for start in range(0, rows, block_rows):
+            size = min(block_rows, rows - start)
+            ids = np.arange(start + 10, start + 10 + size, dtype=np.int64)
+            names = [f'Synthetic Game {app_id}' for app_id in ids.tolist()]
+            descriptions = [' '.join(rng.choice(query_words, 12).tolist()) for _ in range(size)]
+            free = rng.random(size) < free_share
+            prices = (np.round(np.exp(rng.normal(6.9, 0.9, size)) / 100) * 100 - 1).clip(99, 6999).astype(np.int64)
+            genres = _multi_hot(rng, genre_weights, size)
+            categories = _multi_hot(rng, category_weights, size)
+            recommendations = (rng.pareto(1.2, size) * 10).astype(np.int64)
+            vectors = rng.standard_normal((size, dimension), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            details = pa.table({
+                'id': ids,
+                'name': names,
+                'short_description': descriptions,
+                'price': pa.array(np.where(free, 0, prices), mask=free),
+                'genres': genres,
+                'categories': categories,
+                'recommendations': recommendations,
+            })
+            conn.execute("""
+                INSERT INTO detail (id, name, is_free, short_description, detailed_description, about_the_game, image, price, genres, categories, recommendations)
+                SELECT id, name, price IS NULL, short_description, short_description, short_description,
+                       'https://example.com/' || id || '.jpg', price, genres, categories, recommendations
+                FROM details
+            """)
+            embeddings = pa.table({
+                'id': [str(app_id) for app_id in ids.tolist()],
+                'name': names,
+                'text': descriptions,
+                'embedding': pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel()), dimension),
+            })
+            conn.execute(f"INSERT INTO {embeddings_table_name} SELECT * FROM embeddings")
+        conn.execute("INSTALL vss;")
+        conn.execute("LOAD vss;")
+        conn.execute("SET hnsw_enable_experimental_persistence = true;")
+        conn.execute(f"CREATE INDEX {embeddings_table_name}_index ON {embeddings_table_name} USING HNSW (embedding)")
+        # like generate_gold, the filters of the search path use the bitmask columns
+        rebuild_bitmasks(conn)
+        rebuild_fts_index(conn)
+        rebuild_title_index(conn)
+        rebuild_facets(conn)
+    os.replace(tmp_path, path)
+
+
+def _percentiles(latencies: list[float]) -> dict:
+    return {
+        f'p{p}_ms': round(float(np.percentile(latencies, p)) * 1000, 3) for p in (50, 95, 99)
+    }
+
+
+def _memory_mb() -> float | None:
+    # peak of this process only, on linux ru_maxrss keeps the peak of the parent that generated the catalog
+    try:
+        with open('/proc/self/status', 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_worker(queries: int, concurrency: int, k: int, seed: int) -> dict:
+    """
+    Runs inside a process configured through the environment, measures every filter mix.
+    """
+    from app.db.connection import get_write_cursor
+    from app.services.bitmasks import ensure_bitmasks
+    from app.services.embedder import embeddings_table_name, embed_query_cached
+    from app.services.matryoshka import coarse_dimensions, short_vector_dimensions, build_short_vectors
+    from app.services.quantization import quantization, quantized_dimensions, build_quantized, storage_report
+    from app.services.searcher import do_query_search, build_filters, _exact_rank
+    from app.utils.metrics import start_timings
+
+    concurrency = int(os.getenv('BENCHMARK_CONCURRENCY', concurrency))
+    # the worker builds the short and int8 vectors its configuration needs
+    conn = get_write_cursor()
+    # catalogs generated before the bitmasks were added get them here
+    ensure_bitmasks(conn)
+    if coarse_dimensions and short_vector_dimensions(conn, embeddings_table_name) != coarse_dimensions:
+        build_short_vectors(conn, embeddings_table_name, coarse_dimensions)
+    if quantization == 'int8' and not quantized_dimensions(conn, embeddings_table_name):
+        build_quantized(conn, embeddings_table_name)
+    rng = np.random.default_rng(seed)
+    texts = [' '.join(rng.choice(query_words, 3).tolist()) for _ in range(queries)]
+    results = {}
+    for mix, filters in filter_mixes.items():
+        for text in texts[:min(5, queries)]:
+            do_query_search(text, **filters, k=k, fields=['id'])
+        latencies, recalls = [], []
+        predicates, params = build_filters(filters['category'], filters['genre'], filters['price_start'], filters['price_end'])
+        for text in texts:
+            start = time.perf_counter()
+            found = do_query_search(text, **filters, k=k, fields=['id'])['id'].tolist()
+            latencies.append(time.perf_counter() - start)
+            expected = _exact_rank(conn, embed_query_cached(text), predicates, params, k, 0, quantized=False)
+            recalls.append(len(set(expected) & set(found)) / len(expected) if expected else 1.0)
+
+        def timed_search(text: str) -> dict:
+            timings = start_timings()
+            start = time.perf_counter()
+            do_query_search(text, **filters, k=k, fields=['id'])
+            stages = {'total': time.perf_counter() - start}
+            for stage, duration in timings:
+                stages[stage] = stages.get(stage, 0.0) + duration
+            return stages
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            stages = list(executor.map(timed_search, texts))
+        elapsed = time.perf_counter() - start
+        results[mix] = {
+            **_percentiles(latencies),
+            'qps': round(len(texts) / elapsed, 2),
+            f'recall@{k}': round(float(np.mean(recalls)), 4),
+        }
+        # index scans run one at a time per process, so under load part of the latency is the wait for the lock
+        scanned = [timing for timing in stages if 'hnsw_scan' in timing]
+        if scanned:
+            results[mix]['concurrent'] = {
+                'hnsw_wait': _percentiles([timing['hnsw_wait'] for timing in scanned]),
+                'hnsw_scan': _percentiles([timing['hnsw_scan'] for timing in scanned]),
+                'total': _percentiles([timing['total'] for timing in scanned]),
+                'hnsw_wait_share': round(sum(timing['hnsw_wait'] for timing in scanned) / sum(timing['total'] for timing in scanned), 3),
+            }
+    return {'memory_mb': _memory_mb(), 'storage': storage_report(conn, embeddings_table_name), 'mixes': results}
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__) or '.'
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the search path on synthetic catalogs.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000])
+    parser.add_argument('--dimension', type=int, default=256)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--configs', nargs='+', default=list(configs), choices=list(configs))
+    parser.add_argument('--workdir', default=default_workdir)
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--output', default=None, help="json file, printed to stdout when missing")
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.worker, 'w', encoding='utf-8') as f:
+            json.dump(run_worker(args.queries, args.concurrency, args.k, args.seed), f)
+        return 0
+
+    os.makedirs(args.workdir, exist_ok=True)
+    report = {
+        'commit': _commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'duckdb': duckdb.__version__,
+        'settings': {key: getattr(args, key) for key in ('dimension', 'queries', 'concurrency', 'k', 'seed')},
+        'results': [],
+    }
+    for rows in args.rows:
+        path = catalog_path(args.workdir, rows, args.dimension, args.seed)
+        if args.regenerate or not os.path.exists(path):
+            generate_catalog(path, rows, args.dimension, args.seed)
+        for name in args.configs:
+            env = {key: value or str(args.dimension // 4) for key, value in configs[name].items()}
+            # the worker adds the short, int8 and bitmask columns its configuration needs, on a copy, so every
+            # configuration starts from the generated catalog and the cached one is never changed
+            run_dir = tempfile.mkdtemp(prefix=f'{name}_{rows}_', dir=args.workdir)
+            run_path = os.path.join(run_dir, os.path.basename(path))
+            shutil.copy(path, run_path)
+            worker_env = {
+                **os.environ,
+                'STEAM_SEARCHER_DB': run_path,
+                'STEAM_SEARCHER_VECTORS': os.path.join(run_dir, 'vectors'),
+                'EMBEDDING_BACKEND': 'hashing',
+                'EMBEDDING_DIMENSIONS': str(args.dimension),
+                'SEARCH_TITLE_FAST_PATH': 'false',
+                'QUERY_CACHE_PERSISTENT': 'false',
+                'EMBEDDING_BATCH_WINDOW_MS': '0',
+                **env,
+            }
+            print(f"Running {name} on {rows} games.", file=sys.stderr)
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+                result_path = f.name
+            try:
+                process = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--worker', result_path,
+                     '--queries', str(args.queries), '--concurrency', str(args.concurrency),
+                     '--k', str(args.k), '--seed', str(args.seed)],
+                    env=worker_env, stdout=subprocess.DEVNULL
+                )
+                if process.returncode == 0:
+                    with open(result_path, 'r', encoding='utf-8') as f:
+                        result = json.load(f)
+                else:
+                    # a crashed configuration is reported, the other ones still run
+                    print(f"{name} on {rows} games exited with {process.returncode}.", file=sys.stderr)
+                    result = {'error': f'worker exited with {process.returncode}'}
+            finally:
+                os.remove(result_path)
+                shutil.rmtree(run_dir, ignore_errors=True)
+            report['results'].append({'rows': rows, 'config': name, 'env': env, **result})
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+    failed = [f"{result['config']} ({result['rows']} games)" for result in report['results'] if 'error' in result]
+    if failed:
+        # the report is still written, but a crashed configuration fails the run
+        print(f"Failed configurations: {', '.join(failed)}.", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
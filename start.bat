@@ -1,8 +1,9 @@
 @echo off
 rem
 call .venv\Scripts\activate
+python kaggle_collector.py
+python -m app.db.migrations
 start "" python run.py
-start "" python kaggle_collector.py
 
 rem
 timeout /t 3 /nobreak
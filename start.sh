@@ -4,6 +4,8 @@ source .venv/bin/activate
 echo "Updating database..."
 python kaggle_collector.py
 echo "Finished database update..."
+echo "Migrating database..."
+python -m app.db.migrations
 echo "Starting the backend-server..."
 python run.py &
 echo "Finished backend-server..."
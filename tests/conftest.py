@@ -0,0 +1,65 @@
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+# the app reads its settings when it is imported, so they are set before any test module imports it
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+data_path = tempfile.mkdtemp(prefix='steam-searcher-tests-')
+catalog_path = os.path.join(data_path, 'catalog.duckdb')
+catalog_rows = 600
+catalog_dimension = 32
+os.environ.update({
+    'STEAM_SEARCHER_DB': catalog_path,
+    'STEAM_SEARCHER_VECTORS': os.path.join(data_path, 'vectors'),
+    'EMBEDDING_BACKEND': 'hashing',
+    'EMBEDDING_DIMENSIONS': str(catalog_dimension),
+    'OPENAI_API_KEY': 'sk-test',
+    'DUCKDB_READ_ONLY': 'true',
+    'MIGRATE_ON_STARTUP': 'false',
+})
+
+
+@pytest.fixture(scope='session', autouse=True)
+def catalog():
+    """
+    Synthetic catalog shared by the tests, migrated like a real one. The api opens it read-only,
+    tests that write use writable_catalog.
+    """
+    import duckdb
+    from benchmark import generate_catalog
+    from app.db.connection import connection_manager
+    from app.db.migrations import migrate
+
+    generate_catalog(catalog_path, catalog_rows, catalog_dimension, seed=7)
+    with duckdb.connect(catalog_path) as conn:
+        migrate(conn)
+    yield catalog_path
+    from app.services.embedder import query_cache
+    # the atexit flush would run after the directory is gone
+    query_cache.flush()
+    connection_manager.close()
+    shutil.rmtree(data_path, ignore_errors=True)
+
+
+@pytest.fixture
+def writable_catalog(tmp_path):
+    """
+    Read-write connection to a copy of the catalog.
+    """
+    import duckdb
+    path = str(tmp_path / 'catalog.duckdb')
+    shutil.copy(catalog_path, path)
+    conn = duckdb.connect(path)
+    conn.execute("LOAD vss;")
+    conn.execute("SET hnsw_enable_experimental_persistence = true;")
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(scope='session')
+def client(catalog):
+    from app import create_app
+    return create_app().test_client()
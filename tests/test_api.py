@@ -0,0 +1,50 @@
+import asyncio
+import json
+import pytest
+
+
+@pytest.mark.parametrize('body, error', [
+    ({'query': 'space', 'price_start': 'abc'}, 'price_start must be a number.'),
+    ({'query': 'space', 'price_end': None}, 'price_end must be a number.'),
+    ({'query': 'space', 'price_end': True}, 'price_end must be a number.'),
+    ({'query': 'space', 'genre': 'RPG'}, 'genre must be a list of strings.'),
+    ({'query': 'space', 'category': [1, 2]}, 'category must be a list of strings.'),
+    ({'query': 'space', 'fields': 'name'}, 'fields must be a list of strings.'),
+    ({'query': ['space']}, 'query must be a string.'),
+    ({'query': 'space', 'k': 0}, 'k must be between 1 and 100.'),
+])
+def test_search_rejects_bad_types(client, body, error):
+    response = client.post('/api/search', json=body)
+    assert response.status_code == 400
+    assert response.get_json() == {'error': error}
+
+
+def test_search_accepts_numeric_strings_for_prices(client):
+    # the filter compares the stored price, in cents
+    response = client.post('/api/search', json={'query': 'space', 'price_start': '0', 'price_end': '1000', 'fields': ['id', 'price']})
+    assert response.status_code == 200
+    games = response.get_json()
+    assert games and all(0 <= game['price'] <= 10 for game in games)
+
+
+def test_batch_names_the_bad_query(client):
+    response = client.post('/api/search/batch', json={'queries': [{'query': 'space'}, {'query': 'farm', 'price_start': 'abc'}]})
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'queries[1]: price_start must be a number.'}
+
+
+def test_asgi_search_rejects_bad_price():
+    from app.asgi import create_asgi_app
+    asgi_app = create_asgi_app()
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': json.dumps({'query': 'space', 'price_start': 'abc'}).encode()}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'POST', 'path': '/api/search', 'headers': [], 'query_string': b''}
+    asyncio.run(asgi_app(scope, receive, send))
+    assert messages[0]['status'] == 400
+    assert json.loads(messages[1]['body']) == {'error': 'price_start must be a number.'}
@@ -0,0 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app.services.batcher import EmbeddingMicroBatcher
+
+
+def test_concurrent_queries_share_one_request():
+    requests = []
+
+    def embed_many(texts):
+        requests.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+    batcher = EmbeddingMicroBatcher(embed_many, window_ms=100, max_batch=64)
+    texts = ['a', 'bb', 'ccc', 'bb']
+    with ThreadPoolExecutor(max_workers=len(texts)) as executor:
+        vectors = list(executor.map(batcher.embed, texts))
+    assert vectors == [[1.0], [2.0], [3.0], [2.0]]
+    # duplicates are embedded once
+    assert len(requests) == 1 and sorted(requests[0]) == ['a', 'bb', 'ccc']
+    assert batcher.stats()['average_batch_size'] == 4
+
+
+def test_batches_stop_at_max_batch():
+    requests = []
+    batcher = EmbeddingMicroBatcher(lambda texts: requests.append(texts) or [[0.0]] * len(texts), window_ms=200, max_batch=2)
+    futures = [batcher.submit(str(i)) for i in range(5)]
+    assert [future.result(5) for future in futures] == [[0.0]] * 5
+    assert max(len(texts) for texts in requests) == 2
+
+
+def test_a_failed_request_fails_every_caller_of_the_batch():
+    def embed_many(texts):
+        raise RuntimeError('rate limited')
+
+    batcher = EmbeddingMicroBatcher(embed_many, window_ms=50)
+    futures = [batcher.submit(text) for text in ('a', 'b')]
+    for future in futures:
+        with pytest.raises(RuntimeError, match='rate limited'):
+            future.result(5)
@@ -0,0 +1,42 @@
+import pytest
+from app.db.connection import get_cursor
+from app.services import searcher
+from app.services.bitmasks import facet_mask
+from app.services.embedder import embed_query_cached
+
+filters = [
+    {'category': None, 'genre': ['RPG'], 'price_start': 0.0, 'price_end': 1000000.0},
+    {'category': ['Co-op', 'PvP'], 'genre': ['Action', 'Indie'], 'price_start': 0.0, 'price_end': 2000.0},
+    {'category': ['Not a category'], 'genre': None, 'price_start': 0.0, 'price_end': 1000000.0},
+]
+
+
+def test_facet_mask_ors_the_bits_and_keeps_the_values_without_one():
+    assert facet_mask({'RPG': 0, 'Indie': 3, 'Rare': None}, ['RPG', 'Indie', 'Rare', 'Missing']) == (0b1001, ['Rare'])
+
+
+@pytest.mark.parametrize('search', filters)
+def test_bitmask_filters_match_the_list_filters(monkeypatch, search):
+    query_embedding = embed_query_cached('space shooter')
+
+    def rank(bitmasks: bool) -> tuple[list[str], list[int]]:
+        monkeypatch.setattr(searcher, 'facet_bitmasks', bitmasks)
+        predicates, params = searcher.build_filters(search['category'], search['genre'], search['price_start'], search['price_end'])
+        return predicates, searcher._exact_rank(get_cursor(), query_embedding, predicates, params, 50, 0)
+
+    mask_predicates, mask_ids = rank(True)
+    list_predicates, list_ids = rank(False)
+    assert any('_mask' in predicate for predicate in mask_predicates)
+    assert not any('_mask' in predicate for predicate in list_predicates)
+    assert mask_ids == list_ids
+
+
+@pytest.mark.parametrize('bitmasks', [True, False])
+def test_batch_filters_follow_the_bitmask_setting(monkeypatch, bitmasks):
+    monkeypatch.setattr(searcher, 'facet_bitmasks', bitmasks)
+    _, predicate, _ = searcher._batch_facet_filter(get_cursor(), 'genre', 'genres', [dict(search, query='space') for search in filters])
+    assert ('_mask' in predicate) == bitmasks
+    searches = [dict(search, query='space shooter') for search in filters]
+    batch = searcher.do_batch_query_search(searches, k=10)
+    for search, df in zip(searches, batch):
+        assert df['id'].tolist() == searcher.rank_query_search(**search, k=10)
@@ -0,0 +1,53 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.db.connection import ConnectionManager, hnsw_scan
+from app.utils.metrics import start_timings
+
+
+def test_each_thread_reuses_its_own_cursor(catalog):
+    manager = ConnectionManager(catalog, read_only=True)
+    try:
+        assert manager.cursor() is manager.cursor()
+        other = []
+        thread = threading.Thread(target=lambda: other.append(manager.cursor()))
+        thread.start()
+        thread.join()
+        assert other[0] is not manager.cursor()
+        assert manager.cursor().execute("SELECT COUNT(*) FROM detail").fetchone()[0] > 0
+    finally:
+        manager.close()
+
+
+def test_read_write_is_refused_once_open_read_only(catalog):
+    manager = ConnectionManager(catalog, read_only=True)
+    try:
+        manager.cursor()
+        try:
+            manager.use_read_write()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('use_read_write should fail on an open read-only connection')
+    finally:
+        manager.close()
+
+
+def test_hnsw_scans_run_one_at_a_time_and_report_the_wait():
+    active, overlaps = [], []
+
+    def scan():
+        timings = start_timings()
+        with hnsw_scan():
+            active.append(1)
+            overlaps.append(len(active))
+            time.sleep(0.02)
+            active.pop()
+        return dict(timings)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        stages = list(executor.map(lambda _: scan(), range(4)))
+    assert max(overlaps) == 1
+    assert all({'hnsw_wait', 'hnsw_scan'} <= set(timing) for timing in stages)
+    # the last scan to get the lock waited for the three before it
+    assert max(timing['hnsw_wait'] for timing in stages) >= 0.05
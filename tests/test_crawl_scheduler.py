@@ -0,0 +1,101 @@
+import asyncio
+import time
+import aiohttp
+import pytest
+from app.crawlers import scheduler as scheduler_module
+from app.crawlers.scheduler import AdaptiveConcurrency, CrawlScheduler, TokenBucket, backoff_delay, is_throttled, retry_after
+
+
+def throttled_error(retry_after_value: str | None = None) -> aiohttp.ClientResponseError:
+    headers = {'Retry-After': retry_after_value} if retry_after_value else None
+    return aiohttp.ClientResponseError(None, (), status=429, headers=headers)
+
+
+def crawl(scheduler: CrawlScheduler, items, fetch) -> dict:
+    done = {}
+    asyncio.run(scheduler.run(items, fetch, lambda item, result, error: done.__setitem__(item, (result, error))))
+    return done
+
+
+def test_every_item_is_done_once_and_failures_are_retried(monkeypatch):
+    tries = {}
+
+    async def fetch(item):
+        tries[item] = tries.get(item, 0) + 1
+        if item == 'flaky' and tries[item] < 3:
+            raise throttled_error()
+        if item == 'broken':
+            raise ValueError('bad json')
+        return item.upper()
+
+    # retries are requeued after their backoff, the test doesnt wait for it
+    monkeypatch.setattr(scheduler_module, 'backoff_delay', lambda attempt, error: 0.0)
+    scheduler = CrawlScheduler(TokenBucket(rate=0), AdaptiveConcurrency(initial=4, maximum=4), max_tries=3)
+    done = crawl(scheduler, ['a', 'flaky', 'broken', 'b'], fetch)
+    assert done['a'] == ('A', None) and done['b'] == ('B', None) and done['flaky'] == ('FLAKY', None)
+    assert isinstance(done['broken'][1], ValueError)
+    assert tries == {'a': 1, 'flaky': 3, 'b': 1, 'broken': 3}
+    assert scheduler.stats == {'requests': 8, 'throttled': 2, 'retries': 4, 'failed': 1}
+
+
+def test_concurrency_never_exceeds_the_limit_and_halves_on_throttling():
+    in_flight, peak = 0, 0
+
+    async def fetch(item):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.005)
+        in_flight -= 1
+        if item == 0:
+            raise throttled_error()
+        return item
+
+    concurrency = AdaptiveConcurrency(initial=8, maximum=8)
+    crawl(CrawlScheduler(TokenBucket(rate=0), concurrency, max_tries=1), range(12), fetch)
+    assert peak <= 8
+    # one 429 halved it, the successes after it grew it back by about one slot per round
+    assert 4 <= concurrency.limit < 8
+
+
+def test_a_burst_of_throttled_requests_decreases_once():
+    async def main():
+        concurrency = AdaptiveConcurrency(initial=8, maximum=8)
+        started = time.monotonic()
+        for _ in range(8):
+            await concurrency.acquire()
+        for _ in range(8):
+            await concurrency.release(started, True)
+        return concurrency.limit
+
+    assert asyncio.run(main()) == 4
+
+
+def test_token_bucket_holds_the_rate():
+    async def main():
+        bucket = TokenBucket(rate=100, burst=1)
+        start = time.monotonic()
+        for _ in range(11):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) >= 0.09
+
+
+def test_retry_after_pauses_and_bounds_the_backoff():
+    assert retry_after(throttled_error('3')) == 3.0
+    assert retry_after(throttled_error('Wed, 21 Oct 2015 07:28:00 GMT')) == 0.0
+    assert retry_after(ValueError()) is None
+    assert all(backoff_delay(0, throttled_error('2'), base=1, maximum=120) >= 2 for _ in range(20))
+    assert all(backoff_delay(10, ValueError(), base=1, maximum=5) <= 5 for _ in range(20))
+
+
+@pytest.mark.parametrize('error, throttled', [
+    (throttled_error(), True),
+    (aiohttp.ClientResponseError(None, (), status=503), True),
+    (aiohttp.ClientResponseError(None, (), status=404), None),
+    (asyncio.TimeoutError(), True),
+    (ValueError(), None),
+])
+def test_only_load_errors_count_as_throttling(error, throttled):
+    assert is_throttled(error) is throttled
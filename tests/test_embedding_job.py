@@ -0,0 +1,64 @@
+from app.services.embedding_backends import HashingBackend
+from app.services.embedder import embeddings_table_name
+from app.services.embedding_job import RateBudget, run_embedding_job
+from conftest import catalog_dimension
+
+
+class CountingBackend(HashingBackend):
+    def __init__(self, dimension: int):
+        super().__init__(dimension)
+        self.texts = []
+
+    def embed_documents(self, texts, chunk_size=None):
+        self.texts.extend(texts)
+        return super().embed_documents(texts, chunk_size)
+
+
+def run(conn) -> tuple[dict, list[str]]:
+    backend = CountingBackend(catalog_dimension)
+    report = run_embedding_job(conn, backend, 'detail', embeddings_table_name, budget=RateBudget(0, 0))
+    return report, backend.texts
+
+
+def vectors(conn, ids: list[int]) -> list:
+    return [row[0] for row in conn.execute(
+        f"SELECT embedding FROM {embeddings_table_name} WHERE id IN (SELECT CAST(UNNEST(?::BIGINT[]) AS VARCHAR)) ORDER BY id", [ids]
+    ).fetchall()]
+
+
+def some_ids(conn, count: int) -> list[int]:
+    return [row[0] for row in conn.execute(f"SELECT id FROM detail ORDER BY id LIMIT {count}").fetchall()]
+
+
+def test_only_changed_texts_are_embedded_and_each_text_once(writable_catalog):
+    conn = writable_catalog
+    run(conn)
+    edited, *same_text = some_ids(conn, 4)
+    report, texts = run(conn)
+    assert report['pending'] == 0 and texts == []
+    # whitespace only edits keep the hash
+    conn.execute("UPDATE detail SET short_description = '  ' || short_description || '  ' WHERE id = ?", [edited])
+    # three games get the same new text
+    conn.execute("""
+        UPDATE detail SET short_description = 'a brand new cozy farming story', detailed_description = NULL, about_the_game = NULL
+        WHERE id IN (SELECT UNNEST(?::BIGINT[]))
+    """, [same_text])
+    report, texts = run(conn)
+    assert report['pending'] == 3
+    assert len(texts) == 1 and 'a brand new cozy farming story' in texts[0]
+    assert report['deduplicated'] == 2
+    first, *others = vectors(conn, same_text)
+    assert all(vector == first for vector in others)
+
+
+def test_a_text_already_embedded_is_reused_without_a_request(writable_catalog):
+    conn = writable_catalog
+    run(conn)
+    [original] = some_ids(conn, 1)
+    conn.execute("""
+        INSERT INTO detail BY NAME
+        SELECT * REPLACE (10000000 AS id, 'A copy' AS name) FROM detail WHERE id = ?
+    """, [original])
+    report, texts = run(conn)
+    assert report['pending'] == 1 and texts == []
+    assert vectors(conn, [original]) == vectors(conn, [10000000])
@@ -0,0 +1,45 @@
+import time
+from app.db.version import bump_dataset_version, dataset_version_table_name
+from app.services import facets
+from app.services.facets import FacetCache
+
+
+def count_version_reads(monkeypatch) -> list:
+    reads = []
+    get_dataset_version = facets.get_dataset_version
+
+    def counted(conn):
+        reads.append(1)
+        return get_dataset_version(conn)
+
+    monkeypatch.setattr(facets, 'get_dataset_version', counted)
+    return reads
+
+
+def test_version_is_read_once_per_ttl(monkeypatch, writable_catalog):
+    reads = count_version_reads(monkeypatch)
+    cache = FacetCache(version_ttl=60)
+    for _ in range(10):
+        cache.get(writable_catalog, 'genre')
+        cache.stats(writable_catalog)
+        cache.row_count(writable_catalog, 'detail')
+    assert len(reads) == 1
+
+
+def test_a_bump_from_this_process_is_seen_at_once(writable_catalog):
+    cache = FacetCache(version_ttl=60)
+    total = cache.stats(writable_catalog)['total']
+    writable_catalog.execute("DELETE FROM detail WHERE id IN (SELECT id FROM detail LIMIT 10)")
+    bump_dataset_version(writable_catalog)
+    assert cache.stats(writable_catalog)['total'] == total - 10
+
+
+def test_a_bump_from_another_process_is_seen_after_the_ttl(writable_catalog):
+    cache = FacetCache(version_ttl=0.2)
+    total = cache.stats(writable_catalog)['total']
+    # what another process running the pipeline leaves behind, without touching this process' bump count
+    writable_catalog.execute("DELETE FROM detail WHERE id IN (SELECT id FROM detail LIMIT 10)")
+    writable_catalog.execute(f"UPDATE {dataset_version_table_name} SET version = version + 1")
+    assert cache.stats(writable_catalog)['total'] == total
+    time.sleep(0.25)
+    assert cache.stats(writable_catalog)['total'] == total - 10
@@ -0,0 +1,31 @@
+import json
+import os
+import subprocess
+import sys
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# a worker has to boot in well under a second, the budget leaves room for slow ci machines
+import_budget_seconds = float(os.getenv('IMPORT_TIME_BUDGET', 1.5))
+heavy_modules = ('pandas', 'langchain', 'langchain_openai', 'sqlalchemy')
+
+probe = """
+import json, sys, time
+start = time.perf_counter()
+import app.routes.api
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': sorted(sys.modules)}))
+"""
+
+
+def test_api_import_is_fast_and_side_effect_free(tmp_path):
+    db_path = tmp_path / 'steam-searcher.duckdb'
+    env = dict(os.environ, PYTHONPATH=repo_path, STEAM_SEARCHER_DB=str(db_path), OPENAI_API_KEY='sk-test')
+    env.pop('MIGRATE_ON_STARTUP', None)
+    # a fresh interpreter, the modules imported by other tests would hide what the import pulls in
+    result = subprocess.run([sys.executable, '-c', probe], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    assert report['seconds'] < import_budget_seconds, f"importing app.routes.api took {report['seconds']:.2f}s"
+    loaded = [module for module in heavy_modules if module in report['modules']]
+    assert not loaded, f"importing app.routes.api loaded {', '.join(loaded)}"
+    assert not db_path.exists(), "importing app.routes.api created the database file"
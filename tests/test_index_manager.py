@@ -0,0 +1,24 @@
+from app.services.embedder import embeddings_table_name
+from app.services.index_manager import build_index, hnsw_indexes, index_status, measure_recall, rebuild_indexes
+from app.services.matryoshka import build_short_vectors
+from test_embedding_job import run
+
+main_index = f'{embeddings_table_name}_index'
+short_index = f'{embeddings_table_name}_short_index'
+
+
+def test_an_embedding_run_degrades_every_index_and_the_rebuild_fixes_them(writable_catalog):
+    conn = writable_catalog
+    build_index(conn, embeddings_table_name, main_index, m=8, ef_construction=40)
+    build_short_vectors(conn, embeddings_table_name, 8)
+    run(conn)
+    assert {index_status(conn, name)['state'] for name in (main_index, short_index)} == {'degraded'}
+    assert index_status(conn, short_index)['entries'] > index_status(conn, short_index)['rows']
+
+    assert sorted(rebuild_indexes(conn, embeddings_table_name)) == sorted([main_index, short_index])
+    for name in (main_index, short_index):
+        measure_recall(conn, name)
+        status = index_status(conn, name)
+        assert status['entries'] == status['rows'] and status['state'] == 'healthy', status
+    # the rebuild keeps the parameters the index was tuned with
+    assert {name: (parameters['m'], parameters['ef_construction']) for name, _, parameters in hnsw_indexes(conn, embeddings_table_name)}[main_index] == (8, 40)
@@ -0,0 +1,42 @@
+from app.db.connection import get_cursor
+from app.services import searcher
+from app.services.lexical import bm25_rank, reciprocal_rank_fusion, rrf_k, title_rank
+
+no_filter = ['det.price >= ?'], [0]
+
+
+def test_rrf_weights_the_two_rankings():
+    # 1/61 + 1/63 is just above 2/62
+    assert reciprocal_rank_fusion([1, 2, 3], [3, 2, 1], 0.5) == [1, 3, 2]
+    assert reciprocal_rank_fusion([1, 2], [2, 1], 0.9) == [1, 2]
+    assert reciprocal_rank_fusion([1, 2], [2, 1], 0.1) == [2, 1]
+    # a game found by both rankings beats the first of a single one
+    assert reciprocal_rank_fusion([1, 3], [2, 3], 0.5)[0] == 3
+    assert rrf_k == 60
+
+
+def test_title_rank_puts_the_exact_title_first():
+    ids, exact = title_rank(get_cursor(), '  Synthetic GAME 12 ', *no_filter, 5)
+    assert exact and ids == [12]
+    ids, exact = title_rank(get_cursor(), 'synthetic game', *no_filter, 5)
+    assert not exact and len(ids) == 5
+
+
+def test_bm25_ranks_the_games_that_mention_the_words():
+    conn = get_cursor()
+    ids = bm25_rank(conn, 'roguelike deckbuilder', *no_filter, 20)
+    assert ids
+    descriptions = dict(conn.execute(
+        "SELECT id, lower(short_description) FROM detail WHERE id IN (SELECT UNNEST(?::BIGINT[]))", [ids]
+    ).fetchall())
+    assert all('roguelike' in descriptions[app_id] or 'deckbuilder' in descriptions[app_id] for app_id in ids)
+    assert 'roguelike' in descriptions[ids[0]] and 'deckbuilder' in descriptions[ids[0]]
+
+
+def test_hybrid_mode_fuses_bm25_and_vector_ranks():
+    query = 'roguelike deckbuilder'
+    lexical = searcher.rank_query_search(query, None, None, 0, 1000000, k=10, mode='lexical')
+    semantic = searcher.rank_query_search(query, None, None, 0, 1000000, k=10, mode='semantic')
+    assert searcher.rank_query_search(query, None, None, 0, 1000000, k=10, mode='hybrid', lexical_weight=1.0) == lexical
+    hybrid = searcher.rank_query_search(query, None, None, 0, 1000000, k=10, mode='hybrid', lexical_weight=0.0)
+    assert hybrid[:5] == semantic[:5]
@@ -0,0 +1,41 @@
+import pytest
+from app.db.connection import get_cursor
+from app.services import planner, searcher
+from app.services.planner import estimate_selectivity, plan_search
+
+
+def matching(genre: list[str], price_end: float) -> int:
+    return get_cursor().execute(
+        "SELECT COUNT(*) FROM detail WHERE list_has_any(genres, ?) AND price BETWEEN 0 AND ?", [genre, price_end]
+    ).fetchone()[0]
+
+
+@pytest.mark.parametrize('genre, price_end', [(['Indie'], 1000000), (['Racing'], 1000000), (['Action', 'RPG'], 1999)])
+def test_selectivity_is_close_to_the_matching_share(genre, price_end):
+    conn = get_cursor()
+    total = conn.execute("SELECT COUNT(*) FROM detail").fetchone()[0]
+    selectivity = estimate_selectivity(conn, None, genre, 0, price_end)
+    assert selectivity == pytest.approx(matching(genre, price_end) / total, abs=0.05)
+
+
+def test_selective_filters_are_scanned_exactly():
+    assert plan_search(get_cursor(), ['VR Supported'], ['Racing'], 0, 1000000, 20)['strategy'] == 'exact'
+
+
+def test_broad_filters_use_the_index_with_enough_candidates(monkeypatch):
+    monkeypatch.setattr(planner, 'exact_max_rows', 0)
+    monkeypatch.setattr(planner, 'exact_max_selectivity', 0)
+    plan = plan_search(get_cursor(), None, ['Indie'], 0, 1000000, 20)
+    assert plan['strategy'] == 'hnsw'
+    assert plan['fetch'] == pytest.approx(20 / plan['selectivity'] * planner.hnsw_overfetch, abs=1)
+    monkeypatch.setattr(planner, 'hnsw_max_fetch', 25)
+    assert plan_search(get_cursor(), None, ['Indie'], 0, 1000000, 20)['fetch'] == 25
+
+
+def test_index_searches_return_k_filtered_games(monkeypatch):
+    monkeypatch.setattr(planner, 'exact_max_rows', 0)
+    monkeypatch.setattr(planner, 'exact_max_selectivity', 0)
+    ids = searcher.rank_query_search('space shooter', None, ['Indie'], 0, 1000000, k=20)
+    assert len(ids) == 20
+    genres = dict(get_cursor().execute("SELECT id, genres FROM detail WHERE id IN (SELECT UNNEST(?::BIGINT[]))", [ids]).fetchall())
+    assert all('Indie' in genres[app_id] for app_id in ids)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from app.services import searcher
+from app.services.embedder import embed_query_cached, embeddings_table_name
+from app.services.quantization import build_quantized, int8_column, quantize_int8, quantized_dimensions
+
+queries = ['space shooter', 'cozy farming', 'dark fantasy roguelike']
+
+
+def test_int8_codes_round_trip_within_half_a_step():
+    matrix = np.random.default_rng(3).normal(size=(50, 32)).astype(np.float32)
+    matrix[0] = 0
+    codes, scales = quantize_int8(matrix)
+    assert codes.dtype == np.int8 and np.abs(codes).max() <= 127
+    assert np.all(np.abs(codes.astype(np.float32) * scales[:, None] - matrix) <= scales[:, None] / 2 + 1e-6)
+
+
+def test_build_quantized_fills_every_row(writable_catalog):
+    conn = writable_catalog
+    build_quantized(conn, embeddings_table_name)
+    assert quantized_dimensions(conn, embeddings_table_name) == len(embed_query_cached('space shooter'))
+    assert conn.execute(f"SELECT COUNT(*) FROM {embeddings_table_name} WHERE {int8_column} IS NULL").fetchone()[0] == 0
+
+
+@pytest.mark.parametrize('query', queries)
+def test_int8_rerank_returns_the_exact_top_k(writable_catalog, query):
+    conn = writable_catalog
+    build_quantized(conn, embeddings_table_name)
+    predicates, params = searcher.build_filters(None, None, 0.0, 1000000.0)
+    query_embedding = embed_query_cached(query)
+    exact = searcher._exact_rank(conn, query_embedding, predicates, params, 20, 0, quantized=False)
+    reranked = searcher._exact_rank(conn, query_embedding, predicates, params, 20, 0, quantized=True)
+    # the shortlist is far larger than k, the full vectors put it back in the exact order
+    assert reranked == exact
+    assert searcher._exact_rank(conn, query_embedding, predicates, params, 10, 10, quantized=True) == exact[10:]
+
+
+def test_without_codes_the_rerank_falls_back_to_the_exact_scan(writable_catalog):
+    predicates, params = searcher.build_filters(None, None, 0.0, 1000000.0)
+    query_embedding = embed_query_cached('space shooter')
+    assert searcher._exact_rank(writable_catalog, query_embedding, predicates, params, 20, 0, quantized=True) == \
+        searcher._exact_rank(writable_catalog, query_embedding, predicates, params, 20, 0, quantized=False)
@@ -0,0 +1,93 @@
+import subprocess
+import sys
+import duckdb
+from app.services.query_cache import QueryEmbeddingCache, move_catalog_cache, normalize_query, query_cache_table_name
+
+
+def cache(tmp_path, **kwargs) -> QueryEmbeddingCache:
+    return QueryEmbeddingCache('test/model', path=str(tmp_path / 'query_cache.duckdb'), **kwargs)
+
+
+def test_lru_evicts_the_least_recently_used_query(tmp_path):
+    lru = cache(tmp_path, max_size=2, persistent=False)
+    lru.put('a', [1.0])
+    lru.put('b', [2.0])
+    assert lru.get('a') == [1.0]
+    lru.put('c', [3.0])
+    assert lru.get('b') is None
+    assert lru.get('a') == [1.0] and lru.get('c') == [3.0]
+
+
+def test_queries_are_normalized_and_embedded_once(tmp_path):
+    calls = []
+    lru = cache(tmp_path, persistent=False)
+
+    def embed(query):
+        calls.append(query)
+        return [float(len(query))]
+
+    assert lru.get_or_embed('  Cozy   Farming ', embed) == lru.get_or_embed('cozy farming', embed)
+    assert calls == [normalize_query('cozy farming')]
+    assert lru.stats()['hits'] == 1
+
+
+def test_persistent_tier_survives_a_new_process(tmp_path):
+    first = cache(tmp_path, flush_size=1)
+    first.put('space shooter', [0.5, 0.25])
+    second = cache(tmp_path)
+    assert second.get('Space Shooter') == [0.5, 0.25]
+    assert second.stats()['persistent_hits'] == 1
+
+
+def test_entries_are_flushed_in_batches(tmp_path):
+    batched = cache(tmp_path, flush_size=3, flush_seconds=3600)
+    batched.put('a', [1.0])
+    batched.put('b', [2.0])
+    assert not (tmp_path / 'query_cache.duckdb').exists()
+    batched.put('c', [3.0])
+    with duckdb.connect(str(tmp_path / 'query_cache.duckdb'), read_only=True) as conn:
+        assert conn.execute(f"SELECT COUNT(*) FROM {query_cache_table_name}").fetchone()[0] == 3
+
+
+def test_locked_file_keeps_the_entries_for_the_next_flush(tmp_path):
+    path = tmp_path / 'query_cache.duckdb'
+    batched = cache(tmp_path, flush_size=100, flush_seconds=3600)
+    batched.put('a', [1.0])
+    assert batched.flush() == 1
+    batched.put('b', [2.0])
+    # another worker reading the cache holds the file lock
+    reader = subprocess.Popen(
+        [sys.executable, '-c', f"import duckdb, time; c = duckdb.connect({str(path)!r}, read_only=True); print('open', flush=True); time.sleep(30)"],
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        assert reader.stdout.readline().strip() == 'open'
+        assert batched.flush() == 0
+    finally:
+        reader.kill()
+        reader.wait()
+    assert batched.flush() == 1
+    assert cache(tmp_path).get('b') == [2.0]
+
+
+def test_read_only_api_still_fills_the_persistent_tier():
+    from app.db.connection import connection_manager
+    from app.services.embedder import embed_query_cached, query_cache
+    assert connection_manager.read_only
+    embedding = embed_query_cached('read only api persistent tier')
+    query_cache.flush()
+    fresh = QueryEmbeddingCache(query_cache.model, path=query_cache.path)
+    assert fresh.get('read only api persistent tier') == embedding
+
+
+def test_migration_moves_the_catalog_table_to_the_cache_file(writable_catalog, tmp_path):
+    writable_catalog.execute(f"""
+        CREATE TABLE {query_cache_table_name} (query VARCHAR, model VARCHAR, embedding FLOAT[], created_at TIMESTAMP, PRIMARY KEY (query, model))
+    """)
+    writable_catalog.execute(f"INSERT INTO {query_cache_table_name} VALUES ('old query', 'test/model', [1.5], now())")
+    path = str(tmp_path / 'moved.duckdb')
+    move_catalog_cache(writable_catalog, path)
+    assert not writable_catalog.execute(
+        "SELECT 1 FROM duckdb_tables() WHERE table_name = ?", [query_cache_table_name]
+    ).fetchone()
+    assert QueryEmbeddingCache('test/model', path=path).get('old query') == [1.5]
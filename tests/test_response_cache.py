@@ -0,0 +1,58 @@
+from app.services.response_cache import CachedResponse, ResponseCache, etag_matches, make_etag, response_cache
+
+
+def entry(body: bytes) -> CachedResponse:
+    return CachedResponse(body, 'application/json', make_etag(body), {})
+
+
+def test_search_responses_get_an_etag_and_a_304_when_it_matches(client):
+    body = {'query': 'cozy farming', 'genre': ['Indie', 'RPG'], 'price_end': 5000}
+    first = client.post('/api/search', json=body)
+    assert first.status_code == 200 and first.headers['ETag'] and 'max-age=' in first.headers['Cache-Control']
+    hits = response_cache.stats()['hits']
+    # the same filters in another order are the same response
+    second = client.post('/api/search', json=dict(body, genre=['RPG', 'Indie'], price_end=5000.0))
+    assert second.headers['ETag'] == first.headers['ETag'] and second.get_data() == first.get_data()
+    assert response_cache.stats()['hits'] == hits + 1
+    revalidated = client.post('/api/search', json=body, headers={'If-None-Match': first.headers['ETag']})
+    assert revalidated.status_code == 304 and revalidated.get_data() == b''
+    assert revalidated.headers['ETag'] == first.headers['ETag']
+
+
+def test_streamed_and_failed_responses_are_not_cached(client):
+    streamed = client.post('/api/search', json={'query': 'cozy farming', 'format': 'ndjson'})
+    assert streamed.status_code == 200 and 'ETag' not in streamed.headers
+    failed = client.post('/api/search', json={'query': 'cozy farming', 'k': 0})
+    assert failed.status_code == 400 and 'ETag' not in failed.headers
+
+
+def test_facet_responses_are_revalidated(client):
+    first = client.get('/api/get_genres?with_counts=true')
+    assert client.get('/api/get_genres?with_counts=true', headers={'If-None-Match': f'W/{first.headers["ETag"]}'}).status_code == 304
+
+
+def test_a_newer_dataset_version_drops_the_old_entries():
+    cache = ResponseCache(max_size=10, max_bytes=1000)
+    cache.put(1, 'a', entry(b'one'))
+    assert cache.get(1, 'a').body == b'one'
+    assert cache.get(2, 'a') is None
+    # a request that read the old version doesnt bring its entry back
+    cache.put(1, 'a', entry(b'one'))
+    assert cache.get(2, 'a') is None
+
+
+def test_entries_are_evicted_by_count_and_by_bytes():
+    cache = ResponseCache(max_size=2, max_bytes=10)
+    cache.put(1, 'a', entry(b'1234'))
+    cache.put(1, 'b', entry(b'1234'))
+    cache.put(1, 'c', entry(b'1234'))
+    assert cache.get(1, 'a') is None and cache.stats()['entries'] == 2
+    cache.put(1, 'd', entry(b'12345678'))
+    assert cache.stats()['bytes'] <= 10
+
+
+def test_if_none_match_lists_and_weak_tags():
+    etag = make_etag(b'body')
+    assert etag_matches(f'"other", {etag}', etag)
+    assert etag_matches(f'W/{etag}', etag) and etag_matches('*', etag)
+    assert not etag_matches(None, etag) and not etag_matches('"other"', etag)
@@ -0,0 +1,35 @@
+import duckdb
+import numpy as np
+import pytest
+from app.services.embedder import embeddings_table_name
+from app.services.similar import _distances, neighbors_table_name, refresh_neighbors, similar_ids
+
+duckdb_functions = {'l2sq': 'array_distance', 'cosine': 'array_cosine_distance', 'ip': 'array_negative_inner_product'}
+
+
+@pytest.mark.parametrize('metric', list(duckdb_functions))
+def test_distances_match_the_duckdb_distance_function(metric):
+    rng = np.random.default_rng(3)
+    matrix = rng.standard_normal((20, 8)).astype(np.float32)
+    norms = np.einsum('ij,ij->i', matrix, matrix)
+    expected = duckdb.execute(
+        f"SELECT {duckdb_functions[metric]}(a.v::FLOAT[8], b.v::FLOAT[8]) FROM (SELECT UNNEST(?::FLOAT[][]) AS v) a "
+        f"CROSS JOIN (SELECT row_number() OVER () AS i, v FROM (SELECT UNNEST(?::FLOAT[][]) AS v)) b",
+        [matrix[:3].tolist(), matrix.tolist()]
+    ).fetchall()
+    distances = _distances(matrix[:3], matrix, norms, metric)
+    assert np.allclose(distances.ravel(), [row[0] for row in expected], atol=1e-4)
+
+
+def test_refreshed_neighbors_are_the_exact_nearest_games(writable_catalog):
+    assert refresh_neighbors(writable_catalog, embeddings_table_name, count=5, full=True) > 0
+    app_id, neighbor_ids = writable_catalog.execute(f"SELECT id, neighbor_ids FROM {neighbors_table_name} LIMIT 1").fetchone()
+    exact = writable_catalog.execute(f"""
+        SELECT CAST(other.id AS BIGINT)
+        FROM {embeddings_table_name} AS game, {embeddings_table_name} AS other
+        WHERE game.id = ? AND other.id != game.id
+        ORDER BY array_distance(game.embedding, other.embedding) + 0, other.id
+        LIMIT 5
+    """, [app_id]).fetchall()
+    assert neighbor_ids == [row[0] for row in exact]
+    assert similar_ids(writable_catalog, app_id, ['det.price >= ?'], [0], 3) == neighbor_ids[:3]
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app.services.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def test_concurrent_calls_with_the_same_key_run_once():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def search():
+        calls.append(1)
+        release.wait(5)
+        return [1, 2, 3]
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(flight.do, 'key', search) for _ in range(5)]
+        while flight.coalesced < 4:
+            time.sleep(0.001)
+        release.set()
+        results = [future.result() for future in futures]
+    assert calls == [1]
+    assert results == [[1, 2, 3]] * 5
+    # the key is released, the next call runs again
+    assert flight.do('key', lambda: 'again') == 'again'
+
+
+def test_waiters_get_the_leader_exception():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.05)
+        raise RuntimeError('embedding failed')
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flight.do, 'key', failing)
+        started.wait(5)
+        waiter = executor.submit(flight.do, 'key', lambda: 'not run')
+        for future in (leader, waiter):
+            with pytest.raises(RuntimeError, match='embedding failed'):
+                future.result()
+
+
+def test_async_waiters_share_the_task_and_survive_a_cancelled_caller():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def search():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'result'
+
+    async def main():
+        cancelled = asyncio.ensure_future(flight.do('key', search))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flight.do('key', search)) for _ in range(3)]
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await asyncio.gather(*waiters)
+
+    assert asyncio.run(main()) == ['result'] * 3
+    assert calls == [1]
+    assert flight.coalesced == 3